@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+## A stand-in for a Hue Bridge's event stream, for trying out (and testing) event stream mode without a bridge.
+##
+## It serves a few lights and sensors on the v1 API (GET only), and the CLIP v2 event stream at /eventstream/clip/v2.
+## Every few seconds it changes something -- a light goes on or off or changes brightness, the motion sensor
+## trips or clears, the temperature drifts -- and sends the change down the stream the way a bridge would.
+##
+## Usage:
+##    ./sse_standin.py [port] [seconds between changes] [changes before dropping the stream]
+##
+## Then point a table at it:
+##    create server myhuestandin foreign data wrapper multicorn options
+##        (wrapper 'hue_fdw.HueLightsFDW.HueLightsFDW',
+##         bridge 'localhost:8080',
+##         username 'postgreshue',
+##         event_stream 'true',
+##         event_stream_url 'http://localhost:8080/eventstream/clip/v2');
+##
+## With a "changes before dropping" count the stand-in hangs up on the stream that often, so you can watch
+## the wrapper fall back to polling and reconnect.
+##
+
+import sys
+import json
+import time
+import random
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+
+port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+interval = float(sys.argv[2]) if len(sys.argv) > 2 else 2
+dropAfter = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+
+## What the v1 API would say:
+state = {
+    'lights': {
+        '1': {'state': {'on': True, 'bri': 254, 'hue': 8418, 'sat': 140, 'effect': 'none', 'xy': [0.4573, 0.41],
+                        'ct': 366, 'alert': 'none', 'colormode': 'ct', 'reachable': True},
+              'type': 'Extended color light', 'name': 'Hallway', 'modelid': 'LCT001', 'uniqueid': '00:17:88:01:00:00:00:01-0b',
+              'swversion': '5.23.1.13452', 'pointsymbol': {}},
+        '2': {'state': {'on': False, 'bri': 1, 'hue': 8418, 'sat': 140, 'effect': 'none', 'xy': [0.4573, 0.41],
+                        'ct': 366, 'alert': 'none', 'colormode': 'xy', 'reachable': True},
+              'type': 'Extended color light', 'name': 'Kitchen', 'modelid': 'LCT001', 'uniqueid': '00:17:88:01:00:00:00:02-0b',
+              'swversion': '5.23.1.13452', 'pointsymbol': {}},
+    },
+    'sensors': {
+        '5': {'state': {'presence': False, 'lastupdated': '2015-01-01T00:00:00'},
+              'config': {'on': True, 'battery': 100, 'reachable': True, 'alert': 'none', 'ledindication': False,
+                         'usertest': False, 'sensitivity': 2, 'sensitivitymax': 2},
+              'name': 'Hallway sensor', 'type': 'ZLLPresence', 'modelid': 'SML001', 'manufacturername': 'Philips',
+              'swversion': '6.1.0.18912', 'uniqueid': '00:17:88:01:00:00:00:05-02-0406'},
+        '6': {'state': {'temperature': 2150, 'lastupdated': '2015-01-01T00:00:00'},
+              'config': {'on': True, 'battery': 100, 'reachable': True, 'alert': 'none', 'ledindication': False,
+                         'usertest': False},
+              'name': 'Hallway temperature', 'type': 'ZLLTemperature', 'modelid': 'SML001', 'manufacturername': 'Philips',
+              'swversion': '6.1.0.18912', 'uniqueid': '00:17:88:01:00:00:00:05-02-0402'},
+    },
+}
+
+lock = threading.Lock()
+
+## The streams that are listening, and the next event id:
+listeners = []
+eventCount = [0]
+
+
+####
+## Make one random change, and the v2 resource update that describes it.
+def change():
+
+    now = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    which = random.choice(['light', 'motion', 'temperature'])
+
+    if which == 'light':
+        lightID = random.choice(state['lights'].keys())
+        light = state['lights'][lightID]['state']
+        if random.random() < 0.5:
+            light['on'] = not light['on']
+            update = {'on': {'on': light['on']}}
+        else:
+            light['bri'] = random.randint(1, 254)
+            update = {'dimming': {'brightness': round(light['bri'] * 100 / 254.0, 2)}}
+        update.update({'id_v1': '/lights/' + lightID, 'type': 'light'})
+
+    elif which == 'motion':
+        sensor = state['sensors']['5']['state']
+        sensor['presence'] = not sensor['presence']
+        sensor['lastupdated'] = now.rstrip('Z')
+        update = {'id_v1': '/sensors/5', 'type': 'motion', 'motion': {'motion': sensor['presence'], 'motion_valid': True}}
+
+    else:
+        sensor = state['sensors']['6']['state']
+        sensor['temperature'] += random.randint(-20, 20)
+        sensor['lastupdated'] = now.rstrip('Z')
+        update = {'id_v1': '/sensors/6', 'type': 'temperature',
+                  'temperature': {'temperature': sensor['temperature'] / 100.0, 'temperature_valid': True}}
+
+    return [{'creationtime': now, 'id': '%08d' % eventCount[0], 'type': 'update', 'data': [update]}]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+
+        if self.path.startswith('/eventstream/clip/v2'):
+            return self.stream()
+
+        # /api/<username>/<endpoint>/<id>
+        path = [part for part in self.path.split('/') if part][2:]
+        with lock:
+            node = state
+            for part in path:
+                if not isinstance(node, dict) or part not in node:
+                    node = [{'error': {'type': 3, 'address': '/' + '/'.join(path), 'description': 'resource, /%s, not available' % '/'.join(path)}}]
+                    break
+                node = node[part]
+            body = json.dumps(node)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream(self):
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(': hi\n\n')
+        self.wfile.flush()
+
+        events = []
+        event = threading.Event()
+        with lock:
+            listeners.append((events, event))
+
+        sent = 0
+        try:
+            while not dropAfter or sent < dropAfter:
+                # Keep-alive, like the bridge, when nothing has happened:
+                if not event.wait(interval * 2):
+                    self.wfile.write(': hi\n\n')
+                    self.wfile.flush()
+                    continue
+                with lock:
+                    event.clear()
+                    waiting = events[:]
+                    del events[:]
+                for message in waiting:
+                    self.wfile.write('id: %s\ndata: %s\n\n' % (message[0]['id'], json.dumps(message)))
+                    sent += 1
+                self.wfile.flush()
+        finally:
+            with lock:
+                listeners.remove((events, event))
+
+    def log_message(self, format, *args):
+        sys.stderr.write('%s\n' % (format % args))
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+####
+def changer():
+    while True:
+        time.sleep(interval)
+        with lock:
+            eventCount[0] += 1
+            message = change()
+            for events, event in listeners:
+                events.append(message)
+                event.set()
+        print json.dumps(message)
+
+
+if __name__ == '__main__':
+
+    thread = threading.Thread(target=changer)
+    thread.daemon = True
+    thread.start()
+
+    print 'Hue event stream stand-in on port %d' % port
+    StandInServer(('', port), StandInHandler).serve_forever()
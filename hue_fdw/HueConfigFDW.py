@@ -5,25 +5,29 @@
 ##   * Lights
 ##   * Config
 ##   * Sensors
+##   * Groups
+##   * Scenes
+##   * Schedules
+##   * Rules
 ## as separate classes since they have very different structures and purposes.
 ## 
-## Rules, Scenes, and Groups are not yet implemented.
-##
 ## Each of these FDW classes is in a different file.
 ## This file has the one for the * Config * endpoint in it.
 ##
 ## R.Otten - 2015
 ################################################################################################################
 
-from collections import OrderedDict
 import json
 
 from multicorn import ForeignDataWrapper
 from multicorn.utils import log_to_postgres, ERROR, WARNING, DEBUG
 
-import requests
-
-from operatorFunctions import unknownOperatorException, getOperatorFunction
+from hueBridge import hueBridgeException, getBridge, DEFAULT_FULLSTATE_TTL_MS
+from jsonCache import SerializationCache
+from commandScheduler import Command, CommandBuffer
+from hue_errors import describeErrors
+import hueStats
+from explainScan import explainScan, plannedRequest, describeQual
 
 
 ##############################################
@@ -35,6 +39,12 @@ from operatorFunctions import unknownOperatorException, getOperatorFunction
 ##              (see http://www.developers.meethue.com/documentation/getting-started )
 ##  hueid    -- Optional:  The Hue system ID - not used at this time
 ##  kvtype   -- Optional:  json or hstore - Whether nested KV data returns JSON format or HSTORE format. (default:  json)
+##  pool_size, pool_idle_timeout -- Optional:  Connection pool settings for the bridge.  (see hueBridge.py)
+##  cache_ttl_ms -- Optional:  Integer - Milliseconds a scan may reuse the last response from the bridge. (default: 0)
+##  fetch_mode   -- Optional:  endpoint or fullstate - Whether a scan GETs just config, or the whole bridge datastore
+##                  (which refreshes every Hue table's snapshot at once). (default: endpoint)
+##  transactional  -- Optional: true or false - Hold config changes back until the transaction commits, merging repeated
+##                    changes into one PUT, and sending nothing on rollback.  (default: false)
 ##
 ## ** We do not yet support whitelist management with this foreign data wrapper. **
 ##
@@ -62,7 +72,25 @@ class HueConfigFDW(ForeignDataWrapper):
             self.userName = 'postgreshue'
             log_to_postgres('Using Default Username for Hue Config setup:  postgreshue.', WARNING)
 
-        self.baseURL = 'http://' + self.bridge + "/api/" + self.userName + "/config/"
+        # All of the Hue wrappers in this backend share one pooled connection to each bridge:
+        self.hueBridge = getBridge(self.bridge, options)
+
+        # Either GET just our own endpoint, or the whole datastore so the other Hue tables can share the response:
+        if options.has_key('fetch_mode'):
+            if options['fetch_mode'].lower() in ['endpoint', 'fullstate']:
+                self.fetchMode = options['fetch_mode'].lower()
+            else:
+                log_to_postgres('Invalid Fetch Mode for Hue Config setup: %s. (Choose "endpoint" or "fullstate")' % options['fetch_mode'], ERROR)
+        else:
+            self.fetchMode = 'endpoint'
+
+        # Scans within this many seconds of the last one are answered from the bridge snapshot:
+        if options.has_key('cache_ttl_ms'):
+            self.cacheTTL = float(options['cache_ttl_ms']) / 1000
+        elif self.fetchMode == 'fullstate':
+            self.cacheTTL = float(DEFAULT_FULLSTATE_TTL_MS) / 1000
+        else:
+            self.cacheTTL = 0
 
         # We don't really use this anywhere.  Including it for now in case it ends up having a use.
         if options.has_key('hueid'):
@@ -81,6 +109,23 @@ class HueConfigFDW(ForeignDataWrapper):
         else:
             self.kvType = 'json'
 
+        # Send our changes at the end of each statement, or hold them until the transaction commits:
+        if options.has_key('transactional'):
+            if options['transactional'].lower() in ['true', 'false']:
+                self.transactional = options['transactional'].lower() == 'true'
+            else:
+                log_to_postgres('Invalid Transactional setting for Hue Config setup: %s. (Choose "true" or "false")' % options['transactional'], ERROR)
+        else:
+            self.transactional = False
+
+        self.transactionCommands = CommandBuffer()
+
+        # The nested objects hardly ever change, so we keep the json we made for them last time:
+        self.jsonCache = SerializationCache()
+
+        # What the last scan cost, for EXPLAIN VERBOSE (see explainScan.py):
+        self.lastScan = None
+
         ###
         # We need to identify the "primary key" column so we can do updates:
         self._row_id_column = 'name'
@@ -128,6 +173,16 @@ class HueConfigFDW(ForeignDataWrapper):
                               # 
                               'whitelist'         : 'whitelist' }
 
+        # Rough widths (in bytes) of each column, for the planner.  Anything not listed is a short string.
+        self.columnWidths = { 'software_update' : 200,
+                              'link_button'     : 1,
+                              'zigbee_channel'  : 4,
+                              'portal_state'    : 120,
+                              'portal_services' : 1,
+                              'dhcp'            : 1,
+                              'proxy_port'      : 4,
+                              'whitelist'       : 1000 }
+
 
     ############
     # We need to overload this function so Updates will work
@@ -136,56 +191,120 @@ class HueConfigFDW(ForeignDataWrapper):
         return self._row_id_column
 
 
+    ############
+    # Query planning:
+    # The config endpoint is always exactly one row.
+    def get_rel_size(self, quals, columns):
+        return (1, sum([self.columnWidths.get(column, 16) for column in columns]))
+
+
+    ############
+    # There is only one row, so looking it up by name doesn't cost anything more than any other scan.
+    # But without a cache, every lookup in a nested loop join would be a round trip to the bridge.
+    def get_path_keys(self):
+
+        if self.cacheTTL > 0:
+            return [(('name',), 1)]
+
+        return []
+
+
+    ############
+    # EXPLAIN:  what a scan would ask the bridge for.  (see explainScan.py)
+    # There is only the one row, so we don't test any quals on it.
+    def explain(self, quals, columns, sortkeys=None, verbose=False):
+
+        request = plannedRequest(self.hueBridge, self.userName, 'config', None, self.cacheTTL, self.fetchMode == 'fullstate')
+
+        lines = explainScan([(self.bridge, request)], [], [], columns, self.lastScan, verbose)
+
+        if quals:
+            lines.append('Ignored:  %s' % ', '.join([describeQual(qual) for qual in quals]))
+
+        return lines
+
+
+    ############
+    # Work out, once per scan, how to pull each table column out of the config.
+    # Multicorn wants a sequence row to have a value for every column of the table, in table order,
+    # so the columns the query didn't ask for just get None.
+    def compileExtractors(self, columns):
+
+        extractors = []
+
+        for column in self.columns:
+
+            if column not in columns:
+                extractors.append(lambda config: None)
+
+            elif column in ['software_update', 'portal_state', 'whitelist']:
+                # HSTORE Column Type:
+                if self.kvType == 'hstore':
+                    extractors.append(lambda config, key=self.columnKeyMap[column]: config[key])
+                # JSON Column Type:
+                else:
+                    extractors.append(lambda config, key=self.columnKeyMap[column]: self.jsonCache.dumps(key, config[key]))
+
+            elif column == 'proxy_port':
+                extractors.append(lambda config, key=self.columnKeyMap[column]: int(config[key]))
+
+            else:
+                extractors.append(lambda config, key=self.columnKeyMap[column]: config[key])
+
+        return tuple(extractors)
+
+
     ############
     # SQL SELECT:
-    # We get back all of the lights we can find and roll them up into rows
+    # We get back the bridge configuration as one row
     def execute(self, quals, columns):
 
         log_to_postgres('Hue Config Query Columns:  %s' % columns, DEBUG)
         log_to_postgres('Hue Config Query Filters:  %s' % quals, DEBUG)
 
-        results = requests.get(self.baseURL)
+        extractors = self.compileExtractors(columns)
+
+        # What this scan costs, for EXPLAIN VERBOSE:
+        scanCost = hueStats.ScanCost('config', [self.bridge])
+        self.lastScan = scanCost
 
         try:
 
-            hueResults = json.loads(results.text)
+            hueResults = self.hueBridge.snapshot(self.userName, 'config', self.cacheTTL, self.fetchMode == 'fullstate')
 
-        except:
+        except hueBridgeException, e:
 
-            log_to_postgres('Unexpected (non-JSON) response from the Hue Bridge: %s' % self.bridge, ERROR)
             log_to_postgres('%s' % e, ERROR)
-            log_to_postgres('%s' % results, ERROR)
-         
-        row = OrderedDict()
 
-        # add the requested columns to the output:
-        for column in columns:
+        # If the bridge didn't answer and serve_stale is on, we're looking at an old snapshot:
+        for warning in self.hueBridge.takeWarnings():
+            log_to_postgres(warning, WARNING)
 
-            if column in ['software_update', 'portal_state', 'whitelist']:
-                # HSTORE Column Type:
-                if self.kvType == 'hstore':
-                    row[column] = hueResults[self.columnKeyMap[column]]
-                # JSON Column Type:
-                else:  
-                    row[column] = json.dumps(hueResults[self.columnKeyMap[column]])
+        scanCost.update()
 
-            elif column == 'proxy_port':
-                row[column] = int(hueResults[self.columnKeyMap[column]])
+        # Changes this transaction is still holding back, so we read our own writes:
+        if self.transactional and 'config' in self.transactionCommands.pending:
+            hueResults = dict(hueResults)
+            hueResults.update(self.transactionCommands.pending['config'].payload)
 
-            else:
-                row[column] = hueResults[self.columnKeyMap[column]]
+        # Rows are lists in table column order.
+        row = [extract(hueResults) for extract in extractors]
+
+        # We don't filter the one row, but it still counts as a scan (see hueStats.py):
+        scanCost.countRows(self.bridge, lambda row: True)(row)
+        scanCost.finish()
 
         # we only ever get one row back.  We are going to ignore quals.
         if len(quals):
             log_to_postgres('Hue Config Select called with qualifiers - IGNORED', WARNING)
 
         yield row
- 
+
 
 
     ############
     # SQL UPDATE:
-    ## -- we should consider implementing 'rollback' (and, necessarily, 'commit')
+    # The change is sent at the end of the statement (see end_modify()), or with "transactional" set, at commit.
     def update(self, name, newValues):
 
         log_to_postgres('Hue Config Update Request - name:  %s' % name, DEBUG)
@@ -212,37 +331,96 @@ class HueConfigFDW(ForeignDataWrapper):
 
                     newState[self.columnKeyMap[changedColumn]] = newValues[changedColumn]
 
-        log_to_postgres(self.baseURL + ' -- ' + json.dumps(newState), DEBUG)
+        command = Command('config', newState)
 
-        try:
+        log_to_postgres('Hue Config Update Queued - %s' % command, DEBUG)
 
-            results = requests.put(self.baseURL, json.dumps(newState))
+        # Through the bridge's command scheduler, like everything else we PUT.  It paces us, and sends again
+        # whatever the bridge failed for its own reasons.
+        if self.transactional:
+            self.transactionCommands.add(command)
+        else:
+            self.hueBridge.scheduler.submit(self.userName, command, self)
 
-        except:
 
-            log_to_postgres('Unexpected (non-JSON) response from the Hue Bridge: %s' % self.bridge, ERROR)
-            log_to_postgres('%s' % e, ERROR)
-            log_to_postgres('%s' % results, ERROR)
+    ############
+    # End of an INSERT/UPDATE/DELETE statement:
+    # Send the change we queued up in update() -- unless we are holding it for the end of the transaction.
+    def end_modify(self):
 
-        
-        try:
+        if not self.transactional:
+            self.sendCommands()
 
-            hueResults = json.loads(results.text)
 
-        except Exception, e:
+    ############
+    # Transactions:
+    # With "transactional" set, everything the transaction changed goes out just before it commits.
+    # An ERROR here aborts the commit.
+    def pre_commit(self):
 
-            log_to_postgres('Unexpected (non-JSON) response from the Hue Bridge: %s' % self.bridge, ERROR)
-            log_to_postgres('%s' % e, ERROR)
-            log_to_postgres('%s' % results, ERROR)
-    
+        if self.transactional:
+            for command in self.transactionCommands.take():
+                self.hueBridge.scheduler.submit(self.userName, command, self)
+            self.sendCommands()
+
+
+    # An UPDATE that failed part way through may also have left its change with the scheduler.  It mustn't go out
+    # with our next statement.
+    def rollback(self):
+        self.transactionCommands.discard()
+        self.hueBridge.scheduler.discard(self)
+
+
+    def sub_begin(self, level):
+        self.transactionCommands.savepoint()
+
+
+    def sub_commit(self, level):
+        self.transactionCommands.release()
+
+
+    def sub_rollback(self, level):
+        self.transactionCommands.rollbackToSavepoint()
+        self.hueBridge.scheduler.discard(self)
+
+
+    ############
+    # Send whatever the scheduler is holding for us, and check what the bridge made of it.
+    # The bridge answers each setting separately.  We keep the ones that worked, and report all of the others at once.
+    def sendCommands(self):
+
+        failures = []
+        errors = []
+
+        for command, hueResults, e in self.hueBridge.scheduler.drain(1, self):
+
+            if e is not None:
+
+                # We can't tell whether the bridge got our request, so don't trust our snapshot any more:
+                self.hueBridge.invalidate(self.userName, 'config')
+                failures.append('%s' % e)
+                continue
+
+            if not isinstance(hueResults, list):
+                self.hueBridge.invalidate(self.userName, 'config')
+                errors.append({'address': '/config', 'description': 'unexpected response %s' % hueResults})
+                continue
+
+            for status in hueResults:
+
+                # Keep our snapshot in step with what the bridge says it changed:
+                if status.has_key('success'):
+                    self.hueBridge.applySuccess(self.userName, status['success'])
+                else:
+                    errors.append(status.get('error', {'address': '/config', 'description': '%s' % status}))
+
+        failures.extend(describeErrors(errors))
 
-        for status in hueResults:
+        if failures:
 
-              if not status.has_key('success'):
+            log_to_postgres('Hue Config Full Results: %s' % failures, DEBUG)
+            log_to_postgres('Hue Config Column Update Failed:  %s' % '; '.join(failures), ERROR)
 
-                    log_to_postgres('Hue Config Full Results: %s' % results.text, DEBUG)
-                    log_to_postgres('Hue Config Column Update Failed.', ERROR)
-            
 
     ############
     # SQL INSERT:
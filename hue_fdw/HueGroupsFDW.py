@@ -0,0 +1,569 @@
+################################################################################################################
+## This is the implementation of the Multicorn ForeignDataWrapper class as an interface to the Philips Hue system
+##
+## We set up these endpoints:
+##   * Lights
+##   * Config
+##   * Sensors
+##   * Groups
+##   * Scenes
+##   * Schedules
+##   * Rules
+## as separate classes since they have very different structures and purposes.
+##
+## Each of these FDW classes is in a different file.
+## This file has the one for the * Groups * endpoint in it.
+##
+################################################################################################################
+
+import json
+
+from multicorn import ForeignDataWrapper
+from multicorn.utils import log_to_postgres, ERROR, WARNING, DEBUG
+
+from operatorFunctions import unknownOperatorException, compileQuals, getEqualityValue
+from hueBridge import hueBridgeException, getBridge, DEFAULT_FULLSTATE_TTL_MS
+from commandScheduler import Command, CommandBuffer
+from hue_errors import describeErrors
+import hueStats
+from explainScan import explainScan, plannedRequest, pushedQuals
+
+
+## Our row estimate before we've seen the bridge -- a handful of rooms:
+DEFAULT_ESTIMATED_GROUPS = 8
+
+
+##############################################
+## The Foreign Data Wrapper Class for Groups:
+##
+## Options:
+##  bridge   -- Required:  The IP address for the Hue Bridge
+##  username -- Required:  The API user name - configured when the bridge is set up
+##              (see http://www.developers.meethue.com/documentation/getting-started )
+##  pool_size, pool_idle_timeout -- Optional:  Connection pool settings for the bridge.  (see hueBridge.py)
+##  max_group_commands_per_sec -- Optional:  Rate limit for the group commands we send the bridge.  (see hueBridge.py)
+##  cache_ttl_ms -- Optional:  Integer - Milliseconds a scan may reuse the last response from the bridge. (default: 0)
+##  fetch_mode   -- Optional:  endpoint or fullstate - Whether a scan GETs just groups, or the whole bridge datastore
+##                  (which refreshes every Hue table's snapshot at once). (default: endpoint)
+##  transitiontime -- Optional: Integer - Number of 100ms the bulbs will take to transition during an update. (default: 4)
+##  transactional  -- Optional: true or false - Hold group actions back until the transaction commits, merging repeated
+##                    changes to a group into one action, and sending nothing on rollback.  (default: false)
+##
+## An UPDATE of a group's action columns is sent as a single PUT to /groups/<id>/action.  The bridge broadcasts it
+## to every light in the group at once, instead of us sending each light its own command.
+##
+## Group 0 (every light on the bridge) isn't listed under /groups, so it doesn't show up here.
+##
+## ** We do not yet support creating or deleting groups with this foreign data wrapper. **
+##
+class HueGroupsFDW(ForeignDataWrapper):
+
+    """
+    Philips Hue Groups Foreign Data Wrapper for PostgreSQL
+    """
+
+    def __init__(self, options, columns):
+
+        super(HueGroupsFDW, self).__init__(options, columns)
+
+        log_to_postgres('Hue Groups options:  %s' % options, DEBUG)
+        log_to_postgres('Hue Groups columns:  %s' % columns, DEBUG)
+
+        if options.has_key('bridge'):
+            self.bridge = options['bridge']
+        else:
+            log_to_postgres('bridge IP address is required for Hue Groups setup.', ERROR)
+
+        if options.has_key('username'):
+            self.userName = options['username']
+        else:
+            self.userName = 'postgreshue'
+            log_to_postgres('Using Default Username for Hue Groups setup:  postgreshue.', WARNING)
+
+        # All of the Hue wrappers in this backend share one pooled connection to each bridge:
+        self.hueBridge = getBridge(self.bridge, options)
+
+        # Either GET just our own endpoint, or the whole datastore so the other Hue tables can share the response:
+        if options.has_key('fetch_mode'):
+            if options['fetch_mode'].lower() in ['endpoint', 'fullstate']:
+                self.fetchMode = options['fetch_mode'].lower()
+            else:
+                log_to_postgres('Invalid Fetch Mode for Hue Groups setup: %s. (Choose "endpoint" or "fullstate")' % options['fetch_mode'], ERROR)
+        else:
+            self.fetchMode = 'endpoint'
+
+        # Scans within this many seconds of the last one are answered from the bridge snapshot:
+        if options.has_key('cache_ttl_ms'):
+            self.cacheTTL = float(options['cache_ttl_ms']) / 1000
+        elif self.fetchMode == 'fullstate':
+            self.cacheTTL = float(DEFAULT_FULLSTATE_TTL_MS) / 1000
+        else:
+            self.cacheTTL = 0
+
+        # Like the lights table, this is an update option rather than something we can query.
+        if options.has_key('transitiontime'):
+            self.transitionTime = int(options['transitiontime'])
+        else:
+            # The Hue System Default is '4' - which is 400ms.
+            self.transitionTime = 4
+
+        # Send our changes at the end of each statement, or hold them until the transaction commits:
+        if options.has_key('transactional'):
+            if options['transactional'].lower() in ['true', 'false']:
+                self.transactional = options['transactional'].lower() == 'true'
+            else:
+                log_to_postgres('Invalid Transactional setting for Hue Groups setup: %s. (Choose "true" or "false")' % options['transactional'], ERROR)
+        else:
+            self.transactional = False
+
+        self.transactionCommands = CommandBuffer()
+
+        # What the last scan cost, for EXPLAIN VERBOSE (see explainScan.py):
+        self.lastScan = None
+
+        # The groups our last scan saw, to tell what an UPDATE actually changed:
+        self.scannedGroups = {}
+
+        ###
+        # We need to identify the "primary key" column so we can do updates:
+        self._row_id_column = 'group_id'
+
+        # The columns we'll be using (defaults to 'all'):
+        self.columns = columns
+
+        # Where each column sits in the rows we hand back:
+        self.columnIndex = dict([(column, i) for i, column in enumerate(columns)])
+
+        # These are the only columns we are going to allow to be updated.  They are the group's "action":
+        self.mutable_columns = ['is_on',
+                                'hue',
+                                'effect',
+                                'alert',
+                                'xy',
+                                'brightness',
+                                'saturation',
+                                'color_temperature']
+
+        # The same renames as the lights table, so the two line up.
+        self.columnKeyMap = { 'is_on'             : 'on',
+                              'color_mode'        : 'colormode',
+                              'brightness'        : 'bri',
+                              'saturation'        : 'sat',
+                              'color_temperature' : 'ct',
+                              'any_on'            : 'any_on',
+                              'all_on'            : 'all_on',
+                              #
+                              'group_name'        : 'name',
+                              'group_type'        : 'type',
+                              'group_class'       : 'class',
+                              'light_ids'         : 'lights',
+                              # These haven't been renamed:
+                              'hue'               : 'hue',
+                              'effect'            : 'effect',
+                              'alert'             : 'alert',
+                              'xy'                : 'xy' }
+
+        # These columns come out of the group's inner "action" object (the last state sent to the whole group):
+        self.actionColumns = ['is_on', 'hue', 'color_mode', 'effect', 'alert', 'xy', 'brightness', 'saturation', 'color_temperature']
+
+        # And these out of its "state" object:
+        self.stateColumns = ['any_on', 'all_on']
+
+        # Rough widths (in bytes) of each column, for the planner.  Anything not listed is a short string.
+        self.columnWidths = { 'group_id'          : 2,
+                              'light_ids'         : 24,
+                              'any_on'            : 1,
+                              'all_on'            : 1,
+                              'is_on'             : 1,
+                              'xy'                : 32,
+                              'hue'               : 4,
+                              'brightness'        : 4,
+                              'saturation'        : 4,
+                              'color_temperature' : 4 }
+
+
+    ############
+    # We need to overload this function so Updates will work
+    @property
+    def rowid_column(self):
+        return self._row_id_column
+
+
+    ############
+    # Query planning:
+    # Tell PostgreSQL about how many rows (and how wide) a scan will produce, so it can plan joins sensibly.
+    # We count whatever we last saw from the bridge rather than asking it again just to plan.
+    def get_rel_size(self, quals, columns):
+
+        if getEqualityValue(quals, 'group_id') is not None:
+            rows = 1
+        else:
+            groups = self.hueBridge.lastSnapshot(self.userName, 'groups')
+            rows = len(groups) if isinstance(groups, dict) else DEFAULT_ESTIMATED_GROUPS
+
+        return (rows, sum([self.columnWidths.get(column, 16) for column in columns]))
+
+
+    ############
+    # A scan with group_id given can be the inner side of a nested loop join, looked up once per outer row.
+    # That is only cheap if the lookups come out of our snapshot (see hueBridge.resource()).  Without a cache each
+    # one would be a round trip to the bridge, so we leave the planner to scan the table once and hash join instead.
+    def get_path_keys(self):
+
+        if self.cacheTTL > 0:
+            return [(('group_id',), 1)]
+
+        return []
+
+
+    ############
+    # EXPLAIN:  what a scan would ask the bridge for, and which quals narrow it.  (see explainScan.py)
+    # In fullstate mode, or with a cache, group_id doesn't narrow the request -- we get the whole datastore (or endpoint) either way.
+    def explain(self, quals, columns, sortkeys=None, verbose=False):
+
+        fullState = self.fetchMode == 'fullstate'
+        groupID = getEqualityValue(quals, 'group_id')
+
+        request = plannedRequest(self.hueBridge, self.userName, 'groups', groupID, self.cacheTTL, fullState)
+        pushed = pushedQuals(quals, None if fullState or self.cacheTTL > 0 else 'group_id')
+
+        return explainScan([(self.bridge, request)], pushed, quals, columns, self.lastScan, verbose)
+
+
+    ############
+    # Work out, once per scan, how to pull each table column out of a group.
+    # Multicorn wants a sequence row to have a value for every column of the table, in table order,
+    # so the columns the query didn't ask for just get None.
+    def compileExtractors(self, columns):
+
+        extractors = []
+
+        for column in self.columns:
+
+            if column not in columns:
+                extractors.append(lambda groupID, group: None)
+
+            elif column == 'group_id':
+                extractors.append(lambda groupID, group: int(groupID))
+
+            # The member lights, as light_ids we can join to the lights table:
+            elif column == 'light_ids':
+                extractors.append(lambda groupID, group: [int(lightID) for lightID in group.get('lights', [])])
+
+            # We are going to flatten out the "action" and "state" inner json.
+            # A group of lights that can't do color has no hue, xy, etc. in its action.
+            elif column in self.actionColumns:
+                extractors.append(lambda groupID, group, key=self.columnKeyMap[column]: group.get('action', {}).get(key))
+
+            elif column in self.stateColumns:
+                extractors.append(lambda groupID, group, key=self.columnKeyMap[column]: group.get('state', {}).get(key))
+
+            # Older bridges don't give groups a class:
+            elif column == 'group_class':
+                extractors.append(lambda groupID, group: group.get('class'))
+
+            else:
+                extractors.append(lambda groupID, group, key=self.columnKeyMap[column]: group[key])
+
+        return tuple(extractors)
+
+
+    ############
+    # SQL SELECT:
+    # We get back all of the groups we can find and roll them up into rows
+    def execute(self, quals, columns):
+
+        log_to_postgres('Hue Groups Query Columns:  %s' % columns, DEBUG)
+        log_to_postgres('Hue Groups Query Filters:  %s' % quals, DEBUG)
+
+        # Work out how to build and test each row once, up front.
+        # An operator we can't handle fails here, before we fetch anything.
+        extractors = self.compileExtractors(columns)
+
+        try:
+            rowMatches = compileQuals(quals, self.columnIndex)
+
+        except unknownOperatorException, e:
+            log_to_postgres(e, ERROR)
+
+        # What this scan costs, for EXPLAIN VERBOSE:
+        scanCost = hueStats.ScanCost('groups', [self.bridge])
+        self.lastScan = scanCost
+
+        # Keep count of the rows we look at and hand back (see hueStats.py):
+        rowMatches = scanCost.countRows(self.bridge, rowMatches)
+
+        # "where group_id = N" only needs /groups/N.  (In fullstate mode the shared datastore GET is the cheaper way to go.)
+        # We still run all of the quals over whatever comes back, so the results are the same either way.
+        groupID = getEqualityValue(quals, 'group_id')
+
+        try:
+
+            if groupID is not None and self.fetchMode != 'fullstate':
+                hueResults = self.hueBridge.resource(self.userName, 'groups', int(groupID), self.cacheTTL)
+            else:
+                hueResults = self.hueBridge.snapshot(self.userName, 'groups', self.cacheTTL, self.fetchMode == 'fullstate')
+
+        except hueBridgeException, e:
+
+            log_to_postgres('%s' % e, ERROR)
+
+        # If the bridge didn't answer and serve_stale is on, we're looking at an old snapshot:
+        for warning in self.hueBridge.takeWarnings():
+            log_to_postgres(warning, WARNING)
+
+        scanCost.update()
+
+        self.scannedGroups.update(hueResults)
+
+        # Actions this transaction is still holding back, so we read our own writes:
+        waiting = self.transactionCommands.pending if self.transactional else {}
+
+        try:
+
+            for groupID, group in hueResults.items():
+
+                if 'groups/%s/action' % groupID in waiting:
+                    group = self.withWaitingAction(group, waiting['groups/%s/action' % groupID].payload)
+
+                # Rows are lists in table column order.
+                row = [extract(groupID, group) for extract in extractors]
+
+                if rowMatches(row):
+
+                    yield row
+
+        finally:
+
+            # Add this scan's rows to the stats (see hueStats.py):
+            scanCost.finish()
+
+
+    ############
+    # SQL UPDATE:
+    # The whole group gets one command, through the bridge's (much smaller) group command budget.
+    def update(self, groupID, newValues):
+
+        log_to_postgres('Hue Groups Update Request - group_id:  %s' % groupID, DEBUG)
+        log_to_postgres('Hue Groups Update Request - new values:  %s' % newValues, DEBUG)
+
+        newAction = {}
+        for changedColumn in newValues.keys():
+
+            # We are only going to be able to change the "action" columns.
+            if changedColumn in self.mutable_columns:
+
+                # 't' and 'f' are only going to show up on the boolean columns
+                # We'll make sure we are in a boolean column anyhow:
+                # (Depending on the Multicorn version, they may already be python booleans.)
+                if changedColumn in ['is_on']:
+
+                    if newValues[changedColumn] in ['t', True]:
+                        newAction[self.columnKeyMap[changedColumn]] = True
+
+                    elif newValues[changedColumn] in ['f', False]:
+                        newAction[self.columnKeyMap[changedColumn]] = False
+
+                # A NULL is an attribute this group doesn't have (eg. hue on a group of white bulbs):
+                elif newValues[changedColumn] is not None:
+
+                    newAction[self.columnKeyMap[changedColumn]] = newValues[changedColumn]
+
+        # Multicorn hands us the whole row, and most of it is the group's last action as the scan saw it.
+        # Sending that again would put every light in the group back to it, so only what the UPDATE actually
+        # changed goes out (and any alert, see changedAction()):
+        newAction = self.changedAction(groupID, newAction)
+
+        if not newAction:
+            log_to_postgres('Hue Groups Update Skipped - group_id %s already has these values' % groupID, DEBUG)
+            return
+
+        # set the transition time to our wrapper global value:
+        newAction['transitiontime'] = self.transitionTime
+
+        log_to_postgres('Hue Groups Update Queued - group_id %s -- %s' % (groupID, json.dumps(newAction)), DEBUG)
+
+        # Remember which lights are in the group, so the lights snapshot can follow along:
+        groups = self.hueBridge.lastSnapshot(self.userName, 'groups') or {}
+        lightIDs = groups.get(str(groupID), {}).get('lights', [])
+
+        command = Command('groups/%s/action' % groupID, newAction, lightIDs, isGroup=True)
+
+        if self.transactional:
+            self.transactionCommands.add(command)
+        else:
+            self.hueBridge.scheduler.submit(self.userName, command, self)
+
+
+    ############
+    # Just the parts of newAction that differ from the group's action.
+    #
+    # We compare with the group as the scan that produced the row saw it (or failing that, our snapshot), plus
+    # anything this transaction is still holding back for it.  If we don't know the group at all, everything goes.
+    # An alert is a one-shot action rather than a state ("select" blinks once), so asking for one is always sent.
+    def changedAction(self, groupID, newAction):
+
+        group = self.scannedGroups.get(str(groupID))
+        if group is None:
+            group = (self.hueBridge.lastSnapshot(self.userName, 'groups') or {}).get(str(groupID))
+        if group is None:
+            return newAction
+
+        address = 'groups/%s/action' % groupID
+        if address in self.transactionCommands.pending:
+            group = self.withWaitingAction(group, self.transactionCommands.pending[address].payload)
+
+        action = group.get('action', {})
+
+        changed = {}
+        for key, value in newAction.items():
+            if (key == 'alert' and value != 'none') or not self.sameValue(key, action.get(key), value):
+                changed[key] = value
+
+        return changed
+
+
+    ############
+    # A copy of a group, with the action we are still waiting to send laid over it.
+    def withWaitingAction(self, group, payload):
+
+        group = dict(group)
+        group['action'] = dict(group.get('action', {}))
+
+        for key, value in payload.items():
+            if key != 'transitiontime':
+                group['action'][key] = value
+
+        return group
+
+
+    ############
+    # Does the group's value for key already match the one we were given?
+    # The bridge only keeps xy to 4 decimal places, and PostgreSQL may hand us numerics as Decimals.
+    def sameValue(self, key, current, value):
+
+        if key == 'xy' and current is not None and value is not None:
+            try:
+                return [round(float(v), 4) for v in current] == [round(float(v), 4) for v in value]
+            except (TypeError, ValueError):
+                return False
+
+        return current == value
+
+
+    ############
+    # End of an INSERT/UPDATE/DELETE statement:
+    # Send the group actions we queued up in update() -- unless we are holding them for the end of the transaction.
+    def end_modify(self):
+
+        if not self.transactional:
+            self.sendCommands()
+
+
+    ############
+    # Transactions:
+    # With "transactional" set, everything the transaction changed goes out just before it commits.
+    # An ERROR here aborts the commit.
+    def pre_commit(self):
+
+        if self.transactional:
+            for command in self.transactionCommands.take():
+                self.hueBridge.scheduler.submit(self.userName, command, self)
+            self.sendCommands()
+
+
+    # An UPDATE that failed part way through may also have left actions with the scheduler.  They mustn't go out
+    # with our next statement.
+    def rollback(self):
+        self.transactionCommands.discard()
+        self.hueBridge.scheduler.discard(self)
+
+
+    def sub_begin(self, level):
+        self.transactionCommands.savepoint()
+
+
+    def sub_commit(self, level):
+        self.transactionCommands.release()
+
+
+    def sub_rollback(self, level):
+        self.transactionCommands.rollbackToSavepoint()
+        self.hueBridge.scheduler.discard(self)
+
+
+    ############
+    # Send whatever the scheduler is holding, and check what the bridge made of it.
+    def sendCommands(self):
+
+        failures = []
+        errors = []
+
+        for command, hueResults, e in self.hueBridge.scheduler.drain(1, self):
+
+            if e is not None:
+
+                # We can't tell what the bridge did with our request, so don't trust our snapshots any more:
+                self.hueBridge.invalidate(self.userName, 'groups')
+                self.hueBridge.invalidate(self.userName, 'lights')
+                failures.append('%s:  %s' % (command, e))
+                continue
+
+            # The bridge answers each attribute separately, so we keep everything that worked and report
+            # everything that didn't together, at the end.
+            for status in hueResults:
+
+                if status.has_key('success'):
+                    self.applyGroupSuccess(command, status['success'])
+
+                else:
+                    self.hueBridge.invalidate(self.userName, 'groups')
+                    self.hueBridge.invalidate(self.userName, 'lights')
+                    errors.append(status.get('error', {'address': '/' + command.address, 'description': '%s' % status}))
+
+        failures.extend(describeErrors(errors))
+
+        if failures:
+
+            log_to_postgres('Hue Groups Full Results: %s' % failures, DEBUG)
+            log_to_postgres('Hue Groups Column Update Failed:  %s' % '; '.join(failures), ERROR)
+
+
+    ############
+    # Keep our snapshots in step with what the bridge says it changed.
+    # "/groups/1/action/on" changes the group's action, and "/lights/<id>/state/on" for every light in the group.
+    # Turning the whole group on or off also settles its any_on and all_on.
+    def applyGroupSuccess(self, command, success):
+
+        self.hueBridge.applySuccess(self.userName, success)
+
+        groupID = command.address.split('/')[1]
+
+        # If we didn't know the group's lights when we queued the command, we can't tell which lights changed:
+        if not command.lightIDs:
+            self.hueBridge.invalidate(self.userName, 'lights')
+
+        for address, value in success.items():
+
+            attribute = address.split('/')[-1]
+
+            for lightID in command.lightIDs:
+                self.hueBridge.applySuccess(self.userName, {'/lights/%s/state/%s' % (lightID, attribute): value})
+
+            if attribute == 'on':
+                self.hueBridge.applySuccess(self.userName, {'/groups/%s/state/any_on' % groupID: value,
+                                                            '/groups/%s/state/all_on' % groupID: value})
+
+
+    ############
+    # SQL INSERT:
+    def insert(self, new_values):
+
+        log_to_postgres('Hue Groups Insert Request Not Yet Implemented - requested values:  %s' % new_values, WARNING)
+
+
+    ############
+    # SQL DELETE
+    def delete(self, old_values):
+
+        log_to_postgres('Hue Groups Delete Request Not Yet Implemented - old values:  %s' % old_values, WARNING)
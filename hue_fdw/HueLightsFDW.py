@@ -5,37 +5,67 @@
 ##   * Lights
 ##   * Config
 ##   * Sensors
+##   * Groups
+##   * Scenes
+##   * Schedules
+##   * Rules
 ## as separate classes since they have very different structures and purposes.
 ##
-## Rules, Scenes, and Groups are not yet implemented.
-## 
 ## Each of these FDW classes is in a different file.
 ## This file has the one for the * Lights * endpoint in it.
 ##
 ## R.Otten - 2015
 ################################################################################################################
 
-from collections import OrderedDict
 import json
 
 from multicorn import ForeignDataWrapper
 from multicorn.utils import log_to_postgres, ERROR, WARNING, DEBUG
 
-import requests
+from operatorFunctions import unknownOperatorException, compileQuals, getEqualityValue, getEqualityValues
+from hueBridge import hueBridgeException, getBridges, DEFAULT_FULLSTATE_TTL_MS
+from commandDispatch import dispatchAsCompleted
+import hueStats
+from explainScan import explainScan, plannedRequest, pushedQuals
+from jsonCache import SerializationCache
+from eventStream import getEventStream
+from updatePlanner import UpdatePlanner
 
-from operatorFunctions import unknownOperatorException, getOperatorFunction
+
+## Our row estimate before we've seen the bridge -- a typical home bridge (it can't hold more than 63 lights):
+DEFAULT_ESTIMATED_LIGHTS = 20
 
 
 ##############################################
 ## The Foreign Data Wrapper Class for Lights:
 ##
 ## Options:
-##  bridge   -- Required:  The IP address for the Hue Bridge
+##  bridge   -- Required:  The IP address for the Hue Bridge.  Or several, separated by commas, for one table
+##              that spans them all.  Their lights are fetched concurrently, and the "bridge" column says which
+##              bridge each light is on.  (With more than one bridge, UPDATE finds lights by unique_id.)
 ##  username -- Required:  The API user name - configured when the bridge is set up 
 ##              (see http://www.developers.meethue.com/documentation/getting-started )
+##              With several bridges, either one name for all of them or a comma separated list in the same order.
 ##  hueid    -- Optional:  The Hue system ID - not used at this time
 ##  kvtype   -- Optional:  json or hstore - Whether nested KV data returns JSON format or HSTORE format. (default:  json)
+##  pool_size, pool_idle_timeout -- Optional:  Connection pool settings for the bridge.  (see hueBridge.py)
+##  max_commands_per_sec, max_group_commands_per_sec -- Optional:  Rate limits for the commands we send the bridge.  (see hueBridge.py)
+##  cache_ttl_ms -- Optional:  Integer - Milliseconds a scan may reuse the last response from the bridge. (default: 0)
+##  fetch_mode   -- Optional:  endpoint or fullstate - Whether a scan GETs just lights, or the whole bridge datastore
+##                  (which refreshes every Hue table's snapshot at once). (default: endpoint)
+##  event_stream -- Optional:  true or false - Keep a live copy of the lights from the bridge's event stream and answer scans
+##                  from it, going back to polling whenever the stream is down.  (see eventStream.py) (default: false)
+##  event_stream_url -- Optional:  Override where the event stream is.  Only for a single bridge.  (default: https://<bridge>/eventstream/clip/v2)
 ##  transitiontime -- Optional: Integer - Number of 100ms the bulb will take to transition during an update. (default: 4)
+##  group_updates  -- Optional: true or false - Whether an UPDATE that gives several lights the same state is sent as one
+##                    group action instead of a PUT per light.  (see updatePlanner.py) (default: true)
+##  min_group_size -- Optional: Integer - How many lights have to share a state before we use a group action. (default: 3)
+##  max_concurrent_commands -- Optional: Integer - How many light commands we send to the bridge at once.
+##                    More than pool_size just means waiting for a connection. (default: 4)
+##  transactional  -- Optional: true or false - Hold the changes back until the transaction commits, instead of sending
+##                    them at the end of each statement.  Later changes to a light are merged into earlier ones, so
+##                    it gets one command at commit, and a rollback sends nothing at all.  Scans in the same transaction
+##                    see the changes that are waiting.  (default: false)
 ##
 class HueLightsFDW(ForeignDataWrapper):
 
@@ -61,7 +91,50 @@ class HueLightsFDW(ForeignDataWrapper):
             self.userName = 'postgreshue'
             log_to_postgres('Using Default Username for Hue Lights setup:  postgreshue.', WARNING)
 
-        self.baseURL = 'http://' + self.bridge + "/api/" + self.userName + "/lights/"
+        # All of the Hue wrappers in this backend share one pooled connection to each bridge.
+        # A list of (HueBridge, username) pairs -- usually just the one:
+        try:
+            self.hueBridges = getBridges(options, self.userName)
+
+        except hueBridgeException, e:
+            log_to_postgres('Invalid bridge setup for Hue Lights: %s' % e, ERROR)
+
+        # Either GET just our own endpoint, or the whole datastore so the other Hue tables can share the response:
+        if options.has_key('fetch_mode'):
+            if options['fetch_mode'].lower() in ['endpoint', 'fullstate']:
+                self.fetchMode = options['fetch_mode'].lower()
+            else:
+                log_to_postgres('Invalid Fetch Mode for Hue Lights setup: %s. (Choose "endpoint" or "fullstate")' % options['fetch_mode'], ERROR)
+        else:
+            self.fetchMode = 'endpoint'
+
+        # Scans within this many seconds of the last one are answered from the bridge snapshot:
+        if options.has_key('cache_ttl_ms'):
+            self.cacheTTL = float(options['cache_ttl_ms']) / 1000
+        elif self.fetchMode == 'fullstate':
+            self.cacheTTL = float(DEFAULT_FULLSTATE_TTL_MS) / 1000
+        else:
+            self.cacheTTL = 0
+
+        # Have the bridge tell us about changes instead of asking it on every scan:
+        if options.has_key('event_stream'):
+            if options['event_stream'].lower() in ['true', 'false']:
+                useEventStream = options['event_stream'].lower() == 'true'
+            else:
+                log_to_postgres('Invalid Event Stream setting for Hue Lights setup: %s. (Choose "true" or "false")' % options['event_stream'], ERROR)
+        else:
+            useEventStream = False
+
+        if useEventStream and len(self.hueBridges) > 1 and options.has_key('event_stream_url'):
+            log_to_postgres('event_stream_url can only be used with a single bridge in Hue Lights setup.', ERROR)
+
+        # bridge address -> its event stream (or None)
+        self.eventStreams = {}
+        for hueBridge, userName in self.hueBridges:
+            if useEventStream:
+                self.eventStreams[hueBridge.bridge] = getEventStream(hueBridge, userName, options)
+            else:
+                self.eventStreams[hueBridge.bridge] = None
 
         # We don't really use this anywhere.  Including it for now in case it ends up having a use.
         if options.has_key('hueid'):
@@ -80,6 +153,12 @@ class HueLightsFDW(ForeignDataWrapper):
         else:
             self.kvType = 'json'
 
+        # The nested objects hardly ever change, so we keep the json we made for them last time:
+        self.jsonCache = SerializationCache()
+
+        # What the last scan cost, for EXPLAIN VERBOSE (see explainScan.py):
+        self.lastScan = None
+
         # For now this is a global FDW setting.
         # It isn't a queryable data element on the lights endpoint, but rather an update option.
         # Since we can't really pass options in an update statement (that aren't columns), we'll set the
@@ -91,13 +170,61 @@ class HueLightsFDW(ForeignDataWrapper):
             # We'll use that for our default here too.
             self.transitionTime = 4 
 
+        # Collapse lights that are getting the same new state into one group action:
+        if options.has_key('group_updates'):
+            if options['group_updates'].lower() in ['true', 'false']:
+                groupUpdates = options['group_updates'].lower() == 'true'
+            else:
+                log_to_postgres('Invalid Group Updates setting for Hue Lights setup: %s. (Choose "true" or "false")' % options['group_updates'], ERROR)
+        else:
+            groupUpdates = True
+
+        if options.has_key('min_group_size'):
+            minGroupSize = int(options['min_group_size'])
+        else:
+            minGroupSize = 3
+
+        # Commands that can't be collapsed into a group are sent concurrently:
+        if options.has_key('max_concurrent_commands'):
+            maxConcurrentCommands = int(options['max_concurrent_commands'])
+        else:
+            maxConcurrentCommands = 4
+
+        # Send our changes at the end of each statement, or hold them until the transaction commits:
+        if options.has_key('transactional'):
+            if options['transactional'].lower() in ['true', 'false']:
+                self.transactional = options['transactional'].lower() == 'true'
+            else:
+                log_to_postgres('Invalid Transactional setting for Hue Lights setup: %s. (Choose "true" or "false")' % options['transactional'], ERROR)
+        else:
+            self.transactional = False
+
+        # The lights as our scans last saw them (see changedState()), by bridge address:
+        self.scannedLights = dict([(hueBridge.bridge, {}) for hueBridge, userName in self.hueBridges])
+
+        # The rows of an UPDATE are collected here and sent to the bridge when the statement (or transaction) is done with us.
+        # Each bridge gets its own planner (and so its own groups and rate limits):
+        self.updatePlanners = dict([(hueBridge.bridge, UpdatePlanner(hueBridge, userName, groupUpdates, minGroupSize, maxConcurrentCommands))
+                                    for hueBridge, userName in self.hueBridges])
+
         ###
-        # We need to identify the "primary key" column so we can do updates:
-        self._row_id_column = 'light_id'
+        # We need to identify the "primary key" column so we can do updates.
+        # light_id is only unique on one bridge.  Across several we use unique_id, and the scans remember
+        # which bridge and light_id each one belongs to:
+        if len(self.hueBridges) > 1:
+            self._row_id_column = 'unique_id'
+        else:
+            self._row_id_column = 'light_id'
+
+        # unique_id -> (bridge address, light_id)
+        self.scannedRowIDs = {}
 
         # The columns we'll be using (defaults to 'all'):
         self.columns = columns
 
+        # Where each column sits in the rows we hand back:
+        self.columnIndex = dict([(column, i) for i, column in enumerate(columns)])
+
         # These are the only columns we are going to allow to be updated though:
         self.mutable_columns = ['is_on', 
                                 'hue', 
@@ -128,7 +255,130 @@ class HueLightsFDW(ForeignDataWrapper):
                               'reachable'         : 'reachable',
                               'pointsymbol'       : 'pointsymbol' }
 
+        # These columns come out of the light's inner "state" object:
+        self.stateColumns = ['is_on', 'hue', 'color_mode', 'effect', 'alert', 'xy', 'reachable', 'brightness', 'saturation', 'color_temperature']
+
+        # Rough widths (in bytes) of each column, for the planner.  Anything not listed is a short string.
+        self.columnWidths = { 'light_id'          : 2,
+                              'reachable'         : 1,
+                              'is_on'             : 1,
+                              'xy'                : 32,
+                              'hue'               : 4,
+                              'brightness'        : 4,
+                              'saturation'        : 4,
+                              'color_temperature' : 4,
+                              'pointsymbol'       : 120 }
+
+
+    ############
+    # Query planning:
+    # Tell PostgreSQL about how many rows (and how wide) a scan will produce, so it can plan joins sensibly.
+    # We count whatever we last saw from the bridge rather than asking it again just to plan.
+    def get_rel_size(self, quals, columns):
+
+        hueBridges = self.scanBridges(quals)
+
+        if getEqualityValue(quals, 'light_id') is not None:
+            rows = len(hueBridges)
+        else:
+            rows = 0
+            for hueBridge, userName in hueBridges:
+                lights = hueBridge.lastSnapshot(userName, 'lights')
+                if lights is None:
+                    rows += DEFAULT_ESTIMATED_LIGHTS
+                else:
+                    rows += len(lights)
+
+        return (rows, sum([self.columnWidths.get(column, 16) for column in columns]))
+
+
+    ############
+    # A scan with light_id given can be the inner side of a nested loop join, looked up once per outer row.
+    # That is only cheap if the lookups come out of our snapshot (see hueBridge.resource()) or a live event stream.
+    # Otherwise each one would be a round trip to the bridge, so we leave the planner to scan the table once and
+    # hash join instead.
+    def get_path_keys(self):
+
+        eventStreams = self.eventStreams.values()
+        if self.cacheTTL <= 0 and (None in eventStreams or not all([eventStream.live for eventStream in eventStreams])):
+            return []
+
+        if len(self.hueBridges) > 1:
+            return [(('light_id',), len(self.hueBridges)), (('bridge', 'light_id'), 1)]
+
+        return [(('light_id',), 1)]
+
+
+    ############
+    # EXPLAIN:  what a scan would ask each bridge for, and which quals narrow it.  (see explainScan.py)
+    # In fullstate mode, or with a cache, light_id doesn't narrow the request -- we get the whole datastore (or endpoint) either way.
+    def explain(self, quals, columns, sortkeys=None, verbose=False):
+
+        fullState = self.fetchMode == 'fullstate'
+        lightID = getEqualityValue(quals, 'light_id')
+
+        requests = []
+        for hueBridge, userName in self.scanBridges(quals):
+            requests.append((hueBridge.bridge, plannedRequest(hueBridge, userName, 'lights', lightID, self.cacheTTL, fullState,
+                                                               self.eventStreams[hueBridge.bridge])))
+
+        pushed = pushedQuals(quals, None if fullState or self.cacheTTL > 0 else 'light_id')
+
+        return explainScan(requests, pushed, quals, columns, self.lastScan, verbose)
+
+
+    ############
+    # The bridges a scan has to ask.  "where bridge = ..." (or "bridge in (...)") leaves the others out.
+    def scanBridges(self, quals):
+
+        wanted = getEqualityValues(quals, 'bridge')
+
+        if wanted is None:
+            return self.hueBridges
+
+        return [(hueBridge, userName) for hueBridge, userName in self.hueBridges if hueBridge.bridge in wanted]
+
+
+    ############
+    # Work out, once per scan, how to pull each table column out of a light.
+    # Multicorn wants a sequence row to have a value for every column of the table, in table order,
+    # so the columns the query didn't ask for just get None.
+    # With several bridges we compile a set for each of them.
+    def compileExtractors(self, columns, bridge):
+
+        extractors = []
+
+        for column in self.columns:
+
+            if column not in columns:
+                extractors.append(lambda lightID, light: None)
+
+            elif column == 'light_id':
+                extractors.append(lambda lightID, light: int(lightID))
+
+            elif column == 'bridge':
+                extractors.append(lambda lightID, light: bridge)
+
+            # We are going to flatten out the "state" inner json.
+            elif column in self.stateColumns:
+                extractors.append(lambda lightID, light, key=self.columnKeyMap[column]: light['state'][key])
+
+            # Pointsymbol isn't used by the API yet.  We'll save it as is for now.
+            elif column == 'pointsymbol':
+                # HSTORE Column Type:
+                if self.kvType == 'hstore':
+                    extractors.append(lambda lightID, light: light['pointsymbol'])
+                # JSON Column Type:
+                else:
+                    extractors.append(lambda lightID, light: self.jsonCache.dumps(('pointsymbol', bridge, lightID), light['pointsymbol']))
+
+            else:
+                extractors.append(lambda lightID, light, key=self.columnKeyMap[column]: light[key])
+
+        return tuple(extractors)
 
+
+    ############
     # SQL SELECT:
     # We get back all of the lights we can find and roll them up into rows
     def execute(self, quals, columns):
@@ -136,78 +386,120 @@ class HueLightsFDW(ForeignDataWrapper):
         log_to_postgres('Hue Lights Query Columns:  %s' % columns, DEBUG)
         log_to_postgres('Hue Lights Query Filters:  %s' % quals, DEBUG)
 
-        # Question:  Is this really capped at 15 results per GET, or will it return everything?
-        # ie, do we need to loop this until we exhaust all of the lights in the system, or is one GET enough?
-        # we don't have enough lights to test it
-        results = requests.get(self.baseURL)
+        # Work out how to test each row once, up front.
+        # An operator we can't handle fails here, before we fetch anything.
+        try:
+            rowMatches = compileQuals(quals, self.columnIndex)
+
+        except unknownOperatorException, e:
+            log_to_postgres(e, ERROR)
+
+        # "where light_id = N" only needs /lights/N.  (In fullstate mode the shared datastore GET is the cheaper way to go.)
+        # We still run all of the quals over whatever comes back, so the results are the same either way.
+        lightID = getEqualityValue(quals, 'light_id')
+
+        hueBridges = self.scanBridges(quals)
+
+        # What this scan costs, for EXPLAIN VERBOSE:
+        scanCost = hueStats.ScanCost('lights', [hueBridge.bridge for hueBridge, userName in hueBridges])
+        self.lastScan = scanCost
+
+        # Every bridge is asked at once, and each one's rows go out as soon as its lights arrive.
+        fetch = lambda (hueBridge, userName): self.fetchLights(hueBridge, userName, lightID)
 
         try:
 
-            hueResults = json.loads(results.text)
+            for (hueBridge, userName), hueResults, e in dispatchAsCompleted(fetch, hueBridges, len(hueBridges)):
 
-        except:
+                if isinstance(e, hueBridgeException):
+                    log_to_postgres('%s' % e, ERROR)
+                elif e is not None:
+                    raise e
 
-            log_to_postgres('Unexpected (non-JSON) response from the Hue Bridge: %s' % self.bridge, ERROR)
-            log_to_postgres('%s' % e, ERROR)
-            log_to_postgres('%s' % results, ERROR)
-         
-        for light in hueResults.keys():
+                # If the bridge didn't answer and serve_stale is on, we're looking at an old snapshot:
+                for warning in hueBridge.takeWarnings():
+                    log_to_postgres(warning, WARNING)
 
-            # We are using an ordered dict so we preserve the column ordering.
-            row = OrderedDict()
+                # If the event stream is down we've just polled instead.  Say why it is down:
+                eventStream = self.eventStreams[hueBridge.bridge]
+                if eventStream is not None and not eventStream.live and eventStream.lastError is not None:
+                    log_to_postgres('Hue Lights event stream from the bridge %s is down, so we are polling: %s' % (hueBridge.bridge, eventStream.lastError), WARNING)
 
-            # add the requested columns to the output:
-            for column in columns:
+                scanCost.update()
 
-                if column == 'light_id':
-                    row['light_id'] = int(light)
-                    continue
+                bridge = hueBridge.bridge
+                extractors = self.compileExtractors(columns, bridge)
 
-                # We are going to flatten out the "state" inner json.
-                if column in ['is_on', 'hue', 'color_mode', 'effect', 'alert', 'xy', 'reachable', 'brightness', 'saturation', 'color_temperature']:
-                    row[column] = hueResults[light]['state'][self.columnKeyMap[column]]
-                    continue
+                # Keep count of the rows we look at and hand back (see hueStats.py):
+                bridgeRowMatches = scanCost.countRows(bridge, rowMatches)
 
-                # Pointsymbol isn't used by the API yet.  We'll save it as is for now.
-                if column == 'pointsymbol':
-                    # HSTORE Column Type:
-                    if self.kvType == 'hstore':
-                        row['pointsymbol'] = hueResults[light]['pointsymbol']
-                    # JSON Column Type:
-                    else:  
-                        row['pointsymbol'] = json.dumps(hueResults[light]['pointsymbol'])
-                    continue
+                # update() compares each row with the light as we saw it here:
+                self.scannedLights[bridge].update(hueResults)
 
-                # else:
-                row[column] = hueResults[light][self.columnKeyMap[column]]
+                # Changes this transaction is still holding back, so we read our own writes:
+                waiting = self.updatePlanners[bridge].pending if self.transactional else {}
 
+                for lightID, light in hueResults.items():
 
-            # Unfortunately the Hue API doesn't have much in the way of filtering when you request the data.
-            # So we do it here.
-            # We can't have more than 63 lights in one system, and we only have 15 columns to worry about.
-            goodRow = True
-            for qual in quals:
+                    # So an UPDATE by unique_id can find its way back to this light:
+                    if len(self.hueBridges) > 1 and light.get('uniqueid') is not None:
+                        self.scannedRowIDs[light['uniqueid']] = (bridge, lightID)
 
-                try:
-                    operatorFunction = getOperatorFunction(qual.operator)
+                    if lightID in waiting:
+                        light = self.withWaitingState(light, waiting[lightID])
 
-                except unknownOperatorException, e:
-                    log_to_postgres(e, ERROR)
+                    # Rows are lists in table column order.
+                    row = [extract(lightID, light) for extract in extractors]
 
-                # The SQL parser should have caught if the where clause referenced a column we aren't selecting.
-                # If it didn't, we'll just let this next statement throw an exception (rather than trying to handle it).
-                if not operatorFunction(row[qual.field_name], qual.value):
+                    # Unfortunately the Hue API doesn't have much in the way of filtering when you request the data.
+                    # So we do it here.
+                    # We can't have more than 63 lights in one system, and we only have 15 columns to worry about.
+                    if bridgeRowMatches(row):
 
-                    # this column  didn't match.  Drop out and then move to the next row
-                    goodRow = False
-                    break
+                        yield row
 
-            if goodRow:
+                     # otherwise, loop around and try the next row
 
-                yield row
- 
-             # otherwise, loop around and try the next row
+        finally:
 
+            # Add this scan's rows to the stats (see hueStats.py):
+            scanCost.finish()
+
+
+    ############
+    # One bridge's lights for a scan.
+    # With several bridges this runs on a dispatch worker thread (see commandDispatch.py), so it mustn't log anything.
+    def fetchLights(self, hueBridge, userName, lightID):
+
+        eventStream = self.eventStreams[hueBridge.bridge]
+
+        # Question:  Is this really capped at 15 results per GET, or will it return everything?
+        # ie, do we need to loop this until we exhaust all of the lights in the system, or is one GET enough?
+        # we don't have enough lights to test it
+
+        # While the event stream is up our copy is already current:
+        if eventStream is not None and eventStream.live:
+            return eventStream.current('lights', lightID)
+
+        if lightID is not None and self.fetchMode != 'fullstate':
+            return hueBridge.resource(userName, 'lights', int(lightID), self.cacheTTL)
+
+        return hueBridge.snapshot(userName, 'lights', self.cacheTTL, self.fetchMode == 'fullstate')
+
+
+
+    ############
+    # A copy of a light, with the state changes we are still waiting to send laid over it.
+    def withWaitingState(self, light, payload):
+
+        light = dict(light)
+        light['state'] = dict(light['state'])
+
+        for key, value in payload.items():
+            if key in light['state']:
+                light['state'][key] = value
+
+        return light
 
 
     ############
@@ -220,12 +512,20 @@ class HueLightsFDW(ForeignDataWrapper):
     ############
     ############
     # SQL UPDATE:
-    ## -- we should consider implementing 'rollback' (and, necessarily, 'commit')
-    def update(self, lightID, newValues):
+    # (see the "transactional" option for holding updates until commit)
+    def update(self, rowID, newValues):
 
-        log_to_postgres('Hue Lights Update Request - lightID:  %s' % lightID, DEBUG)
+        log_to_postgres('Hue Lights Update Request - %s:  %s' % (self._row_id_column, rowID), DEBUG)
         log_to_postgres('Hue Lights Update Request - new values:  %s' % newValues, DEBUG)
 
+        # Which bridge's light is this?
+        if len(self.hueBridges) > 1:
+            if rowID not in self.scannedRowIDs:
+                log_to_postgres('Hue Lights Update Failed - unique_id %s is not a light on any of our bridges' % rowID, ERROR)
+            bridge, lightID = self.scannedRowIDs[rowID]
+        else:
+            bridge, lightID = self.hueBridges[0][0].bridge, rowID
+
         newState = {}
         for changedColumn in newValues.keys():
 
@@ -234,12 +534,13 @@ class HueLightsFDW(ForeignDataWrapper):
 
                 # 't' and 'f' are only going to show up on the boolean columns
                 # We'll make sure we are in a boolean column anyhow:
+                # (Depending on the Multicorn version, they may already be python booleans.)
                 if changedColumn in ['is_on']:
 
-                    if newValues[changedColumn] == 't':
+                    if newValues[changedColumn] in ['t', True]:
                         newState[self.columnKeyMap[changedColumn]] = True
 
-                    elif newValues[changedColumn] == 'f':  
+                    elif newValues[changedColumn] in ['f', False]:
                         newState[self.columnKeyMap[changedColumn]] = False
 
                 # If this is any other type of column, try to set it to whatever we got:
@@ -247,31 +548,126 @@ class HueLightsFDW(ForeignDataWrapper):
 
                     newState[self.columnKeyMap[changedColumn]] = newValues[changedColumn]
 
+        # Most of a bulk update is usually values the light already has.  Leave those out:
+        newState = self.changedState(bridge, lightID, newState)
+
+        if not newState:
+            log_to_postgres('Hue Lights Update Skipped - light_id %s already has these values' % lightID, DEBUG)
+            return
+
         # set the transition time to our wrapper global value:
         newState['transitiontime'] = self.transitionTime
 
-        log_to_postgres(self.baseURL + '%s/state' % lightID + ' -- ' + json.dumps(newState), DEBUG)
+        log_to_postgres('Hue Lights Update Queued - light_id %s -- %s' % (lightID, json.dumps(newState)), DEBUG)
+
+        # We don't send anything yet.  Once we've seen every row we'll know which lights can share a command.
+        self.updatePlanners[bridge].add(lightID, newState)
+
+
+    ############
+    # Just the parts of newState that would change the light.
+    #
+    # We compare with the light as the scan that produced the row saw it (or failing that, our snapshot), plus
+    # anything this transaction is still holding back for it.  If we don't know the light at all, everything goes.
+    # An alert is a one-shot action rather than a state ("select" blinks once), so asking for one is always sent.
+    def changedState(self, bridge, lightID, newState):
+
+        lightID = str(lightID)
+        updatePlanner = self.updatePlanners[bridge]
+
+        light = self.scannedLights[bridge].get(lightID)
+        if light is None:
+            light = (updatePlanner.hueBridge.lastSnapshot(updatePlanner.userName, 'lights') or {}).get(lightID)
+        if light is None:
+            return newState
+
+        if lightID in updatePlanner.pending:
+            light = self.withWaitingState(light, updatePlanner.pending[lightID])
+
+        state = light.get('state', {})
+
+        changed = {}
+        for key, value in newState.items():
+            if (key == 'alert' and value != 'none') or not self.sameValue(key, state.get(key), value):
+                changed[key] = value
+
+        return changed
+
+
+    ############
+    # Does the light's value for key already match the one we were given?
+    # The bridge only keeps xy to 4 decimal places, and PostgreSQL may hand us numerics as Decimals.
+    def sameValue(self, key, current, value):
+
+        if key == 'xy' and current is not None and value is not None:
+            try:
+                return [round(float(v), 4) for v in current] == [round(float(v), 4) for v in value]
+            except (TypeError, ValueError):
+                return False
+
+        return current == value
+
+
+    ############
+    # End of an INSERT/UPDATE/DELETE statement:
+    # Send the state changes we collected in update() -- unless we are holding them for the end of the transaction.
+    def end_modify(self):
+
+        if not self.transactional:
+            self.sendUpdates()
+
+
+    ############
+    # Plan and send whatever the planners are holding.
+    def sendUpdates(self):
+
+        failures = []
+        for hueBridge, userName in self.hueBridges:
+
+            for failure in self.updatePlanners[hueBridge.bridge].flush():
+                if len(self.hueBridges) > 1:
+                    failure = '%s %s' % (hueBridge.bridge, failure)
+                failures.append(failure)
+
+            # eg. a temporary group we couldn't clean up:
+            for warning in self.updatePlanners[hueBridge.bridge].takeWarnings():
+                log_to_postgres(warning, WARNING)
+
+        if failures:
+
+            log_to_postgres('Hue Lights Full Results: %s' % failures, DEBUG)
+            log_to_postgres('Hue Lights Column Update Failed:  %s' % '; '.join(failures), ERROR)
+
+
+    ############
+    # Transactions:
+    # With "transactional" set, everything the transaction changed goes out just before it commits.
+    # An ERROR here aborts the commit.
+    def pre_commit(self):
+
+        if self.transactional:
+            self.sendUpdates()
+
+
+    def rollback(self):
+        for updatePlanner in self.updatePlanners.values():
+            updatePlanner.discard()
 
-        results = requests.put(self.baseURL + '%s/state' % lightID, json.dumps(newState))
-        
-        try:
 
-            hueResults = json.loads(results.text)
+    def sub_begin(self, level):
+        for updatePlanner in self.updatePlanners.values():
+            updatePlanner.savepoint()
 
-        except Exception, e:
 
-            log_to_postgres('Unexpected (non-JSON) response from the Hue Bridge: %s' % self.bridge, ERROR)
-            log_to_postgres('%s' % e, ERROR)
-            log_to_postgres('%s' % results, ERROR)
-    
+    def sub_commit(self, level):
+        for updatePlanner in self.updatePlanners.values():
+            updatePlanner.release()
 
-        for status in hueResults:
 
-              if not status.has_key('success'):
+    def sub_rollback(self, level):
+        for updatePlanner in self.updatePlanners.values():
+            updatePlanner.rollbackToSavepoint()
 
-                    log_to_postgres('Hue Lights Full Results: %s' % results.text, DEBUG)
-                    log_to_postgres('Hue Lights Column Update Failed for light_id %s:  %s' % (lightID, status), ERROR)
-            
 
     ############
     # SQL INSERT:
@@ -0,0 +1,468 @@
+################################################################################################################
+## This is the implementation of the Multicorn ForeignDataWrapper class as an interface to the Philips Hue system
+##
+## We set up these endpoints:
+##   * Lights
+##   * Config
+##   * Sensors
+##   * Groups
+##   * Scenes
+##   * Schedules
+##   * Rules
+## as separate classes since they have very different structures and purposes.
+##
+## Each of these FDW classes is in a different file.
+## This file has the one for the * Rules * endpoint in it.
+##
+################################################################################################################
+
+import json
+
+from multicorn import ForeignDataWrapper
+from multicorn.utils import log_to_postgres, ERROR, WARNING, DEBUG
+
+from operatorFunctions import unknownOperatorException, compileQuals, getEqualityValue
+from hueBridge import hueBridgeException, getBridge, DEFAULT_FULLSTATE_TTL_MS
+from jsonCache import SerializationCache
+from commandScheduler import Command
+from sensorTypes import noneToNull
+from hue_errors import describeErrors
+import hueStats
+from explainScan import explainScan, plannedRequest, pushedQuals
+
+
+## Our row estimate before we've seen the bridge.  (Each Hue dimmer switch or motion sensor comes with several rules.)
+DEFAULT_ESTIMATED_RULES = 20
+
+
+##############################################
+## The Foreign Data Wrapper Class for Rules:
+##
+## Options:
+##  bridge   -- Required:  The IP address for the Hue Bridge
+##  username -- Required:  The API user name - configured when the bridge is set up
+##              (see http://www.developers.meethue.com/documentation/getting-started )
+##  pool_size, pool_idle_timeout -- Optional:  Connection pool settings for the bridge.  (see hueBridge.py)
+##  max_commands_per_sec -- Optional:  Rate limit for the commands we send the bridge.  (see hueBridge.py)
+##  cache_ttl_ms -- Optional:  Integer - Milliseconds a scan may reuse the last response from the bridge. (default: 0)
+##  fetch_mode   -- Optional:  endpoint or fullstate - Whether a scan GETs just rules, or the whole bridge datastore
+##                  (which refreshes every Hue table's snapshot at once). (default: endpoint)
+##
+## A rule is the bridge reacting to a sensor by itself:  when all of its conditions hold, it carries out its actions.
+## That takes the database (and its polling) out of the path between a sensor and the lights.
+##   * conditions is a json list like [{"address": "/sensors/2/state/presence", "operator": "eq", "value": "true"}]
+##   * actions is a json list like [{"address": "/groups/0/action", "method": "PUT", "body": {"on": true}}]
+##     (addresses are relative to /api/<username>; we add a missing leading "/")
+##     (see http://www.developers.meethue.com/documentation/rules-api-0 )
+##   * Both are always json, whatever kvtype the other tables use -- hstore can't hold a list.
+##
+## INSERT creates the rule right away (so "returning rule_id" works), UPDATE changes it, and DELETE removes it.
+## If the bridge won't take a rule -- it is full (601), or the conditions (607) or actions (608) are wrong, or it
+## can't be enabled (609) -- the statement fails with the bridge's explanation.
+##
+class HueRulesFDW(ForeignDataWrapper):
+
+    """
+    Philips Hue Rules Foreign Data Wrapper for PostgreSQL
+    """
+
+    def __init__(self, options, columns):
+
+        super(HueRulesFDW, self).__init__(options, columns)
+
+        log_to_postgres('Hue Rules options:  %s' % options, DEBUG)
+        log_to_postgres('Hue Rules columns:  %s' % columns, DEBUG)
+
+        if options.has_key('bridge'):
+            self.bridge = options['bridge']
+        else:
+            log_to_postgres('bridge IP address is required for Hue Rules setup.', ERROR)
+
+        if options.has_key('username'):
+            self.userName = options['username']
+        else:
+            self.userName = 'postgreshue'
+            log_to_postgres('Using Default Username for Hue Rules setup:  postgreshue.', WARNING)
+
+        # All of the Hue wrappers in this backend share one pooled connection to each bridge:
+        self.hueBridge = getBridge(self.bridge, options)
+
+        # Either GET just our own endpoint, or the whole datastore so the other Hue tables can share the response:
+        if options.has_key('fetch_mode'):
+            if options['fetch_mode'].lower() in ['endpoint', 'fullstate']:
+                self.fetchMode = options['fetch_mode'].lower()
+            else:
+                log_to_postgres('Invalid Fetch Mode for Hue Rules setup: %s. (Choose "endpoint" or "fullstate")' % options['fetch_mode'], ERROR)
+        else:
+            self.fetchMode = 'endpoint'
+
+        # Scans within this many seconds of the last one are answered from the bridge snapshot:
+        if options.has_key('cache_ttl_ms'):
+            self.cacheTTL = float(options['cache_ttl_ms']) / 1000
+        elif self.fetchMode == 'fullstate':
+            self.cacheTTL = float(DEFAULT_FULLSTATE_TTL_MS) / 1000
+        else:
+            self.cacheTTL = 0
+
+        # The nested objects hardly ever change, so we keep the json we made for them last time:
+        self.jsonCache = SerializationCache()
+
+        # What the last scan cost, for EXPLAIN VERBOSE (see explainScan.py):
+        self.lastScan = None
+
+        ###
+        # We need to identify the "primary key" column so we can do updates:
+        self._row_id_column = 'rule_id'
+
+        # The columns we'll be using (defaults to 'all'):
+        self.columns = columns
+
+        # Where each column sits in the rows we hand back:
+        self.columnIndex = dict([(column, i) for i, column in enumerate(columns)])
+
+        # These are the only columns we are going to allow to be updated:
+        self.mutable_columns = ['rule_name', 'status', 'conditions', 'actions']
+
+        # We renamed some of the columns to avoid reserved PG keywords, and made some of them more verbose.
+        self.columnKeyMap = { 'rule_name'       : 'name',
+                              'last_triggered'  : 'lasttriggered',
+                              'times_triggered' : 'timestriggered',
+                              # These haven't been renamed:
+                              'owner'           : 'owner',
+                              'created'         : 'created',
+                              'status'          : 'status',
+                              'conditions'      : 'conditions',
+                              'actions'         : 'actions' }
+
+        # Rough widths (in bytes) of each column, for the planner.  Anything not listed is a short string.
+        self.columnWidths = { 'rule_id'         : 2,
+                              'created'         : 8,
+                              'last_triggered'  : 8,
+                              'times_triggered' : 4,
+                              'conditions'      : 150,
+                              'actions'         : 100 }
+
+        # The rules our last scan saw, to tell what an UPDATE actually changed:
+        self.scannedRules = {}
+
+
+    ############
+    # We need to overload this function so Updates will work
+    @property
+    def rowid_column(self):
+        return self._row_id_column
+
+
+    ############
+    # Query planning:
+    # Tell PostgreSQL about how many rows (and how wide) a scan will produce, so it can plan joins sensibly.
+    # We count whatever we last saw from the bridge rather than asking it again just to plan.
+    def get_rel_size(self, quals, columns):
+
+        if getEqualityValue(quals, 'rule_id') is not None:
+            rows = 1
+        else:
+            rules = self.hueBridge.lastSnapshot(self.userName, 'rules')
+            rows = len(rules) if isinstance(rules, dict) else DEFAULT_ESTIMATED_RULES
+
+        return (rows, sum([self.columnWidths.get(column, 16) for column in columns]))
+
+
+    ############
+    # A scan with rule_id given can be the inner side of a nested loop join, looked up once per outer row.
+    # That is only cheap if the lookups come out of our snapshot (see hueBridge.resource()).  Without a cache each
+    # one would be a round trip to the bridge, so we leave the planner to scan the table once and hash join instead.
+    def get_path_keys(self):
+
+        if self.cacheTTL > 0:
+            return [(('rule_id',), 1)]
+
+        return []
+
+
+    ############
+    # EXPLAIN:  what a scan would ask the bridge for, and which quals narrow it.  (see explainScan.py)
+    # In fullstate mode, or with a cache, rule_id doesn't narrow the request -- we get the whole datastore (or endpoint) either way.
+    def explain(self, quals, columns, sortkeys=None, verbose=False):
+
+        fullState = self.fetchMode == 'fullstate'
+        ruleID = getEqualityValue(quals, 'rule_id')
+
+        request = plannedRequest(self.hueBridge, self.userName, 'rules', ruleID, self.cacheTTL, fullState)
+        pushed = pushedQuals(quals, None if fullState or self.cacheTTL > 0 else 'rule_id')
+
+        return explainScan([(self.bridge, request)], pushed, quals, columns, self.lastScan, verbose)
+
+
+    ############
+    # Work out, once per scan, how to pull each table column out of a rule.
+    # Multicorn wants a sequence row to have a value for every column of the table, in table order,
+    # so the columns the query didn't ask for just get None.
+    def compileExtractors(self, columns):
+
+        extractors = []
+
+        for column in self.columns:
+
+            if column not in columns:
+                extractors.append(lambda ruleID, rule: None)
+
+            elif column == 'rule_id':
+                extractors.append(lambda ruleID, rule: int(ruleID))
+
+            elif column in ['conditions', 'actions']:
+                extractors.append(lambda ruleID, rule, key=self.columnKeyMap[column]: self.jsonCache.dumps((key, ruleID), rule.get(key, [])))
+
+            # The bridge says "none" for a rule that hasn't been triggered yet:
+            elif column in ['created', 'last_triggered']:
+                extractors.append(lambda ruleID, rule, key=self.columnKeyMap[column]: noneToNull(rule.get(key)))
+
+            else:
+                extractors.append(lambda ruleID, rule, key=self.columnKeyMap[column]: rule.get(key))
+
+        return tuple(extractors)
+
+
+    ############
+    # SQL SELECT:
+    # We get back all of the rules we can find and roll them up into rows
+    def execute(self, quals, columns):
+
+        log_to_postgres('Hue Rules Query Columns:  %s' % columns, DEBUG)
+        log_to_postgres('Hue Rules Query Filters:  %s' % quals, DEBUG)
+
+        # Work out how to build and test each row once, up front.
+        # An operator we can't handle fails here, before we fetch anything.
+        extractors = self.compileExtractors(columns)
+
+        try:
+            rowMatches = compileQuals(quals, self.columnIndex)
+
+        except unknownOperatorException, e:
+            log_to_postgres(e, ERROR)
+
+        # What this scan costs, for EXPLAIN VERBOSE:
+        scanCost = hueStats.ScanCost('rules', [self.bridge])
+        self.lastScan = scanCost
+
+        # Keep count of the rows we look at and hand back (see hueStats.py):
+        rowMatches = scanCost.countRows(self.bridge, rowMatches)
+
+        # "where rule_id = N" only needs /rules/N.  (In fullstate mode the shared datastore GET is the cheaper way to go.)
+        # We still run all of the quals over whatever comes back, so the results are the same either way.
+        ruleID = getEqualityValue(quals, 'rule_id')
+
+        try:
+
+            if ruleID is not None and self.fetchMode != 'fullstate':
+                hueResults = self.hueBridge.resource(self.userName, 'rules', int(ruleID), self.cacheTTL)
+            else:
+                hueResults = self.hueBridge.snapshot(self.userName, 'rules', self.cacheTTL, self.fetchMode == 'fullstate')
+
+        except hueBridgeException, e:
+
+            log_to_postgres('%s' % e, ERROR)
+
+        # If the bridge didn't answer and serve_stale is on, we're looking at an old snapshot:
+        for warning in self.hueBridge.takeWarnings():
+            log_to_postgres(warning, WARNING)
+
+        scanCost.update()
+
+        self.scannedRules.update(hueResults)
+
+        try:
+
+            for ruleID, rule in hueResults.items():
+
+                # Rows are lists in table column order.
+                row = [extract(ruleID, rule) for extract in extractors]
+
+                if rowMatches(row):
+
+                    yield row
+
+        finally:
+
+            # Add this scan's rows to the stats (see hueStats.py):
+            scanCost.finish()
+
+
+    ############
+    # conditions and actions come to us as json text.  Both are lists of objects with an address.
+    def parseList(self, column, value):
+
+        try:
+
+            items = json.loads(value) if isinstance(value, basestring) else value
+
+        except ValueError, e:
+
+            log_to_postgres('Invalid %s for a Hue rule (expecting a json list): %s -- %s' % (column, e, value), ERROR)
+
+        if not isinstance(items, list) or not all([isinstance(item, dict) and item.has_key('address') for item in items]):
+            log_to_postgres('Invalid %s for a Hue rule (expecting a json list of objects with an "address"): %s' % (column, value), ERROR)
+
+        # Rule addresses are relative to /api/<username>, and start with a "/":
+        for item in items:
+            if not item['address'].startswith('/'):
+                item['address'] = '/' + item['address']
+
+        return items
+
+
+    ############
+    # The rule attributes (as the bridge names them) for the columns in newValues that aren't NULL.
+    def ruleAttributes(self, newValues):
+
+        attributes = {}
+
+        for column in ['rule_name', 'status']:
+            if newValues.get(column) is not None:
+                attributes[self.columnKeyMap[column]] = newValues[column]
+
+        for column in ['conditions', 'actions']:
+            if newValues.get(column) is not None:
+                attributes[column] = self.parseList(column, newValues[column])
+
+        return attributes
+
+
+    ############
+    # The errors in one of the bridge's answers, the way hue_errors.describeErrors() wants them.
+    # The bridge answers with a list of statuses; anything else counts as an error of its own.
+    def resultErrors(self, address, hueResults):
+
+        if not isinstance(hueResults, list):
+            return [{'address': '/' + address, 'description': 'unexpected response %s' % hueResults}]
+
+        return [status.get('error', {'address': '/' + address, 'description': '%s' % status}) for status in hueResults if not status.has_key('success')]
+
+
+    ############
+    # SQL INSERT:
+    # Create the rule on the bridge right away, so we can hand its id back (eg. "insert ... returning rule_id").
+    def insert(self, new_values):
+
+        log_to_postgres('Hue Rules Insert Request - new values:  %s' % new_values, DEBUG)
+
+        rule = self.ruleAttributes(new_values)
+
+        if not rule.get('conditions') or not rule.get('actions'):
+            log_to_postgres('A Hue rule needs at least one condition and one action.', ERROR)
+
+        try:
+
+            results = self.hueBridge.post(self.hueBridge.apiURL(self.userName, 'rules'), json.dumps(rule))
+            hueResults = json.loads(results.text)
+
+        except hueBridgeException, e:
+
+            # We can't tell whether the bridge did it:
+            self.hueBridge.invalidate(self.userName, 'rules')
+            log_to_postgres('%s' % e, ERROR)
+
+        except ValueError, e:
+
+            log_to_postgres('Unexpected (non-JSON) response from the Hue Bridge %s: %s -- %s' % (self.bridge, e, results), ERROR)
+
+        self.hueBridge.invalidate(self.userName, 'rules')
+
+        if isinstance(hueResults, list):
+            for status in hueResults:
+                if status.has_key('success'):
+                    new_values['rule_id'] = int(status['success']['id'])
+                    return new_values
+
+        log_to_postgres('Hue Rules Full Results: %s' % hueResults, DEBUG)
+        log_to_postgres('Hue Rules Insert Failed:  %s' % '; '.join(describeErrors(self.resultErrors('rules', hueResults))), ERROR)
+
+
+    ############
+    # SQL UPDATE:
+    # Only what changed since our scan is sent.
+    def update(self, ruleID, newValues):
+
+        log_to_postgres('Hue Rules Update Request - rule_id:  %s' % ruleID, DEBUG)
+        log_to_postgres('Hue Rules Update Request - new values:  %s' % newValues, DEBUG)
+
+        rule = self.scannedRules.get(str(ruleID), {})
+
+        changes = {}
+        for key, value in self.ruleAttributes(newValues).items():
+            if rule.get(key) != value:
+                changes[key] = value
+
+        if not changes:
+            return
+
+        log_to_postgres('Hue Rules Update Queued - rule_id %s -- %s' % (ruleID, json.dumps(changes)), DEBUG)
+
+        # The bridge's command scheduler paces what we send.
+        self.hueBridge.scheduler.submit(self.userName, Command('rules/%s' % ruleID, changes), self)
+
+
+    ############
+    # End of an INSERT/UPDATE/DELETE statement:
+    # Send the changes we queued up in update().
+    def end_modify(self):
+
+        failures = []
+        errors = []
+
+        for command, hueResults, e in self.hueBridge.scheduler.drain(1, self):
+
+            if e is not None:
+                failures.append('%s:  %s' % (command, e))
+            else:
+                errors.extend(self.resultErrors(command.address, hueResults))
+
+        self.hueBridge.invalidate(self.userName, 'rules')
+
+        failures.extend(describeErrors(errors))
+
+        if failures:
+
+            log_to_postgres('Hue Rules Full Results: %s' % failures, DEBUG)
+            log_to_postgres('Hue Rules Update Failed:  %s' % '; '.join(failures), ERROR)
+
+
+    ############
+    # Transactions:
+    # An UPDATE that failed part way through may have left changes with the scheduler.  They mustn't go out
+    # with our next statement.
+    def rollback(self):
+        self.hueBridge.scheduler.discard(self)
+
+
+    def sub_rollback(self, level):
+        self.hueBridge.scheduler.discard(self)
+
+
+    ############
+    # SQL DELETE
+    def delete(self, ruleID):
+
+        log_to_postgres('Hue Rules Delete Request - rule_id:  %s' % ruleID, DEBUG)
+
+        try:
+
+            results = self.hueBridge.delete(self.hueBridge.apiURL(self.userName, 'rules/%s' % ruleID))
+            hueResults = json.loads(results.text)
+
+        except hueBridgeException, e:
+
+            # We can't tell whether the bridge did it:
+            self.hueBridge.invalidate(self.userName, 'rules')
+            log_to_postgres('%s' % e, ERROR)
+
+        except ValueError, e:
+
+            log_to_postgres('Unexpected (non-JSON) response from the Hue Bridge %s: %s -- %s' % (self.bridge, e, results), ERROR)
+
+        self.hueBridge.invalidate(self.userName, 'rules')
+
+        errors = self.resultErrors('rules/%s' % ruleID, hueResults)
+
+        if errors:
+            log_to_postgres('Hue Rules Delete Failed:  rule %s -- %s' % (ruleID, '; '.join(describeErrors(errors))), ERROR)
@@ -0,0 +1,512 @@
+################################################################################################################
+## This is the implementation of the Multicorn ForeignDataWrapper class as an interface to the Philips Hue system
+##
+## We set up these endpoints:
+##   * Lights
+##   * Config
+##   * Sensors
+##   * Groups
+##   * Scenes
+##   * Schedules
+##   * Rules
+## as separate classes since they have very different structures and purposes.
+##
+## Each of these FDW classes is in a different file.
+## This file has the one for the * Scenes * endpoint in it.
+##
+################################################################################################################
+
+import json
+
+from multicorn import ForeignDataWrapper
+from multicorn.utils import log_to_postgres, ERROR, WARNING, DEBUG
+
+from operatorFunctions import unknownOperatorException, compileQuals, getEqualityValue
+from hueBridge import hueBridgeException, getBridge, DEFAULT_FULLSTATE_TTL_MS
+from jsonCache import SerializationCache
+from commandScheduler import Command
+from sensorTypes import noneToNull
+import hueStats
+from explainScan import explainScan, plannedRequest, pushedQuals
+
+
+## Our row estimate before we've seen the bridge.  The Hue apps leave a lot of scenes behind.
+DEFAULT_ESTIMATED_SCENES = 50
+
+
+##############################################
+## The Foreign Data Wrapper Class for Scenes:
+##
+## Options:
+##  bridge   -- Required:  The IP address for the Hue Bridge
+##  username -- Required:  The API user name - configured when the bridge is set up
+##              (see http://www.developers.meethue.com/documentation/getting-started )
+##  kvtype   -- Optional:  json or hstore - Whether nested KV data returns JSON format or HSTORE format. (default:  json)
+##  pool_size, pool_idle_timeout -- Optional:  Connection pool settings for the bridge.  (see hueBridge.py)
+##  max_group_commands_per_sec -- Optional:  Rate limit for the group commands (recalls) we send the bridge.  (see hueBridge.py)
+##  cache_ttl_ms -- Optional:  Integer - Milliseconds a scan may reuse the last response from the bridge. (default: 0)
+##  fetch_mode   -- Optional:  endpoint or fullstate - Whether a scan GETs just scenes, or the whole bridge datastore
+##                  (which refreshes every Hue table's snapshot at once). (default: endpoint)
+##
+## A scene is a stored state for each of a set of lights.  Recalling it is one group action, however many lights
+## it sets and however different their states are:
+##   * INSERT stores a new scene.  With light_states left NULL the bridge captures the lights' current states;
+##     otherwise light_states is json like {"1": {"on": true, "bri": 254, "xy": [0.6, 0.3]}, "2": {...}}.
+##   * UPDATE ... SET recall = true recalls the scene.  (recall always reads as false.)
+##     Changing scene_name or light_states changes the stored scene.
+##   * DELETE removes the scene from the bridge.
+##
+## The bridge only hands out a scene's light states when it is asked for that one scene, so light_states is NULL
+## unless the query has "where scene_id = '...'".
+##
+class HueScenesFDW(ForeignDataWrapper):
+
+    """
+    Philips Hue Scenes Foreign Data Wrapper for PostgreSQL
+    """
+
+    def __init__(self, options, columns):
+
+        super(HueScenesFDW, self).__init__(options, columns)
+
+        log_to_postgres('Hue Scenes options:  %s' % options, DEBUG)
+        log_to_postgres('Hue Scenes columns:  %s' % columns, DEBUG)
+
+        if options.has_key('bridge'):
+            self.bridge = options['bridge']
+        else:
+            log_to_postgres('bridge IP address is required for Hue Scenes setup.', ERROR)
+
+        if options.has_key('username'):
+            self.userName = options['username']
+        else:
+            self.userName = 'postgreshue'
+            log_to_postgres('Using Default Username for Hue Scenes setup:  postgreshue.', WARNING)
+
+        # All of the Hue wrappers in this backend share one pooled connection to each bridge:
+        self.hueBridge = getBridge(self.bridge, options)
+
+        # Either GET just our own endpoint, or the whole datastore so the other Hue tables can share the response:
+        if options.has_key('fetch_mode'):
+            if options['fetch_mode'].lower() in ['endpoint', 'fullstate']:
+                self.fetchMode = options['fetch_mode'].lower()
+            else:
+                log_to_postgres('Invalid Fetch Mode for Hue Scenes setup: %s. (Choose "endpoint" or "fullstate")' % options['fetch_mode'], ERROR)
+        else:
+            self.fetchMode = 'endpoint'
+
+        # Scans within this many seconds of the last one are answered from the bridge snapshot:
+        if options.has_key('cache_ttl_ms'):
+            self.cacheTTL = float(options['cache_ttl_ms']) / 1000
+        elif self.fetchMode == 'fullstate':
+            self.cacheTTL = float(DEFAULT_FULLSTATE_TTL_MS) / 1000
+        else:
+            self.cacheTTL = 0
+
+        # Give the user a choice as to whether they want to serialize Dictionaries into
+        # HSTORE or JSON.  By default Multicorn serializes them to HSTORE.  (Issue #86 in the Multicorn Repo.)
+        if options.has_key('kvtype'):
+            if options['kvtype'].lower() in ['hstore', 'json']:
+                self.kvType = options['kvtype'].lower()
+            else:
+                log_to_postgres('Invalid Key Value Type for Hue Scenes setup: %s. (Choose "hstore" or "json")' % options['kvtype'], ERROR)
+        else:
+            self.kvType = 'json'
+
+        # The nested objects hardly ever change, so we keep the json we made for them last time:
+        self.jsonCache = SerializationCache()
+
+        # What the last scan cost, for EXPLAIN VERBOSE (see explainScan.py):
+        self.lastScan = None
+
+        ###
+        # We need to identify the "primary key" column so we can do updates:
+        self._row_id_column = 'scene_id'
+
+        # The columns we'll be using (defaults to 'all'):
+        self.columns = columns
+
+        # Where each column sits in the rows we hand back:
+        self.columnIndex = dict([(column, i) for i, column in enumerate(columns)])
+
+        # These are the only columns we are going to allow to be updated:
+        self.mutable_columns = ['scene_name', 'light_states', 'recall']
+
+        # We renamed some of the columns to avoid reserved PG keywords, and to match the other tables.
+        self.columnKeyMap = { 'scene_name'   : 'name',
+                              'light_ids'    : 'lights',
+                              'group_id'     : 'group',
+                              'last_updated' : 'lastupdated',
+                              'light_states' : 'lightstates',
+                              # These haven't been renamed:
+                              'owner'        : 'owner',
+                              'recycle'      : 'recycle',
+                              'locked'       : 'locked' }
+
+        # Rough widths (in bytes) of each column, for the planner.  Anything not listed is a short string.
+        self.columnWidths = { 'light_ids'    : 24,
+                              'group_id'     : 2,
+                              'recycle'      : 1,
+                              'locked'       : 1,
+                              'recall'       : 1,
+                              'last_updated' : 8,
+                              'light_states' : 200 }
+
+        # The scenes our last scan saw, to tell what an UPDATE actually changed:
+        self.scannedScenes = {}
+
+        # Scenes to recall, and scene changes to make, at the end of the statement:
+        self.sceneChanges = []
+
+
+    ############
+    # We need to overload this function so Updates will work
+    @property
+    def rowid_column(self):
+        return self._row_id_column
+
+
+    ############
+    # Query planning:
+    # Tell PostgreSQL about how many rows (and how wide) a scan will produce, so it can plan joins sensibly.
+    # We count whatever we last saw from the bridge rather than asking it again just to plan.
+    def get_rel_size(self, quals, columns):
+
+        if getEqualityValue(quals, 'scene_id') is not None:
+            rows = 1
+        else:
+            scenes = self.hueBridge.lastSnapshot(self.userName, 'scenes')
+            rows = len(scenes) if isinstance(scenes, dict) else DEFAULT_ESTIMATED_SCENES
+
+        return (rows, sum([self.columnWidths.get(column, 16) for column in columns]))
+
+
+    ############
+    # A scan with scene_id given always asks the bridge (see execute()), so as the inner side of a nested loop join
+    # it would cost a round trip for every outer row.  We don't offer it; the planner scans the table once instead.
+    def get_path_keys(self):
+        return []
+
+
+    ############
+    # EXPLAIN:  what a scan would ask the bridge for, and which quals narrow it.  (see explainScan.py)
+    # A scan by scene_id always asks the bridge (see execute()).
+    def explain(self, quals, columns, sortkeys=None, verbose=False):
+
+        sceneID = getEqualityValue(quals, 'scene_id')
+
+        if sceneID is not None:
+            request = plannedRequest(self.hueBridge, self.userName, 'scenes', sceneID, 0, False)
+        else:
+            request = plannedRequest(self.hueBridge, self.userName, 'scenes', None, self.cacheTTL, self.fetchMode == 'fullstate')
+
+        return explainScan([(self.bridge, request)], pushedQuals(quals, 'scene_id'), quals, columns, self.lastScan, verbose)
+
+
+    ############
+    # Work out, once per scan, how to pull each table column out of a scene.
+    # Multicorn wants a sequence row to have a value for every column of the table, in table order,
+    # so the columns the query didn't ask for just get None.
+    def compileExtractors(self, columns):
+
+        extractors = []
+
+        for column in self.columns:
+
+            if column not in columns:
+                extractors.append(lambda sceneID, scene: None)
+
+            elif column == 'scene_id':
+                extractors.append(lambda sceneID, scene: sceneID)
+
+            elif column == 'light_ids':
+                extractors.append(lambda sceneID, scene: [int(lightID) for lightID in scene.get('lights', [])])
+
+            elif column == 'group_id':
+                extractors.append(lambda sceneID, scene: int(scene['group']) if 'group' in scene else None)
+
+            # Recalling is something we do, not something a scene has:
+            elif column == 'recall':
+                extractors.append(lambda sceneID, scene: False)
+
+            elif column == 'last_updated':
+                extractors.append(lambda sceneID, scene: noneToNull(scene.get('lastupdated')))
+
+            # Only there when we asked for the one scene:
+            elif column == 'light_states':
+                # HSTORE Column Type:
+                if self.kvType == 'hstore':
+                    extractors.append(lambda sceneID, scene: scene.get('lightstates'))
+                # JSON Column Type:
+                else:
+                    extractors.append(lambda sceneID, scene: self.jsonCache.dumps(('lightstates', sceneID), scene['lightstates']) if 'lightstates' in scene else None)
+
+            else:
+                extractors.append(lambda sceneID, scene, key=self.columnKeyMap[column]: scene.get(key))
+
+        return tuple(extractors)
+
+
+    ############
+    # SQL SELECT:
+    # We get back all of the scenes we can find and roll them up into rows
+    def execute(self, quals, columns):
+
+        log_to_postgres('Hue Scenes Query Columns:  %s' % columns, DEBUG)
+        log_to_postgres('Hue Scenes Query Filters:  %s' % quals, DEBUG)
+
+        # Work out how to build and test each row once, up front.
+        # An operator we can't handle fails here, before we fetch anything.
+        extractors = self.compileExtractors(columns)
+
+        try:
+            rowMatches = compileQuals(quals, self.columnIndex)
+
+        except unknownOperatorException, e:
+            log_to_postgres(e, ERROR)
+
+        # What this scan costs, for EXPLAIN VERBOSE:
+        scanCost = hueStats.ScanCost('scenes', [self.bridge])
+        self.lastScan = scanCost
+
+        # Keep count of the rows we look at and hand back (see hueStats.py):
+        rowMatches = scanCost.countRows(self.bridge, rowMatches)
+
+        # "where scene_id = '...'" only needs /scenes/<id>, which is also the only way to get a scene's light states.
+        # So we always ask the bridge for it, even if the list of scenes we have is fresh.
+        sceneID = getEqualityValue(quals, 'scene_id')
+
+        try:
+
+            if sceneID is not None:
+                hueResults = self.hueBridge.resource(self.userName, 'scenes', sceneID, 0)
+            else:
+                hueResults = self.hueBridge.snapshot(self.userName, 'scenes', self.cacheTTL, self.fetchMode == 'fullstate')
+
+        except hueBridgeException, e:
+
+            log_to_postgres('%s' % e, ERROR)
+
+        # If the bridge didn't answer and serve_stale is on, we're looking at an old snapshot:
+        for warning in self.hueBridge.takeWarnings():
+            log_to_postgres(warning, WARNING)
+
+        scanCost.update()
+
+        self.scannedScenes.update(hueResults)
+
+        try:
+
+            for sceneID, scene in hueResults.items():
+
+                # Rows are lists in table column order.
+                row = [extract(sceneID, scene) for extract in extractors]
+
+                if rowMatches(row):
+
+                    yield row
+
+        finally:
+
+            # Add this scan's rows to the stats (see hueStats.py):
+            scanCost.finish()
+
+
+    ############
+    # Scene changes are plain JSON in, list of results out.  Anything but a success is an error.
+    def checkResults(self, action, results):
+
+        try:
+
+            hueResults = json.loads(results.text)
+
+        except ValueError, e:
+
+            log_to_postgres('Unexpected (non-JSON) response from the Hue Bridge %s while trying to %s: %s -- %s' % (self.bridge, action, e, results), ERROR)
+
+        for status in hueResults:
+            if not status.has_key('success'):
+                log_to_postgres('Hue Scenes Full Results: %s' % hueResults, DEBUG)
+                log_to_postgres('Hue Scenes failed to %s:  %s' % (action, status.get('error', status)), ERROR)
+
+        return hueResults
+
+
+    ############
+    # light_states comes to us as json text (or a dict, from hstore).
+    def parseLightStates(self, lightStates):
+
+        if not isinstance(lightStates, dict):
+
+            try:
+
+                lightStates = json.loads(lightStates)
+
+            except ValueError, e:
+
+                log_to_postgres('Invalid light_states for a Hue scene (expecting json like {"1": {"on": true, "bri": 254}}): %s -- %s' % (e, lightStates), ERROR)
+
+        if not isinstance(lightStates, dict):
+            log_to_postgres('Invalid light_states for a Hue scene (expecting json like {"1": {"on": true, "bri": 254}}): %s' % json.dumps(lightStates), ERROR)
+
+        # The bridge keys lights by number:
+        for lightID in lightStates.keys():
+            if not str(lightID).isdigit():
+                log_to_postgres('Invalid light id in the light_states for a Hue scene: "%s".  (Light ids are numbers, eg. {"1": {"on": true}})' % lightID, ERROR)
+
+        return lightStates
+
+
+    ############
+    # SQL INSERT:
+    # Store a new scene on the bridge right away, so we can hand its id back (eg. "insert ... returning scene_id").
+    def insert(self, new_values):
+
+        log_to_postgres('Hue Scenes Insert Request - new values:  %s' % new_values, DEBUG)
+
+        if not new_values.get('scene_name'):
+            log_to_postgres('A Hue scene needs a scene_name.', ERROR)
+
+        scene = { 'name'    : new_values['scene_name'],
+                  'recycle' : new_values.get('recycle') in [True, 't'] }
+
+        if new_values.get('light_states') is not None:
+            lightStates = self.parseLightStates(new_values['light_states'])
+            scene['lightstates'] = lightStates
+            scene['lights'] = sorted([str(lightID) for lightID in lightStates.keys()], key=int)
+
+        if new_values.get('light_ids'):
+            scene['lights'] = [str(lightID) for lightID in new_values['light_ids']]
+
+        if not scene.get('lights'):
+            log_to_postgres('A Hue scene needs its light_ids (or light_states).', ERROR)
+
+        try:
+            results = self.hueBridge.post(self.hueBridge.apiURL(self.userName, 'scenes'), json.dumps(scene))
+        except hueBridgeException, e:
+            log_to_postgres('%s' % e, ERROR)
+
+        hueResults = self.checkResults('create scene %s' % json.dumps(scene), results)
+
+        self.hueBridge.invalidate(self.userName, 'scenes')
+
+        new_values['scene_id'] = hueResults[0]['success']['id']
+        new_values['recall'] = False
+
+        return new_values
+
+
+    ############
+    # SQL UPDATE:
+    # We don't do anything yet.  Once the statement has seen every row we recall the scenes together.
+    def update(self, sceneID, newValues):
+
+        log_to_postgres('Hue Scenes Update Request - scene_id:  %s' % sceneID, DEBUG)
+        log_to_postgres('Hue Scenes Update Request - new values:  %s' % newValues, DEBUG)
+
+        scene = self.scannedScenes.get(sceneID, {})
+
+        if newValues.get('scene_name') is not None and newValues['scene_name'] != scene.get('name'):
+            self.sceneChanges.append(('rename', sceneID, newValues['scene_name']))
+
+        # A scan only has light states if it asked for this one scene, so NULL just means we didn't look:
+        if newValues.get('light_states') is not None:
+            lightStates = self.parseLightStates(newValues['light_states'])
+            if lightStates != scene.get('lightstates'):
+                self.sceneChanges.append(('lightstates', sceneID, lightStates))
+
+        if newValues.get('recall') in [True, 't']:
+            # A scene made for a group is recalled through that group, any other through group 0 (all lights):
+            groupID = scene.get('group', '0')
+            self.sceneChanges.append(('recall', sceneID, groupID))
+
+
+    ############
+    # End of an INSERT/UPDATE/DELETE statement:
+    # Change the scenes first, so a statement that changes and recalls a scene recalls the new version.
+    def end_modify(self):
+
+        sceneChanges = self.sceneChanges
+        self.sceneChanges = []
+
+        recalled = False
+
+        # The renames go straight to the bridge.  We do them before queueing anything else, so if one of them fails
+        # there's nothing left in the scheduler to go out with the next statement.
+        for change, sceneID, value in sceneChanges:
+
+            if change == 'rename':
+
+                try:
+                    results = self.hueBridge.put(self.hueBridge.apiURL(self.userName, 'scenes/%s' % sceneID), json.dumps({'name': value}))
+                except hueBridgeException, e:
+                    self.hueBridge.invalidate(self.userName, 'scenes')
+                    log_to_postgres('%s' % e, ERROR)
+
+                self.checkResults('rename scene %s' % sceneID, results)
+                self.hueBridge.invalidate(self.userName, 'scenes')
+
+        for change, sceneID, value in sceneChanges:
+
+            # Each light's stored state is its own PUT, so they go out through the light command budget:
+            if change == 'lightstates':
+                for lightID, lightState in sorted(value.items()):
+                    self.hueBridge.scheduler.submit(self.userName, Command('scenes/%s/lightstates/%s' % (sceneID, lightID), lightState), self)
+                self.hueBridge.invalidate(self.userName, 'scenes')
+
+            elif change == 'recall':
+                self.hueBridge.scheduler.submit(self.userName, Command('groups/%s/action' % value, {'scene': sceneID}, isGroup=True), self)
+                recalled = True
+
+        failures = []
+
+        for command, hueResults, e in self.hueBridge.scheduler.drain(1, self):
+
+            if e is not None:
+                failures.append('%s:  %s' % (command, e))
+                continue
+
+            for status in hueResults:
+                if not status.has_key('success'):
+                    failures.append('%s:  %s' % (command, status))
+
+        # We can't tell from the recall's answer what each light was set to:
+        if recalled:
+            self.hueBridge.invalidate(self.userName, 'lights')
+            self.hueBridge.invalidate(self.userName, 'groups')
+
+        if failures:
+
+            log_to_postgres('Hue Scenes Full Results: %s' % failures, DEBUG)
+            log_to_postgres('Hue Scenes Update Failed:  %s' % '; '.join(failures), ERROR)
+
+
+    ############
+    # Transactions:
+    # An UPDATE that failed part way through leaves the changes it collected here (and perhaps with the scheduler).
+    # They mustn't go out with our next statement.
+    def rollback(self):
+        self.sceneChanges = []
+        self.hueBridge.scheduler.discard(self)
+
+
+    def sub_rollback(self, level):
+        self.sceneChanges = []
+        self.hueBridge.scheduler.discard(self)
+
+
+    ############
+    # SQL DELETE
+    def delete(self, sceneID):
+
+        log_to_postgres('Hue Scenes Delete Request - scene_id:  %s' % sceneID, DEBUG)
+
+        try:
+            results = self.hueBridge.delete(self.hueBridge.apiURL(self.userName, 'scenes/%s' % sceneID))
+        except hueBridgeException, e:
+            self.hueBridge.invalidate(self.userName, 'scenes')
+            log_to_postgres('%s' % e, ERROR)
+
+        self.checkResults('delete scene %s' % sceneID, results)
+
+        self.hueBridge.invalidate(self.userName, 'scenes')
@@ -0,0 +1,502 @@
+################################################################################################################
+## This is the implementation of the Multicorn ForeignDataWrapper class as an interface to the Philips Hue system
+##
+## We set up these endpoints:
+##   * Lights
+##   * Config
+##   * Sensors
+##   * Groups
+##   * Scenes
+##   * Schedules
+##   * Rules
+## as separate classes since they have very different structures and purposes.
+##
+## Each of these FDW classes is in a different file.
+## This file has the one for the * Schedules * endpoint in it.
+##
+################################################################################################################
+
+import json
+
+from multicorn import ForeignDataWrapper
+from multicorn.utils import log_to_postgres, ERROR, WARNING, DEBUG
+
+from operatorFunctions import unknownOperatorException, compileQuals, getEqualityValue
+from hueBridge import hueBridgeException, getBridge, DEFAULT_FULLSTATE_TTL_MS
+from jsonCache import SerializationCache
+from commandScheduler import Command
+from sensorTypes import noneToNull
+import hueStats
+from explainScan import explainScan, plannedRequest, pushedQuals
+
+
+## Our row estimate before we've seen the bridge.  (The bridge can hold 100 schedules.)
+DEFAULT_ESTIMATED_SCHEDULES = 10
+
+
+##############################################
+## The Foreign Data Wrapper Class for Schedules:
+##
+## Options:
+##  bridge   -- Required:  The IP address for the Hue Bridge
+##  username -- Required:  The API user name - configured when the bridge is set up
+##              (see http://www.developers.meethue.com/documentation/getting-started )
+##  kvtype   -- Optional:  json or hstore - Whether nested KV data returns JSON format or HSTORE format. (default:  json)
+##  pool_size, pool_idle_timeout -- Optional:  Connection pool settings for the bridge.  (see hueBridge.py)
+##  max_commands_per_sec -- Optional:  Rate limit for the commands we send the bridge.  (see hueBridge.py)
+##  cache_ttl_ms -- Optional:  Integer - Milliseconds a scan may reuse the last response from the bridge. (default: 0)
+##  fetch_mode   -- Optional:  endpoint or fullstate - Whether a scan GETs just schedules, or the whole bridge datastore
+##                  (which refreshes every Hue table's snapshot at once). (default: endpoint)
+##
+## A schedule is a command the bridge sends itself at a given time, so a timed sequence of light changes can run
+## on the bridge instead of in a database session sitting in pg_sleep().
+##   * local_time is the bridge's time pattern, eg. '2015-06-01T18:00:00', 'PT00:00:05' (a timer, 5 seconds from now),
+##     'R05/PT00:00:01' (every second, 5 times), or 'W124/T18:00:00' (18:00 on Monday, Wednesday, and Friday).
+##     (see http://www.developers.meethue.com/documentation/datatypes-and-time-patterns )
+##   * command_address can be given the way the other tables talk about resources, eg. 'groups/0/action' --
+##     we add the "/api/<username>/" the bridge wants on the front.
+##   * command_body is the json to send, eg. {"on": true, "bri": 254}
+##
+## INSERT creates the schedule right away (so "returning schedule_id" works), UPDATE changes it, and DELETE removes it.
+##
+class HueSchedulesFDW(ForeignDataWrapper):
+
+    """
+    Philips Hue Schedules Foreign Data Wrapper for PostgreSQL
+    """
+
+    def __init__(self, options, columns):
+
+        super(HueSchedulesFDW, self).__init__(options, columns)
+
+        log_to_postgres('Hue Schedules options:  %s' % options, DEBUG)
+        log_to_postgres('Hue Schedules columns:  %s' % columns, DEBUG)
+
+        if options.has_key('bridge'):
+            self.bridge = options['bridge']
+        else:
+            log_to_postgres('bridge IP address is required for Hue Schedules setup.', ERROR)
+
+        if options.has_key('username'):
+            self.userName = options['username']
+        else:
+            self.userName = 'postgreshue'
+            log_to_postgres('Using Default Username for Hue Schedules setup:  postgreshue.', WARNING)
+
+        # All of the Hue wrappers in this backend share one pooled connection to each bridge:
+        self.hueBridge = getBridge(self.bridge, options)
+
+        # Either GET just our own endpoint, or the whole datastore so the other Hue tables can share the response:
+        if options.has_key('fetch_mode'):
+            if options['fetch_mode'].lower() in ['endpoint', 'fullstate']:
+                self.fetchMode = options['fetch_mode'].lower()
+            else:
+                log_to_postgres('Invalid Fetch Mode for Hue Schedules setup: %s. (Choose "endpoint" or "fullstate")' % options['fetch_mode'], ERROR)
+        else:
+            self.fetchMode = 'endpoint'
+
+        # Scans within this many seconds of the last one are answered from the bridge snapshot:
+        if options.has_key('cache_ttl_ms'):
+            self.cacheTTL = float(options['cache_ttl_ms']) / 1000
+        elif self.fetchMode == 'fullstate':
+            self.cacheTTL = float(DEFAULT_FULLSTATE_TTL_MS) / 1000
+        else:
+            self.cacheTTL = 0
+
+        # Give the user a choice as to whether they want to serialize Dictionaries into
+        # HSTORE or JSON.  By default Multicorn serializes them to HSTORE.  (Issue #86 in the Multicorn Repo.)
+        if options.has_key('kvtype'):
+            if options['kvtype'].lower() in ['hstore', 'json']:
+                self.kvType = options['kvtype'].lower()
+            else:
+                log_to_postgres('Invalid Key Value Type for Hue Schedules setup: %s. (Choose "hstore" or "json")' % options['kvtype'], ERROR)
+        else:
+            self.kvType = 'json'
+
+        # The nested objects hardly ever change, so we keep the json we made for them last time:
+        self.jsonCache = SerializationCache()
+
+        # What the last scan cost, for EXPLAIN VERBOSE (see explainScan.py):
+        self.lastScan = None
+
+        ###
+        # We need to identify the "primary key" column so we can do updates:
+        self._row_id_column = 'schedule_id'
+
+        # The columns we'll be using (defaults to 'all'):
+        self.columns = columns
+
+        # Where each column sits in the rows we hand back:
+        self.columnIndex = dict([(column, i) for i, column in enumerate(columns)])
+
+        # These are the only columns we are going to allow to be updated:
+        self.mutable_columns = ['schedule_name',
+                                'description',
+                                'command_address',
+                                'command_method',
+                                'command_body',
+                                'local_time',
+                                'status',
+                                'autodelete']
+
+        # We renamed some of the columns to avoid reserved PG keywords, and made some of them more verbose.
+        self.columnKeyMap = { 'schedule_name' : 'name',
+                              'local_time'    : 'localtime',
+                              'start_time'    : 'starttime',
+                              # These haven't been renamed:
+                              'description'   : 'description',
+                              'status'        : 'status',
+                              'autodelete'    : 'autodelete',
+                              'recycle'       : 'recycle',
+                              'created'       : 'created' }
+
+        # These columns come out of the schedule's inner "command" object:
+        self.commandColumnMap = { 'command_address' : 'address',
+                                  'command_method'  : 'method',
+                                  'command_body'    : 'body' }
+
+        # Rough widths (in bytes) of each column, for the planner.  Anything not listed is a short string.
+        self.columnWidths = { 'schedule_id'     : 2,
+                              'command_address' : 40,
+                              'command_body'    : 60,
+                              'autodelete'      : 1,
+                              'recycle'         : 1,
+                              'created'         : 8,
+                              'start_time'      : 8 }
+
+        # The schedules our last scan saw, to tell what an UPDATE actually changed:
+        self.scannedSchedules = {}
+
+
+    ############
+    # We need to overload this function so Updates will work
+    @property
+    def rowid_column(self):
+        return self._row_id_column
+
+
+    ############
+    # Query planning:
+    # Tell PostgreSQL about how many rows (and how wide) a scan will produce, so it can plan joins sensibly.
+    # We count whatever we last saw from the bridge rather than asking it again just to plan.
+    def get_rel_size(self, quals, columns):
+
+        if getEqualityValue(quals, 'schedule_id') is not None:
+            rows = 1
+        else:
+            schedules = self.hueBridge.lastSnapshot(self.userName, 'schedules')
+            rows = len(schedules) if isinstance(schedules, dict) else DEFAULT_ESTIMATED_SCHEDULES
+
+        return (rows, sum([self.columnWidths.get(column, 16) for column in columns]))
+
+
+    ############
+    # A scan with schedule_id given can be the inner side of a nested loop join, looked up once per outer row.
+    # That is only cheap if the lookups come out of our snapshot (see hueBridge.resource()).  Without a cache each
+    # one would be a round trip to the bridge, so we leave the planner to scan the table once and hash join instead.
+    def get_path_keys(self):
+
+        if self.cacheTTL > 0:
+            return [(('schedule_id',), 1)]
+
+        return []
+
+
+    ############
+    # EXPLAIN:  what a scan would ask the bridge for, and which quals narrow it.  (see explainScan.py)
+    # In fullstate mode, or with a cache, schedule_id doesn't narrow the request -- we get the whole datastore (or endpoint) either way.
+    def explain(self, quals, columns, sortkeys=None, verbose=False):
+
+        fullState = self.fetchMode == 'fullstate'
+        scheduleID = getEqualityValue(quals, 'schedule_id')
+
+        request = plannedRequest(self.hueBridge, self.userName, 'schedules', scheduleID, self.cacheTTL, fullState)
+        pushed = pushedQuals(quals, None if fullState or self.cacheTTL > 0 else 'schedule_id')
+
+        return explainScan([(self.bridge, request)], pushed, quals, columns, self.lastScan, verbose)
+
+
+    ############
+    # Work out, once per scan, how to pull each table column out of a schedule.
+    # Multicorn wants a sequence row to have a value for every column of the table, in table order,
+    # so the columns the query didn't ask for just get None.
+    def compileExtractors(self, columns):
+
+        extractors = []
+
+        for column in self.columns:
+
+            if column not in columns:
+                extractors.append(lambda scheduleID, schedule: None)
+
+            elif column == 'schedule_id':
+                extractors.append(lambda scheduleID, schedule: int(scheduleID))
+
+            elif column == 'command_body':
+                # HSTORE Column Type:
+                if self.kvType == 'hstore':
+                    extractors.append(lambda scheduleID, schedule: schedule['command'].get('body'))
+                # JSON Column Type:
+                else:
+                    extractors.append(lambda scheduleID, schedule: self.jsonCache.dumps(('body', scheduleID), schedule['command'].get('body')))
+
+            elif column in self.commandColumnMap:
+                extractors.append(lambda scheduleID, schedule, key=self.commandColumnMap[column]: schedule['command'].get(key))
+
+            # The bridge says "none" for times it doesn't have:
+            elif column in ['created', 'start_time']:
+                extractors.append(lambda scheduleID, schedule, key=self.columnKeyMap[column]: noneToNull(schedule.get(key)))
+
+            else:
+                extractors.append(lambda scheduleID, schedule, key=self.columnKeyMap[column]: schedule.get(key))
+
+        return tuple(extractors)
+
+
+    ############
+    # SQL SELECT:
+    # We get back all of the schedules we can find and roll them up into rows
+    def execute(self, quals, columns):
+
+        log_to_postgres('Hue Schedules Query Columns:  %s' % columns, DEBUG)
+        log_to_postgres('Hue Schedules Query Filters:  %s' % quals, DEBUG)
+
+        # Work out how to build and test each row once, up front.
+        # An operator we can't handle fails here, before we fetch anything.
+        extractors = self.compileExtractors(columns)
+
+        try:
+            rowMatches = compileQuals(quals, self.columnIndex)
+
+        except unknownOperatorException, e:
+            log_to_postgres(e, ERROR)
+
+        # What this scan costs, for EXPLAIN VERBOSE:
+        scanCost = hueStats.ScanCost('schedules', [self.bridge])
+        self.lastScan = scanCost
+
+        # Keep count of the rows we look at and hand back (see hueStats.py):
+        rowMatches = scanCost.countRows(self.bridge, rowMatches)
+
+        # "where schedule_id = N" only needs /schedules/N.  (In fullstate mode the shared datastore GET is the cheaper way to go.)
+        # We still run all of the quals over whatever comes back, so the results are the same either way.
+        scheduleID = getEqualityValue(quals, 'schedule_id')
+
+        try:
+
+            if scheduleID is not None and self.fetchMode != 'fullstate':
+                hueResults = self.hueBridge.resource(self.userName, 'schedules', int(scheduleID), self.cacheTTL)
+            else:
+                hueResults = self.hueBridge.snapshot(self.userName, 'schedules', self.cacheTTL, self.fetchMode == 'fullstate')
+
+        except hueBridgeException, e:
+
+            log_to_postgres('%s' % e, ERROR)
+
+        # If the bridge didn't answer and serve_stale is on, we're looking at an old snapshot:
+        for warning in self.hueBridge.takeWarnings():
+            log_to_postgres(warning, WARNING)
+
+        scanCost.update()
+
+        self.scannedSchedules.update(hueResults)
+
+        try:
+
+            for scheduleID, schedule in hueResults.items():
+
+                # Rows are lists in table column order.
+                row = [extract(scheduleID, schedule) for extract in extractors]
+
+                if rowMatches(row):
+
+                    yield row
+
+        finally:
+
+            # Add this scan's rows to the stats (see hueStats.py):
+            scanCost.finish()
+
+
+    ############
+    # The bridge wants the whole path in a schedule's command address: /api/<username>/groups/0/action
+    def commandAddress(self, address):
+
+        if address.startswith('/api/'):
+            return address
+
+        return '/api/%s/%s' % (self.userName, address.lstrip('/'))
+
+
+    ############
+    # command_body comes to us as json text (or a dict, from hstore).
+    def parseBody(self, body):
+
+        if isinstance(body, dict):
+            return body
+
+        try:
+
+            return json.loads(body)
+
+        except ValueError, e:
+
+            log_to_postgres('Invalid command_body for a Hue schedule (expecting json like {"on": true}): %s -- %s' % (e, body), ERROR)
+
+
+    ############
+    # The schedule attributes (as the bridge names them) for the columns we were given.
+    # Only the columns in newValues that aren't NULL are included.  The command always goes as a whole.
+    def scheduleAttributes(self, newValues, schedule={}):
+
+        attributes = {}
+
+        for column in ['schedule_name', 'description', 'local_time', 'status']:
+            if newValues.get(column) is not None:
+                attributes[self.columnKeyMap[column]] = newValues[column]
+
+        if newValues.get('autodelete') is not None:
+            attributes['autodelete'] = newValues['autodelete'] in [True, 't']
+
+        command = dict(schedule.get('command', {}))
+
+        if newValues.get('command_address') is not None:
+            command['address'] = self.commandAddress(newValues['command_address'])
+        if newValues.get('command_method') is not None:
+            command['method'] = newValues['command_method'].upper()
+        if newValues.get('command_body') is not None:
+            command['body'] = self.parseBody(newValues['command_body'])
+
+        if command:
+            command.setdefault('method', 'PUT')
+            attributes['command'] = command
+
+        return attributes
+
+
+    ############
+    # SQL INSERT:
+    # Create the schedule on the bridge right away, so we can hand its id back (eg. "insert ... returning schedule_id").
+    def insert(self, new_values):
+
+        log_to_postgres('Hue Schedules Insert Request - new values:  %s' % new_values, DEBUG)
+
+        if not new_values.get('command_address') or new_values.get('command_body') is None or not new_values.get('local_time'):
+            log_to_postgres('A Hue schedule needs at least a command_address, a command_body, and a local_time.', ERROR)
+
+        schedule = self.scheduleAttributes(new_values)
+
+        try:
+
+            results = self.hueBridge.post(self.hueBridge.apiURL(self.userName, 'schedules'), json.dumps(schedule))
+            hueResults = json.loads(results.text)
+
+        except hueBridgeException, e:
+
+            # We can't tell whether the bridge did it:
+            self.hueBridge.invalidate(self.userName, 'schedules')
+            log_to_postgres('%s' % e, ERROR)
+
+        except ValueError, e:
+
+            log_to_postgres('Unexpected (non-JSON) response from the Hue Bridge %s: %s -- %s' % (self.bridge, e, results), ERROR)
+
+        self.hueBridge.invalidate(self.userName, 'schedules')
+
+        for status in hueResults:
+            if status.has_key('success'):
+                new_values['schedule_id'] = int(status['success']['id'])
+                new_values['command_address'] = schedule['command']['address']
+                return new_values
+
+        log_to_postgres('Hue Schedules Full Results: %s' % hueResults, DEBUG)
+        log_to_postgres('Hue Schedules Insert Failed:  %s -- %s' % (json.dumps(schedule), hueResults), ERROR)
+
+
+    ############
+    # SQL UPDATE:
+    # Only what changed since our scan is sent, so an UPDATE of the status doesn't re-send (and re-arm) the timer.
+    def update(self, scheduleID, newValues):
+
+        log_to_postgres('Hue Schedules Update Request - schedule_id:  %s' % scheduleID, DEBUG)
+        log_to_postgres('Hue Schedules Update Request - new values:  %s' % newValues, DEBUG)
+
+        schedule = self.scannedSchedules.get(str(scheduleID), {})
+
+        changes = {}
+        for key, value in self.scheduleAttributes(newValues, schedule).items():
+            if schedule.get(key) != value:
+                changes[key] = value
+
+        if not changes:
+            return
+
+        log_to_postgres('Hue Schedules Update Queued - schedule_id %s -- %s' % (scheduleID, json.dumps(changes)), DEBUG)
+
+        # The bridge's command scheduler paces what we send.
+        self.hueBridge.scheduler.submit(self.userName, Command('schedules/%s' % scheduleID, changes), self)
+
+
+    ############
+    # End of an INSERT/UPDATE/DELETE statement:
+    # Send the changes we queued up in update().
+    def end_modify(self):
+
+        failures = []
+
+        for command, hueResults, e in self.hueBridge.scheduler.drain(1, self):
+
+            if e is not None:
+                failures.append('%s:  %s' % (command, e))
+                continue
+
+            for status in hueResults:
+                if not status.has_key('success'):
+                    failures.append('%s:  %s' % (command, status))
+
+        self.hueBridge.invalidate(self.userName, 'schedules')
+
+        if failures:
+
+            log_to_postgres('Hue Schedules Full Results: %s' % failures, DEBUG)
+            log_to_postgres('Hue Schedules Update Failed:  %s' % '; '.join(failures), ERROR)
+
+
+    ############
+    # Transactions:
+    # An UPDATE that failed part way through may have left changes with the scheduler.  They mustn't go out
+    # with our next statement.
+    def rollback(self):
+        self.hueBridge.scheduler.discard(self)
+
+
+    def sub_rollback(self, level):
+        self.hueBridge.scheduler.discard(self)
+
+
+    ############
+    # SQL DELETE
+    def delete(self, scheduleID):
+
+        log_to_postgres('Hue Schedules Delete Request - schedule_id:  %s' % scheduleID, DEBUG)
+
+        try:
+
+            results = self.hueBridge.delete(self.hueBridge.apiURL(self.userName, 'schedules/%s' % scheduleID))
+            hueResults = json.loads(results.text)
+
+        except hueBridgeException, e:
+
+            # We can't tell whether the bridge did it:
+            self.hueBridge.invalidate(self.userName, 'schedules')
+            log_to_postgres('%s' % e, ERROR)
+
+        except ValueError, e:
+
+            log_to_postgres('Unexpected (non-JSON) response from the Hue Bridge %s: %s -- %s' % (self.bridge, e, results), ERROR)
+
+        self.hueBridge.invalidate(self.userName, 'schedules')
+
+        for status in hueResults:
+            if not status.has_key('success'):
+                log_to_postgres('Hue Schedules Delete Failed:  schedule %s -- %s' % (scheduleID, status), ERROR)
@@ -0,0 +1,186 @@
+################################################################################################################
+## This is the implementation of the Multicorn ForeignDataWrapper class as an interface to the Philips Hue system
+##
+## We set up these endpoints:
+##   * Lights
+##   * Config
+##   * Sensors
+##   * Groups
+##   * Scenes
+##   * Schedules
+##   * Rules
+## as separate classes since they have very different structures and purposes.
+##
+## Each of these FDW classes is in a different file.
+## This file has the one for * Sensor History * in it.  It isn't a bridge endpoint:  the history is recorded
+## in the database backend by a background poller (see sensorHistory.py).
+##
+################################################################################################################
+
+import calendar
+import datetime
+
+from multicorn import ForeignDataWrapper
+from multicorn.utils import log_to_postgres, ERROR, WARNING, DEBUG
+
+from operatorFunctions import unknownOperatorException, compileQuals
+from hueBridge import getBridge
+from sensorHistory import getRecorder
+import hueStats
+
+
+##############################################
+## The Foreign Data Wrapper Class for Sensor History:
+##
+## Options:
+##  bridge   -- Required:  The IP address for the Hue Bridge
+##  username -- Required:  The API user name - configured when the bridge is set up
+##              (see http://www.developers.meethue.com/documentation/getting-started )
+##  history_size -- Optional:  Integer - How many changes we keep for each sensor state value. (default: 1024)
+##  poll_min_ms  -- Optional:  Integer - The fastest the background poller will poll the bridge. (default: 250)
+##  poll_max_ms  -- Optional:  Integer - The slowest the background poller will poll the bridge. (default: 5000)
+##
+## The recorder starts the first time a backend uses this table (or a sensors table with "record_history 'true'"),
+## and only remembers what happens while that backend is alive.
+##
+## Columns:
+##   sensor_id    smallint
+##   state_key    varchar             -- eg. presence, temperature, lightlevel, daylight, buttonevent
+##   recorded_at  timestamp           -- UTC, the sensor's state.lastupdated
+##   value        double precision    -- booleans are 1 and 0
+##
+## "sensor_id = N" (or "sensor_id in (...)") and ranges on recorded_at are used to pick out what we look at,
+## rather than just filtering what we return.
+##
+class HueSensorHistoryFDW(ForeignDataWrapper):
+
+    """
+    Philips Hue Sensor History Foreign Data Wrapper for PostgreSQL
+    """
+
+    def __init__(self, options, columns):
+
+        super(HueSensorHistoryFDW, self).__init__(options, columns)
+
+        log_to_postgres('Hue Sensor History options:  %s' % options, DEBUG)
+        log_to_postgres('Hue Sensor History columns:  %s' % columns, DEBUG)
+
+        if options.has_key('bridge'):
+            self.bridge = options['bridge']
+        else:
+            log_to_postgres('bridge IP address is required for Hue Sensor History setup.', ERROR)
+
+        if options.has_key('username'):
+            self.userName = options['username']
+        else:
+            self.userName = 'postgreshue'
+            log_to_postgres('Using Default Username for Hue Sensor History setup:  postgreshue.', WARNING)
+
+        self.hueBridge = getBridge(self.bridge, options)
+
+        # Start recording (if we aren't already):
+        self.recorder = getRecorder(self.hueBridge, self.userName, options)
+
+        # The columns we'll be using (defaults to 'all'):
+        self.columns = columns
+
+        # Where each column sits in the rows we hand back:
+        self.columnIndex = dict([(column, i) for i, column in enumerate(columns)])
+
+        # Which field of a recorded (sensor_id, state key, time, value) each column comes from:
+        self.columnFields = { 'sensor_id'   : 0,
+                              'state_key'   : 1,
+                              'recorded_at' : 2,
+                              'value'       : 3 }
+
+
+    ############
+    # Query planning:
+    def get_rel_size(self, quals, columns):
+
+        rows = sum([buffer.count for buffer in self.recorder.buffers.values()])
+
+        return (max(rows, 1), 8 * len(columns))
+
+
+    ############
+    # SQL SELECT:
+    # Everything we've recorded (that the quals let through), oldest first for each sensor value.
+    def execute(self, quals, columns):
+
+        log_to_postgres('Hue Sensor History Query Columns:  %s' % columns, DEBUG)
+        log_to_postgres('Hue Sensor History Query Filters:  %s' % quals, DEBUG)
+
+        try:
+            rowMatches = compileQuals(quals, self.columnIndex)
+
+        except unknownOperatorException, e:
+            log_to_postgres(e, ERROR)
+
+        # Keep count of the rows we look at and hand back (see hueStats.py):
+        scanCost = hueStats.ScanCost('sensor_history', [self.bridge])
+        rowMatches = scanCost.countRows(self.bridge, rowMatches)
+
+        if self.recorder.lastError is not None:
+            log_to_postgres('Hue Sensor History poller is having trouble with the bridge %s: %s' % (self.bridge, self.recorder.lastError), WARNING)
+
+        # Narrow down which buffers, and which part of each buffer, we need to look at:
+        sensorIDs = None
+        lower = None
+        upper = None
+
+        for qual in quals:
+
+            if qual.field_name == 'sensor_id' and qual.value is not None:
+                if qual.is_list_operator and qual.operator == ('=', True):
+                    sensorIDs = set([int(value) for value in qual.value])
+                elif qual.operator == '=':
+                    sensorIDs = set([int(qual.value)])
+
+            elif qual.field_name == 'recorded_at' and isinstance(qual.value, datetime.datetime):
+                when = float(calendar.timegm(qual.value.utctimetuple()))
+                if qual.operator in ['>', '>=', '=']:
+                    lower = when if lower is None else max(lower, when)
+                if qual.operator in ['<', '<=', '=']:
+                    upper = when if upper is None else min(upper, when)
+
+        fields = [self.columnFields.get(column) for column in self.columns]
+
+        try:
+
+            for entry in self.recorder.history(sensorIDs, lower, upper):
+
+                entry = (entry[0], entry[1], datetime.datetime.utcfromtimestamp(entry[2]), entry[3])
+
+                # Rows are lists in table column order.
+                row = [None if field is None else entry[field] for field in fields]
+
+                # The bounds above are inclusive, so we still check ">" and "<" (and anything else) here:
+                if rowMatches(row):
+                    yield row
+
+        finally:
+
+            # Add this scan's rows to the stats (see hueStats.py):
+            scanCost.finish()
+
+
+    ############
+    # SQL INSERT:
+    def insert(self, new_values):
+
+        log_to_postgres('Hue Sensor History Insert Request Ignored - the history is read only - requested values:  %s' % new_values, WARNING)
+
+
+    ############
+    # SQL UPDATE:
+    def update(self, old_values, new_values):
+
+        log_to_postgres('Hue Sensor History Update Request Ignored - the history is read only - new values:  %s' % new_values, WARNING)
+
+
+    ############
+    # SQL DELETE
+    def delete(self, old_values):
+
+        log_to_postgres('Hue Sensor History Delete Request Ignored - the history is read only - old values:  %s' % old_values, WARNING)
@@ -3,38 +3,68 @@
 ##
 ## We set up these endpoints:
 ##   * Lights
+##   * Config
 ##   * Sensors
-##   * Sensors
+##   * Groups
+##   * Scenes
+##   * Schedules
+##   * Rules
 ## as separate classes since they have very different structures and purposes.
 ## 
-## Rules, Scenes, and Groups are not yet implemented.
-##
 ## Each of these FDW classes is in a different file.
 ## This file has the one for the * Sensors * endpoint in it.
 ##
 ## R.Otten - 2015
 ################################################################################################################
 
-from collections import OrderedDict
 import json
 
 from multicorn import ForeignDataWrapper
 from multicorn.utils import log_to_postgres, ERROR, WARNING, DEBUG
 
-import requests
+from operatorFunctions import unknownOperatorException, compileQuals, getEqualityValue, getEqualityValues
+from hueBridge import hueBridgeException, getBridges, DEFAULT_FULLSTATE_TTL_MS
+from commandDispatch import dispatchAsCompleted
+import hueStats
+from explainScan import explainScan, plannedRequest, pushedQuals
+from jsonCache import SerializationCache
+from eventStream import getEventStream
+from commandScheduler import Command, CommandBuffer
+from hue_errors import describeErrors
+from sensorHistory import getRecorder
+from sensorTypes import sensorTypeColumns, noneStringColumns, noneToNull, findSensorType
 
-from operatorFunctions import unknownOperatorException, getOperatorFunction
+
+## Our row estimate before we've seen the bridge -- the Daylight sensor plus a few switches and motion sensors:
+DEFAULT_ESTIMATED_SENSORS = 10
 
 
 ##############################################
 ## The Foreign Data Wrapper Class for Sensors:
 ##
 ## Options:
-##  bridge   -- Required:  The IP address for the Hue Bridge
+##  bridge   -- Required:  The IP address for the Hue Bridge.  Or several, separated by commas, for one table
+##              that spans them all.  Their sensors are fetched concurrently, and the "bridge" column says which
+##              bridge each sensor is on.  (With more than one bridge, UPDATE finds sensors by unique_id.)
 ##  username -- Required:  The API user name - configured when the bridge is set up 
 ##              (see http://www.developers.meethue.com/documentation/getting-started )
+##              With several bridges, either one name for all of them or a comma separated list in the same order.
 ##  hueid    -- Optional:  The Hue system ID - not used at this time
 ##  kvtype   -- Optional:  json or hstore - Whether nested KV data returns JSON format or HSTORE format. (default:  json)
+##  pool_size, pool_idle_timeout -- Optional:  Connection pool settings for the bridge.  (see hueBridge.py)
+##  max_commands_per_sec -- Optional:  Rate limit for the commands we send the bridge.  (see hueBridge.py)
+##  cache_ttl_ms -- Optional:  Integer - Milliseconds a scan may reuse the last response from the bridge. (default: 0)
+##  fetch_mode   -- Optional:  endpoint or fullstate - Whether a scan GETs just sensors, or the whole bridge datastore
+##                  (which refreshes every Hue table's snapshot at once). (default: endpoint)
+##  event_stream -- Optional:  true or false - Keep a live copy of the sensors from the bridge's event stream and answer scans
+##                  from it, going back to polling whenever the stream is down.  (see eventStream.py) (default: false)
+##  event_stream_url -- Optional:  Override where the event stream is.  Only for a single bridge.  (default: https://<bridge>/eventstream/clip/v2)
+##  sensor_type  -- Optional:  Limit the table to one type of sensor (eg. Daylight, ZLLPresence, ZLLTemperature, ZLLLightLevel),
+##                  and flatten that type's config and state out into typed columns.  (see sensorTypes.py for the column names)
+##  record_history -- Optional:  true or false - Start the background sensor history recorder for this bridge as soon as
+##                  the table is used, rather than waiting for a sensor history table to be queried.  (see HueSensorHistoryFDW.py) (default: false)
+##  transactional  -- Optional:  true or false - Hold changes back until the transaction commits, merging repeated changes
+##                  to a sensor into one command, and sending nothing on rollback.  (default: false)
 ##
 ## ** We do not yet support creating new sensors with this foreign data wrapper. **
 ##
@@ -62,7 +92,53 @@ class HueSensorsFDW(ForeignDataWrapper):
             self.userName = 'postgreshue'
             log_to_postgres('Using Default Username for Hue Sensors setup:  postgreshue.', WARNING)
 
-        self.baseURL = 'http://' + self.bridge + "/api/" + self.userName + "/sensors/"
+        # All of the Hue wrappers in this backend share one pooled connection to each bridge.
+        # A list of (HueBridge, username) pairs -- usually just the one:
+        try:
+            self.hueBridges = getBridges(options, self.userName)
+
+        except hueBridgeException, e:
+            log_to_postgres('Invalid bridge setup for Hue Sensors: %s' % e, ERROR)
+
+        # bridge address -> (HueBridge, username)
+        self.bridgeUsers = dict([(hueBridge.bridge, (hueBridge, userName)) for hueBridge, userName in self.hueBridges])
+
+        # Either GET just our own endpoint, or the whole datastore so the other Hue tables can share the response:
+        if options.has_key('fetch_mode'):
+            if options['fetch_mode'].lower() in ['endpoint', 'fullstate']:
+                self.fetchMode = options['fetch_mode'].lower()
+            else:
+                log_to_postgres('Invalid Fetch Mode for Hue Sensors setup: %s. (Choose "endpoint" or "fullstate")' % options['fetch_mode'], ERROR)
+        else:
+            self.fetchMode = 'endpoint'
+
+        # Scans within this many seconds of the last one are answered from the bridge snapshot:
+        if options.has_key('cache_ttl_ms'):
+            self.cacheTTL = float(options['cache_ttl_ms']) / 1000
+        elif self.fetchMode == 'fullstate':
+            self.cacheTTL = float(DEFAULT_FULLSTATE_TTL_MS) / 1000
+        else:
+            self.cacheTTL = 0
+
+        # Have the bridge tell us about changes instead of asking it on every scan:
+        if options.has_key('event_stream'):
+            if options['event_stream'].lower() in ['true', 'false']:
+                useEventStream = options['event_stream'].lower() == 'true'
+            else:
+                log_to_postgres('Invalid Event Stream setting for Hue Sensors setup: %s. (Choose "true" or "false")' % options['event_stream'], ERROR)
+        else:
+            useEventStream = False
+
+        if useEventStream and len(self.hueBridges) > 1 and options.has_key('event_stream_url'):
+            log_to_postgres('event_stream_url can only be used with a single bridge in Hue Sensors setup.', ERROR)
+
+        # bridge address -> its event stream (or None)
+        self.eventStreams = {}
+        for hueBridge, userName in self.hueBridges:
+            if useEventStream:
+                self.eventStreams[hueBridge.bridge] = getEventStream(hueBridge, userName, options)
+            else:
+                self.eventStreams[hueBridge.bridge] = None
 
         # We don't really use this anywhere.  Including it for now in case it ends up having a use.
         if options.has_key('hueid'):
@@ -81,13 +157,61 @@ class HueSensorsFDW(ForeignDataWrapper):
         else:
             self.kvType = 'json'
 
+        # The nested objects hardly ever change, so we keep the json we made for them last time:
+        self.jsonCache = SerializationCache()
+
+        # What the last scan cost, for EXPLAIN VERBOSE (see explainScan.py):
+        self.lastScan = None
+
+        # Send our changes at the end of each statement, or hold them until the transaction commits:
+        if options.has_key('transactional'):
+            if options['transactional'].lower() in ['true', 'false']:
+                self.transactional = options['transactional'].lower() == 'true'
+            else:
+                log_to_postgres('Invalid Transactional setting for Hue Sensors setup: %s. (Choose "true" or "false")' % options['transactional'], ERROR)
+        else:
+            self.transactional = False
+
+        # bridge address -> the commands this transaction is holding for it
+        self.transactionCommands = dict([(hueBridge.bridge, CommandBuffer()) for hueBridge, userName in self.hueBridges])
+
+        # Keep a history of sensor changes in the background:
+        if options.has_key('record_history'):
+            if options['record_history'].lower() in ['true', 'false']:
+                if options['record_history'].lower() == 'true':
+                    for hueBridge, userName in self.hueBridges:
+                        getRecorder(hueBridge, userName, options)
+            else:
+                log_to_postgres('Invalid Record History setting for Hue Sensors setup: %s. (Choose "true" or "false")' % options['record_history'], ERROR)
+
+        # A table for just one type of sensor can have that type's config and state as ordinary columns:
+        if options.has_key('sensor_type'):
+            self.sensorType = findSensorType(options['sensor_type'])
+            if self.sensorType is None:
+                log_to_postgres('Invalid Sensor Type for Hue Sensors setup: %s. (Choose one of: %s)' % (options['sensor_type'], ', '.join(sorted(sensorTypeColumns.keys()))), ERROR)
+            self.typedColumns = sensorTypeColumns[self.sensorType]
+        else:
+            self.sensorType = None
+            self.typedColumns = {}
+
         ###
         # Make note of the "primary key" column to support updates.
-        self._row_id_column = 'sensor_id'
+        # sensor_id is only unique on one bridge.  Across several we use unique_id, and the scans remember
+        # which bridge and sensor_id each one belongs to.  (The CLIP and Daylight sensors don't have one.)
+        if len(self.hueBridges) > 1:
+            self._row_id_column = 'unique_id'
+        else:
+            self._row_id_column = 'sensor_id'
+
+        # unique_id -> (bridge address, sensor_id)
+        self.scannedRowIDs = {}
 
         # The columns we'll be using (defaults to 'all'):
         self.columns = columns
 
+        # Where each column sits in the rows we hand back:
+        self.columnIndex = dict([(column, i) for i, column in enumerate(columns)])
+
         # These are the only columns we are going to allow to be updated:
         # Although the API documentation shows 'name' as being mutable in their example, it actually isn't in our test rig.
         self.mutable_columns = []
@@ -104,6 +228,11 @@ class HueSensorsFDW(ForeignDataWrapper):
                               'config'           : 'config',
                               'state'            : 'state' }
 
+        # Rough widths (in bytes) of each column, for the planner.  Anything not listed is a short string.
+        self.columnWidths = { 'sensor_id' : 2,
+                              'config'    : 120,
+                              'state'     : 80 }
+
 
     ############
     # We need to overload this function so Updates will work
@@ -112,93 +241,247 @@ class HueSensorsFDW(ForeignDataWrapper):
         return self._row_id_column
 
 
+    ############
+    # Query planning:
+    # Tell PostgreSQL about how many rows (and how wide) a scan will produce, so it can plan joins sensibly.
+    # We count whatever we last saw from the bridge rather than asking it again just to plan.
+    def get_rel_size(self, quals, columns):
+
+        hueBridges = self.scanBridges(quals)
+
+        if getEqualityValue(quals, 'sensor_id') is not None:
+            rows = len(hueBridges)
+        else:
+            rows = 0
+            for hueBridge, userName in hueBridges:
+                sensors = hueBridge.lastSnapshot(userName, 'sensors')
+                if sensors is None:
+                    rows += DEFAULT_ESTIMATED_SENSORS
+                elif self.sensorType is not None:
+                    rows += len([sensor for sensor in sensors.values() if sensor.get('type') == self.sensorType])
+                else:
+                    rows += len(sensors)
+
+        return (rows, sum([self.columnWidths.get(column, 16) for column in columns]))
+
+
+    ############
+    # A scan with sensor_id given can be the inner side of a nested loop join, looked up once per outer row.
+    # That is only cheap if the lookups come out of our snapshot (see hueBridge.resource()) or a live event stream.
+    # Otherwise each one would be a round trip to the bridge, so we leave the planner to scan the table once and
+    # hash join instead.
+    def get_path_keys(self):
+
+        eventStreams = self.eventStreams.values()
+        if self.cacheTTL <= 0 and (None in eventStreams or not all([eventStream.live for eventStream in eventStreams])):
+            return []
+
+        if len(self.hueBridges) > 1:
+            return [(('sensor_id',), len(self.hueBridges)), (('bridge', 'sensor_id'), 1)]
+
+        return [(('sensor_id',), 1)]
+
+
+    ############
+    # EXPLAIN:  what a scan would ask each bridge for, and which quals narrow it.  (see explainScan.py)
+    # In fullstate mode, or with a cache, sensor_id doesn't narrow the request -- we get the whole datastore (or endpoint) either way.
+    def explain(self, quals, columns, sortkeys=None, verbose=False):
+
+        fullState = self.fetchMode == 'fullstate'
+        sensorID = getEqualityValue(quals, 'sensor_id')
+
+        requests = []
+        for hueBridge, userName in self.scanBridges(quals):
+            requests.append((hueBridge.bridge, plannedRequest(hueBridge, userName, 'sensors', sensorID, self.cacheTTL, fullState,
+                                                               self.eventStreams[hueBridge.bridge])))
+
+        pushed = pushedQuals(quals, None if fullState or self.cacheTTL > 0 else 'sensor_id')
+
+        lines = explainScan(requests, pushed, quals, columns, self.lastScan, verbose)
+
+        # A table for one type of sensor also skips the others before it tests any quals:
+        if self.sensorType is not None:
+            lines.append('Sensor type:  only %s sensors' % self.sensorType)
+
+        return lines
+
+
+    ############
+    # The bridges a scan has to ask.  "where bridge = ..." (or "bridge in (...)") leaves the others out.
+    def scanBridges(self, quals):
+
+        wanted = getEqualityValues(quals, 'bridge')
+
+        if wanted is None:
+            return self.hueBridges
+
+        return [(hueBridge, userName) for hueBridge, userName in self.hueBridges if hueBridge.bridge in wanted]
+
+
+    ############
+    # Work out, once per scan, how to pull each table column out of a sensor.
+    # Multicorn wants a sequence row to have a value for every column of the table, in table order,
+    # so the columns the query didn't ask for just get None.
+    # With several bridges we compile a set for each of them.
+    def compileExtractors(self, columns, bridge):
+
+        extractors = []
+
+        for column in self.columns:
+
+            if column not in columns:
+                extractors.append(lambda sensorID, sensor: None)
+
+            elif column == 'sensor_id':
+                extractors.append(lambda sensorID, sensor: int(sensorID))
+
+            elif column == 'bridge':
+                extractors.append(lambda sensorID, sensor: bridge)
+
+            # One of our sensor type's flattened config or state values:
+            elif column in self.typedColumns:
+                section, key = self.typedColumns[column]
+                if column in noneStringColumns:
+                    extractors.append(lambda sensorID, sensor, section=section, key=key: noneToNull(sensor[section].get(key)))
+                else:
+                    extractors.append(lambda sensorID, sensor, section=section, key=key: sensor[section].get(key))
+
+            elif column in ['config', 'state']:
+                # HSTORE Column Type:
+                if self.kvType == 'hstore':
+                    extractors.append(lambda sensorID, sensor, key=self.columnKeyMap[column]: sensor[key])
+                # JSON Column Type:
+                else:
+                    extractors.append(lambda sensorID, sensor, key=self.columnKeyMap[column]: self.jsonCache.dumps((key, bridge, sensorID), sensor[key]))
+
+            # Not all sensors have these two values:
+            elif column in ['software_version', 'unique_id']:
+                extractors.append(lambda sensorID, sensor, key=self.columnKeyMap[column]: sensor.get(key))
+
+            else:
+                extractors.append(lambda sensorID, sensor, key=self.columnKeyMap[column]: sensor[key])
+
+        return tuple(extractors)
+
+
     ############
     # SQL SELECT:
-    # We get back all of the lights we can find and roll them up into rows
+    # We get back all of the sensors we can find and roll them up into rows
     def execute(self, quals, columns):
 
         log_to_postgres('Hue Sensors Query Columns:  %s' % columns, DEBUG)
         log_to_postgres('Hue Sensors Query Filters:  %s' % quals, DEBUG)
 
-        results = requests.get(self.baseURL)
+        # Work out how to test each row once, up front.
+        # An operator we can't handle fails here, before we fetch anything.
+        try:
+            rowMatches = compileQuals(quals, self.columnIndex)
+
+        except unknownOperatorException, e:
+            log_to_postgres(e, ERROR)
+
+        # "where sensor_id = N" only needs /sensors/N.  (In fullstate mode the shared datastore GET is the cheaper way to go.)
+        # We still run all of the quals over whatever comes back, so the results are the same either way.
+        sensorID = getEqualityValue(quals, 'sensor_id')
+
+        hueBridges = self.scanBridges(quals)
+
+        # What this scan costs, for EXPLAIN VERBOSE:
+        scanCost = hueStats.ScanCost('sensors', [hueBridge.bridge for hueBridge, userName in hueBridges])
+        self.lastScan = scanCost
+
+        # Every bridge is asked at once, and each one's rows go out as soon as its sensors arrive.
+        fetch = lambda (hueBridge, userName): self.fetchSensors(hueBridge, userName, sensorID)
 
         try:
 
-            hueResults = json.loads(results.text)
+            for (hueBridge, userName), hueResults, e in dispatchAsCompleted(fetch, hueBridges, len(hueBridges)):
 
-        except:
+                if isinstance(e, hueBridgeException):
+                    log_to_postgres('%s' % e, ERROR)
+                elif e is not None:
+                    raise e
 
-            log_to_postgres('Unexpected (non-JSON) response from the Hue Bridge: %s' % self.bridge, ERROR)
-            log_to_postgres('%s' % e, ERROR)
-            log_to_postgres('%s' % results, ERROR)
+                # If the bridge didn't answer and serve_stale is on, we're looking at an old snapshot:
+                for warning in hueBridge.takeWarnings():
+                    log_to_postgres(warning, WARNING)
 
+                # If the event stream is down we've just polled instead.  Say why it is down:
+                eventStream = self.eventStreams[hueBridge.bridge]
+                if eventStream is not None and not eventStream.live and eventStream.lastError is not None:
+                    log_to_postgres('Hue Sensors event stream from the bridge %s is down, so we are polling: %s' % (hueBridge.bridge, eventStream.lastError), WARNING)
 
-        for sensor in hueResults.keys():
+                scanCost.update()
 
-            row = OrderedDict()
+                extractors = self.compileExtractors(columns, hueBridge.bridge)
 
-            ## add the requested columns to the output:
-            for column in columns:
+                # Keep count of the rows we look at and hand back (see hueStats.py):
+                bridgeRowMatches = scanCost.countRows(hueBridge.bridge, rowMatches)
 
-                # Not all sensors have these two values:
-                if column == 'software_version' and not hueResults[sensor].has_key(self.columnKeyMap[column]):
-                    row[column] = None
-                    continue
- 
-                if column == 'unique_id' and not hueResults[sensor].has_key(self.columnKeyMap[column]):
-                    row[column] = None
-                    continue
- 
-                if column == 'sensor_id':
-                    row['sensor_id'] = int(sensor)
-        
-                elif column in ['config', 'state']:
-                    # HSTORE Column Type:
-                    if self.kvType == 'hstore':
-                        row[column] = hueResults[sensor][self.columnKeyMap[column]]
-                    # JSON Column Type:
-                    else:  
-                        row[column] = json.dumps(hueResults[sensor][self.columnKeyMap[column]])
-            
-                else:
-                    row[column] = hueResults[sensor][self.columnKeyMap[column]]
+                for sensorID, sensor in hueResults.items():
+
+                    # So an UPDATE by unique_id can find its way back to this sensor:
+                    if len(self.hueBridges) > 1 and sensor.get('uniqueid') is not None:
+                        self.scannedRowIDs[sensor['uniqueid']] = (hueBridge.bridge, sensorID)
+
+                    # A table for one type of sensor skips the rest before we do any work on them:
+                    if self.sensorType is not None and sensor.get('type') != self.sensorType:
+                        continue
+
+                    # Rows are lists in table column order.
+                    row = [extract(sensorID, sensor) for extract in extractors]
 
-            ## decide if this is a row we should return or not:
+                    ## decide if this is a row we should return or not:
 
-            # Unfortunately the Hue API doesn't have much in the way of filtering when you get the data.
-            # So we do it here.
-            # There aren't really going to be all that many rows that we'll be throwing away so we should be ok.
-            goodRow = True
-            for qual in quals:
+                    # Unfortunately the Hue API doesn't have much in the way of filtering when you get the data.
+                    # So we do it here.
+                    # There aren't really going to be all that many rows that we'll be throwing away so we should be ok.
+                    if bridgeRowMatches(row):
 
-                try:
-                    operatorFunction = getOperatorFunction(qual.operator)
+                        yield row
 
-                except unknownOperatorException, e:
-                    log_to_postgres(e, ERROR)
+        finally:
 
-                # The SQL parser should have caught if the where clause referenced a column we aren't selecting.
-                # If it didn't, we'll just let this next statement throw an exception (rather than trying to handle it).
-                if not operatorFunction(row[qual.field_name], qual.value):
+            # Add this scan's rows to the stats (see hueStats.py):
+            scanCost.finish()
 
-                    # this column  didn't match.  Drop out and then move to the next row
-                    goodRow = False
-                    break
 
-            if goodRow:
+    ############
+    # One bridge's sensors for a scan.
+    # With several bridges this runs on a dispatch worker thread (see commandDispatch.py), so it mustn't log anything.
+    def fetchSensors(self, hueBridge, userName, sensorID):
+
+        eventStream = self.eventStreams[hueBridge.bridge]
+
+        # While the event stream is up our copy is already current:
+        if eventStream is not None and eventStream.live:
+            return eventStream.current('sensors', sensorID)
+
+        if sensorID is not None and self.fetchMode != 'fullstate':
+            return hueBridge.resource(userName, 'sensors', int(sensorID), self.cacheTTL)
 
-                yield row
+        return hueBridge.snapshot(userName, 'sensors', self.cacheTTL, self.fetchMode == 'fullstate')
 
 
 
     ############
     # SQL UPDATE:
-    ## -- we should consider implementing 'rollback' (and, necessarily, 'commit')
-    def update(self, sensorID, newValues):
+    # (see the "transactional" option for holding updates until commit)
+    def update(self, rowID, newValues):
 
-        log_to_postgres('Hue Sensors Update Request - sensor_id:  %s' % sensorID, DEBUG)
+        log_to_postgres('Hue Sensors Update Request - %s:  %s' % (self._row_id_column, rowID), DEBUG)
         log_to_postgres('Hue Sensors Update Request - new values:  %s' % newValues, DEBUG)
 
+        # Which bridge's sensor is this?
+        if len(self.hueBridges) > 1:
+            if rowID not in self.scannedRowIDs:
+                log_to_postgres('Hue Sensors Update Failed - unique_id %s is not a sensor on any of our bridges' % rowID, ERROR)
+            bridge, sensorID = self.scannedRowIDs[rowID]
+        else:
+            bridge, sensorID = self.hueBridges[0][0].bridge, rowID
+
+        hueBridge, userName = self.bridgeUsers[bridge]
+
         newState = {}
         for changedColumn in newValues.keys():
 
@@ -220,28 +503,107 @@ class HueSensorsFDW(ForeignDataWrapper):
 
                     newState[self.columnKeyMap[changedColumn]] = newValues[changedColumn]
 
-        log_to_postgres(self.baseURL + '%s -- ' % sensorID + json.dumps(newState), DEBUG)
+        log_to_postgres('Hue Sensors Update Queued - sensor_id %s -- %s' % (sensorID, json.dumps(newState)), DEBUG)
 
-        results = requests.put(self.baseURL + '%s' % sensorID, json.dumps(newState))
-        
-        try:
+        command = Command('sensors/%s' % sensorID, newState)
+
+        # The bridge's command scheduler paces what we send.
+        if self.transactional:
+            self.transactionCommands[bridge].add(command)
+        else:
+            hueBridge.scheduler.submit(userName, command, self)
+
+
+    ############
+    # End of an INSERT/UPDATE/DELETE statement:
+    # Send the changes we queued up in update() -- unless we are holding them for the end of the transaction.
+    def end_modify(self):
+
+        if not self.transactional:
+            self.sendCommands()
+
+
+    ############
+    # Transactions:
+    # With "transactional" set, everything the transaction changed goes out just before it commits.
+    # An ERROR here aborts the commit.
+    def pre_commit(self):
+
+        if self.transactional:
+            for hueBridge, userName in self.hueBridges:
+                for command in self.transactionCommands[hueBridge.bridge].take():
+                    hueBridge.scheduler.submit(userName, command, self)
+            self.sendCommands()
+
+
+    # An UPDATE that failed part way through may also have left changes with the schedulers.  They mustn't go out
+    # with our next statement.
+    def rollback(self):
+        for transactionCommands in self.transactionCommands.values():
+            transactionCommands.discard()
+        for hueBridge, userName in self.hueBridges:
+            hueBridge.scheduler.discard(self)
+
+
+    def sub_begin(self, level):
+        for transactionCommands in self.transactionCommands.values():
+            transactionCommands.savepoint()
+
+
+    def sub_commit(self, level):
+        for transactionCommands in self.transactionCommands.values():
+            transactionCommands.release()
+
+
+    def sub_rollback(self, level):
+        for transactionCommands in self.transactionCommands.values():
+            transactionCommands.rollbackToSavepoint()
+        for hueBridge, userName in self.hueBridges:
+            hueBridge.scheduler.discard(self)
+
+
+    ############
+    # Send whatever the schedulers are holding, and check what each bridge made of it.
+    # The bridge answers each attribute separately, so we keep everything that worked and report
+    # everything that didn't together, at the end.
+    def sendCommands(self):
+
+        failures = []
+        errors = []
+
+        for hueBridge, userName in self.hueBridges:
+
+            for command, hueResults, e in hueBridge.scheduler.drain(1, self):
+
+                if e is not None:
+
+                    # We can't tell what the bridge did with our request, so don't trust our snapshot any more:
+                    hueBridge.invalidate(userName, 'sensors')
+                    failures.append('%s:  %s' % (command, e))
+                    continue
+
+                if not isinstance(hueResults, list):
+                    hueBridge.invalidate(userName, 'sensors')
+                    errors.append({'address': '/' + command.address, 'description': 'unexpected response %s' % hueResults})
+                    continue
+
+                for status in hueResults:
+
+                    # Keep our snapshot in step with what the bridge says it changed:
+                    if status.has_key('success'):
 
-            hueResults = json.loads(results.text)
+                        hueBridge.applySuccess(userName, status['success'])
 
-        except Exception, e:
+                    else:
 
-            log_to_postgres('Unexpected (non-JSON) response from the Hue Bridge: %s' % self.bridge, ERROR)
-            log_to_postgres('%s' % e, ERROR)
-            log_to_postgres('%s' % results, ERROR)
-    
+                        log_to_postgres('Hue Sensors Full Results: %s' % hueResults, DEBUG)
+                        errors.append(status.get('error', {'address': '/' + command.address, 'description': '%s' % status}))
 
-        for status in hueResults:
+        failures.extend(describeErrors(errors))
 
-              if not status.has_key('success'):
+        if failures:
+            log_to_postgres('Hue Sensors Column Update Failed:  %s' % '; '.join(failures), ERROR)
 
-                    log_to_postgres('Hue Sensors Full Results: %s' % results.text, DEBUG)
-                    log_to_postgres('Hue Sensors Column Update Failed.', ERROR)
-            
 
     ############
     # SQL INSERT:
@@ -0,0 +1,132 @@
+################################################################################################################
+## This is the implementation of the Multicorn ForeignDataWrapper class as an interface to the Philips Hue system
+##
+## We set up these endpoints:
+##   * Lights
+##   * Config
+##   * Sensors
+##   * Groups
+##   * Scenes
+##   * Schedules
+##   * Rules
+## as separate classes since they have very different structures and purposes.
+##
+## Each of these FDW classes is in a different file.
+## This file has the one for * Stats * in it.  It isn't a bridge endpoint:  it shows what the other Hue tables
+## in this database session have cost the bridges, and what they did with what came back (see hueStats.py).
+##
+################################################################################################################
+
+import datetime
+import json
+
+from multicorn import ForeignDataWrapper
+from multicorn.utils import log_to_postgres, ERROR, WARNING, DEBUG
+
+from operatorFunctions import unknownOperatorException, compileQuals
+import hueStats
+
+
+##############################################
+## The Foreign Data Wrapper Class for Stats:
+##
+## Options:
+##   None.  The stats cover every bridge and Hue table this database session has used.
+##
+## Columns:
+##   bridge       varchar             -- The bridge address
+##   metric       varchar             -- requests, request_errors, bytes_received, json_decode, cache_hits, cache_misses,
+##                                       scans, rows_fetched, rows_returned, commands_sent, command_retries
+##                                       (see hueStats.py for what each one counts)
+##   scope        varchar             -- The endpoint (lights, sensors, ..., datastore) or, for the scan metrics, the table's wrapper
+##   method       varchar             -- The HTTP method, for the request metrics
+##   count        bigint              -- How many times it happened
+##   total        double precision    -- The sum of the values (seconds, bytes, ...)
+##   minimum      double precision
+##   maximum      double precision
+##   mean         double precision
+##   p50, p90, p99  double precision  -- Percentiles, for the timings (in seconds).  Estimated from the histogram buckets.
+##   histogram    json                -- The timing histogram:  how many took at most each number of seconds.
+##   since        timestamp           -- UTC, when this session started counting
+##
+class HueStatsFDW(ForeignDataWrapper):
+
+    """
+    Philips Hue Stats Foreign Data Wrapper for PostgreSQL
+    """
+
+    def __init__(self, options, columns):
+
+        super(HueStatsFDW, self).__init__(options, columns)
+
+        log_to_postgres('Hue Stats options:  %s' % options, DEBUG)
+        log_to_postgres('Hue Stats columns:  %s' % columns, DEBUG)
+
+        # The columns we'll be using (defaults to 'all'):
+        self.columns = columns
+
+        # Where each column sits in the rows we hand back:
+        self.columnIndex = dict([(column, i) for i, column in enumerate(columns)])
+
+
+    ############
+    # Query planning:
+    # About a dozen metrics for each endpoint we've used.
+    def get_rel_size(self, quals, columns):
+
+        rows, since = hueStats.snapshot()
+
+        return (max(len(rows), 1), 8 * len(columns))
+
+
+    ############
+    # SQL SELECT:
+    def execute(self, quals, columns):
+
+        log_to_postgres('Hue Stats Query Columns:  %s' % columns, DEBUG)
+        log_to_postgres('Hue Stats Query Filters:  %s' % quals, DEBUG)
+
+        try:
+            rowMatches = compileQuals(quals, self.columnIndex)
+
+        except unknownOperatorException, e:
+            log_to_postgres(e, ERROR)
+
+        stats, since = hueStats.snapshot()
+
+        since = datetime.datetime.utcfromtimestamp(since)
+
+        for stat in sorted(stats, key=lambda stat: (stat['bridge'], stat['metric'], stat['scope'], stat['method'])):
+
+            stat['since'] = since
+
+            if stat['histogram'] is not None:
+                stat['histogram'] = json.dumps(stat['histogram'])
+
+            # Rows are lists in table column order.
+            row = [stat.get(column) if column in columns else None for column in self.columns]
+
+            if rowMatches(row):
+
+                yield row
+
+
+    ############
+    # SQL INSERT:
+    def insert(self, new_values):
+
+        log_to_postgres('Hue Stats Insert Request Ignored - the stats are read only - requested values:  %s' % new_values, WARNING)
+
+
+    ############
+    # SQL UPDATE:
+    def update(self, old_values, new_values):
+
+        log_to_postgres('Hue Stats Update Request Ignored - the stats are read only - new values:  %s' % new_values, WARNING)
+
+
+    ############
+    # SQL DELETE
+    def delete(self, old_values):
+
+        log_to_postgres('Hue Stats Delete Request Ignored - the stats are read only - old values:  %s' % old_values, WARNING)
@@ -0,0 +1,114 @@
+## What we do about a bridge that has stopped answering.
+##
+## A bridge that is unplugged, rebooting, or off the network usually doesn't refuse our connections, it just never
+## answers.  The request timeouts (see hueBridge.py) stop any one request from hanging the backend, but every query
+## that touches a Hue table would still sit through them -- and through the retries after them.
+## So each bridge has a circuit breaker:
+##   * closed    -- the usual state.  Requests go through.  Once breaker_failures requests in a row have failed
+##                  (each after all of its retries), the breaker opens.
+##   * open      -- requests fail straight away, without trying the bridge, for breaker_reset_ms.
+##   * half open -- after that, one request is let through to see whether the bridge is back.  If it gets an answer
+##                  the breaker closes again.  If not, it opens for another breaker_reset_ms.
+##
+## Requests come from the backend's own thread, the dispatch workers, and the background pollers, so it is locked.
+##
+## Here too is how long we wait before trying something again (see retryDelay()).
+##
+
+import random
+import threading
+import time
+
+
+## However many retries are asked for, we never wait longer than this before one:
+MAX_RETRY_DELAY = 2
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, failureThreshold, resetTimeout):
+
+        # A failureThreshold of 0 means never open:
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+
+        # Requests in a row that got no answer:
+        self.failures = 0
+
+        # When we opened, or None while we're closed:
+        self.openedAt = None
+
+        # Whether the one half open request is out:
+        self.trialRunning = False
+
+        self._lock = threading.Lock()
+
+
+    ############
+    # The most recent "create server" options win.
+    def configure(self, failureThreshold, resetTimeout):
+
+        with self._lock:
+            self.failureThreshold = failureThreshold
+            self.resetTimeout = resetTimeout
+
+
+    ############
+    # May a request go to the bridge now?
+    def allow(self):
+
+        with self._lock:
+
+            if self.openedAt is None:
+                return True
+
+            if self.trialRunning or time.time() - self.openedAt < self.resetTimeout:
+                return False
+
+            # Half open:
+            self.trialRunning = True
+            return True
+
+
+    ############
+    # The bridge answered (whatever it said).
+    def succeeded(self):
+
+        with self._lock:
+            self.failures = 0
+            self.openedAt = None
+            self.trialRunning = False
+
+
+    ############
+    # A request got no answer, even after its retries.
+    def failed(self):
+
+        with self._lock:
+
+            self.failures += 1
+
+            if self.trialRunning or (self.failureThreshold > 0 and self.failures >= self.failureThreshold):
+                self.openedAt = time.time()
+
+            self.trialRunning = False
+
+
+    ############
+    # Seconds until we'll try the bridge again (0 if we would now).
+    def retryIn(self):
+
+        with self._lock:
+
+            if self.openedAt is None:
+                return 0
+
+            return max(0, self.resetTimeout - (time.time() - self.openedAt))
+
+
+################################################################################
+## How long to wait before retry number attempt (1, 2, ...):  a random time up to backoff, doubling each time.
+## The randomness keeps several backends from all trying a struggling bridge again at the same moment.
+def retryDelay(attempt, backoff):
+
+    return random.uniform(0, min(MAX_RETRY_DELAY, backoff * 2 ** (attempt - 1)))
@@ -0,0 +1,101 @@
+## A small bounded worker pool for sending several commands to a bridge at once.
+##
+## Each light command is a separate HTTP round trip, and most of that time is spent waiting on the bridge.
+## Sending them from a few threads means a statement takes about as long as its slowest command,
+## rather than the sum of all of them.
+## The same goes for a table that spans several bridges: we ask all of them at once (see dispatchAsCompleted()).
+##
+## The workers only do the HTTP work.  Everything that touches PostgreSQL (log_to_postgres) or our shared
+## snapshots has to happen back on the backend's own thread, after dispatch() returns (or dispatchAsCompleted()
+## hands us the result).
+##
+
+import threading
+import Queue
+
+
+################################################################################
+## Call function(item) for every item, using at most maxWorkers threads.
+##
+## Returns a list, in the same order as items, of (result, exception) pairs -- exactly one of which is None.
+##
+def dispatch(function, items, maxWorkers):
+
+    results = [None] * len(items)
+
+    # Not worth starting threads for:
+    if maxWorkers <= 1 or len(items) <= 1:
+        for i, item in enumerate(items):
+            results[i] = _call(function, item)
+        return results
+
+    work = Queue.Queue()
+    for i, item in enumerate(items):
+        work.put((i, item))
+
+    def worker():
+        while True:
+            try:
+                i, item = work.get_nowait()
+            except Queue.Empty:
+                return
+            results[i] = _call(function, item)
+
+    threads = [threading.Thread(target=worker) for n in range(min(maxWorkers, len(items)))]
+
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+################################################################################
+## Like dispatch(), but yields (item, result, exception) for each item as soon as it is done,
+## so the caller can get on with the first answers while the slower ones are still out.
+##
+## The caller may stop early.  Whatever is still running then just finishes on its own.
+##
+def dispatchAsCompleted(function, items, maxWorkers):
+
+    if maxWorkers <= 1 or len(items) <= 1:
+        for item in items:
+            result, e = _call(function, item)
+            yield (item, result, e)
+        return
+
+    work = Queue.Queue()
+    for item in items:
+        work.put(item)
+
+    done = Queue.Queue()
+
+    def worker():
+        while True:
+            try:
+                item = work.get_nowait()
+            except Queue.Empty:
+                return
+            result, e = _call(function, item)
+            done.put((item, result, e))
+
+    for n in range(min(maxWorkers, len(items))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    for n in range(len(items)):
+        yield done.get()
+
+
+## Run one item, catching whatever it throws so the caller can report it:
+def _call(function, item):
+
+    try:
+        return (function(item), None)
+
+    except Exception, e:
+        return (None, e)
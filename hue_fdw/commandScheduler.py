@@ -0,0 +1,295 @@
+## The per-bridge command scheduler used by the Hue wrappers for everything they PUT to a bridge.
+##
+## The bridge can only process about 10 light commands a second (and about 1 group command a second).
+## Past that it starts delaying or dropping them, which is exactly what a multi-row UPDATE or a trigger
+## firing on every insert will do to it.  So every command goes through here:
+##   * Commands wait on a token bucket before they are sent -- one bucket for light (and other resource)
+##     commands, and a separate, smaller one for group commands.
+##     The buckets live in the backend, like the rest of our per-bridge state (see hueBridge.py).  Sessions don't
+##     share them, so several sessions sending commands at once can together send several times the rate.
+##   * The bridge answers each attribute of a PUT separately, and some of them can fail while the rest work.
+##     Attributes that failed for the bridge's own reasons (see hue_errors.transientErrors) are sent again,
+##     on their own, a couple of times.  Everything else is handed back for the wrapper to report.
+##
+## Each wrapper (and each lights update planner) has its own queue here, and drains only that.  One wrapper's
+## statement never sends, or reports the failures of, another's commands -- and a wrapper whose statement failed
+## drops what it had queued (see discard()), so nothing from an aborted statement goes out later.
+##
+## Every statement drains what it queued before it ends, so there is nothing here to merge.  Changes to the same
+## resource are merged before they get here:  by the lights' update planner (see updatePlanner.py) within a
+## statement, and by a CommandBuffer across the statements of a transaction (the wrappers' "transactional" option).
+##
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from commandDispatch import dispatch
+from circuitBreaker import retryDelay
+from hue_errors import isTransient
+import hueStats
+
+
+## The rates the bridge documentation recommends:
+DEFAULT_MAX_COMMANDS_PER_SEC = 10
+DEFAULT_MAX_GROUP_COMMANDS_PER_SEC = 1
+
+## How many more times we send the attributes the bridge failed with a transient error:
+MAX_COMMAND_RETRIES = 2
+
+
+################################################################################
+## One PUT we intend to send to the bridge.
+##
+##  address  -- The resource under /api/<username>/, eg. 'lights/3/state' or 'groups/0/action'
+##  payload  -- The state dict to send
+##  lightIDs -- The lights the command will change (used to keep the light snapshot in step with group commands)
+##  isGroup  -- True for group actions.  They come out of the (much smaller) group command budget.
+##
+class Command(object):
+
+    def __init__(self, address, payload, lightIDs=[], isGroup=False):
+        self.address = address
+        self.payload = payload
+        self.lightIDs = lightIDs
+        self.isGroup = isGroup
+
+    def __repr__(self):
+        return '%s -- %s' % (self.address, json.dumps(self.payload))
+
+
+################################################################################
+## Fold a newer command for the same resource into one that is still waiting to be sent (newer values win).
+def mergeCommands(waiting, command):
+
+    payload = dict(waiting.payload)
+    payload.update(command.payload)
+    lightIDs = sorted(set(waiting.lightIDs) | set(command.lightIDs))
+
+    return Command(command.address, payload, lightIDs, command.isGroup)
+
+
+################################################################################
+## Commands held back until the end of a transaction (see the "transactional" option on the wrappers).
+## Commands for the same resource are merged as they come in, so however many statements touch it,
+## a resource gets one command at commit.  Savepoints are kept as copies of what was pending when they were set.
+class CommandBuffer(object):
+
+    def __init__(self):
+
+        # address -> Command, in the order they were first buffered
+        self.pending = OrderedDict()
+        self.savepoints = []
+
+
+    def add(self, command):
+
+        if command.address in self.pending:
+            command = mergeCommands(self.pending[command.address], command)
+
+        self.pending[command.address] = command
+
+
+    ############
+    # Hand back everything we've buffered, and start over.
+    def take(self):
+
+        commands = self.pending.values()
+        self.discard()
+
+        return commands
+
+
+    def discard(self):
+        self.pending = OrderedDict()
+        self.savepoints = []
+
+
+    ############
+    # SAVEPOINT, RELEASE SAVEPOINT, and ROLLBACK TO SAVEPOINT:
+    def savepoint(self):
+        self.savepoints.append(OrderedDict(self.pending))
+
+    def release(self):
+        if self.savepoints:
+            self.savepoints.pop()
+
+    def rollbackToSavepoint(self):
+        if self.savepoints:
+            self.pending = self.savepoints.pop()
+
+
+################################################################################
+## A token bucket:  allows rate commands per second, with bursts of up to one second's worth.
+## A rate of 0 (or less) means no limit.
+class TokenBucket(object):
+
+    def __init__(self, rate):
+
+        self.rate = float(rate)
+        self.capacity = max(self.rate, 1)
+        self.tokens = self.capacity
+        self.lastFill = time.time()
+
+        # Several dispatch workers take tokens from the same bucket:
+        self.lock = threading.Lock()
+
+
+    ############
+    # Wait until we are allowed to send one more command.
+    def take(self):
+
+        if self.rate <= 0:
+            return
+
+        while True:
+
+            with self.lock:
+
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.lastFill) * self.rate)
+                self.lastFill = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+################################################################################
+## Queues and paces the commands for one bridge.
+class CommandScheduler(object):
+
+    def __init__(self, hueBridge, maxCommandsPerSec, maxGroupCommandsPerSec):
+
+        self.hueBridge = hueBridge
+        self.configure(maxCommandsPerSec, maxGroupCommandsPerSec)
+
+        # (owner, (username, address), Command), in the order they were queued.  The owner is the wrapper
+        # (or update planner) that queued the command, and the only one that can drain or discard it.
+        self.pending = []
+
+
+    ############
+    # The most recent "create server" options win.
+    def configure(self, maxCommandsPerSec, maxGroupCommandsPerSec):
+
+        if getattr(self, 'lightBucket', None) is None or self.lightBucket.rate != maxCommandsPerSec:
+            self.lightBucket = TokenBucket(maxCommandsPerSec)
+
+        if getattr(self, 'groupBucket', None) is None or self.groupBucket.rate != maxGroupCommandsPerSec:
+            self.groupBucket = TokenBucket(maxGroupCommandsPerSec)
+
+
+    ############
+    # Queue a command for owner, to go out with owner's next drain().
+    def submit(self, userName, command, owner):
+        self.pending.append((owner, (userName, command.address), command))
+
+
+    ############
+    # Forget the commands owner queued and hasn't drained (its statement or transaction was rolled back).
+    def discard(self, owner):
+        self.pending = [item for item in self.pending if item[0] is not owner]
+
+
+    ############
+    # Send everything owner has waiting, at most maxWorkers at a time and no faster than the buckets allow.
+    # Then send again whatever the bridge failed with a transient error, until it works or we run out of retries.
+    #
+    # Returns a list of (command, decoded response, exception) -- one of the last two will be None.
+    # The response is every answer we got for the command:  the successes from each try, and the errors that were left.
+    def drain(self, maxWorkers, owner):
+
+        queued = [(key, command) for (queuedBy, key, command) in self.pending if queuedBy is owner]
+        self.pending = [item for item in self.pending if item[0] is not owner]
+
+        results = [[command, hueResults, e] for ((key, command), (hueResults, e)) in zip(queued, dispatch(self._send, queued, maxWorkers))]
+
+        for attempt in range(1, MAX_COMMAND_RETRIES + 1):
+
+            # (position in results, (username, address), the part of the command to send again)
+            retries = []
+            for i, (key, command) in enumerate(queued):
+                command, hueResults, e = results[i]
+                if e is None:
+                    retry = retryCommand(command, hueResults)
+                    if retry is not None:
+                        retries.append((i, key, retry))
+
+            if not retries:
+                break
+
+            time.sleep(retryDelay(attempt, self.hueBridge.retryBackoff))
+
+            for i, key, retry in retries:
+                hueStats.count(self.hueBridge.bridge, 'command_retries', retry.address.split('/')[0])
+
+            for (i, key, retry), (hueResults, e) in zip(retries, dispatch(self._send, [(key, retry) for i, key, retry in retries], maxWorkers)):
+
+                # If the retry didn't get an answer at all, we leave the errors from the last one that did:
+                if e is None:
+                    results[i][1] = [status for status in results[i][1] if not isTransientStatus(status)] + hueResults
+
+        return [tuple(result) for result in results]
+
+
+    ############
+    # Send one queued command.  (This runs on the dispatch worker threads.)
+    def _send(self, item):
+
+        (userName, address), command = item
+
+        if command.isGroup:
+            self.groupBucket.take()
+        else:
+            self.lightBucket.take()
+
+        hueStats.count(self.hueBridge.bridge, 'commands_sent', command.address.split('/')[0])
+
+        return self.hueBridge.putCommand(userName, command)
+
+
+################################################################################
+## Is this answer from the bridge an error worth trying again?
+def isTransientStatus(status):
+    return isinstance(status, dict) and status.has_key('error') and isTransient(status['error'])
+
+
+################################################################################
+## The part of a command worth sending again, or None if nothing is.
+##
+## Each error's address ends with the attribute it is about ("/lights/3/state/bri"), so the retry only carries
+## the attributes that failed with a transient error, plus the transition time if there was one.
+## An error about the whole resource rather than one of its attributes means sending all of it again.
+def retryCommand(command, hueResults):
+
+    if not isinstance(hueResults, list):
+        return None
+
+    attributes = []
+
+    for status in hueResults:
+
+        if isTransientStatus(status):
+
+            attribute = (status['error'].get('address') or '').split('/')[-1]
+
+            if attribute not in command.payload:
+                return Command(command.address, command.payload, command.lightIDs, command.isGroup)
+
+            attributes.append(attribute)
+
+    if not attributes:
+        return None
+
+    payload = dict([(attribute, command.payload[attribute]) for attribute in attributes])
+
+    if 'transitiontime' in command.payload:
+        payload['transitiontime'] = command.payload['transitiontime']
+
+    return Command(command.address, payload, command.lightIDs, command.isGroup)
@@ -0,0 +1,327 @@
+## Event stream mode for the Hue Lights and Sensors FDWs.
+##
+## Newer bridges (API 1.48 and up) push every change they see as server-sent events on the CLIP v2 event stream:
+##    https://<bridge>/eventstream/clip/v2
+## Rather than polling /lights and /sensors, a background thread holds that stream open and applies each change
+## to our snapshots of the two endpoints as it arrives.  While the stream is up, scans are answered straight from
+## those snapshots without a request to the bridge at all.
+##
+## The stream speaks the v2 resource model, but our snapshots (and tables) are v1 shaped.  Every v2 resource that
+## has a v1 twin says so in its "id_v1" (eg. "/lights/3", "/sensors/5"), and the attributes we understand are
+## translated back into the v1 state and config keys.  Anything we can't translate (eg. buttons, whose v1
+## buttonevent codes can't be worked out from the v2 event alone) is re-fetched from the v1 API instead.
+##
+## If the stream drops we mark it down, the wrappers go back to polling, and we keep trying to reconnect
+## (backing off up to a minute between tries).  Each time it connects we re-fetch both endpoints before
+## calling it live again, since we can't know what we missed.
+##
+## Like the sensor history poller, this runs on its own thread, so it must never call log_to_postgres.
+## Its last error is kept in lastError instead, and the wrappers log it as a WARNING when a scan has to poll.
+##
+## Options (set per wrapper, on "create server" or "create foreign table"):
+##  event_stream     -- Optional:  true or false - Keep the snapshots current from the bridge's event stream. (default: false)
+##  event_stream_url -- Optional:  Where to find the event stream.  Mainly for testing against a stand-in
+##                      (see extra/sse_standin.py). (default: https://<bridge>/eventstream/clip/v2)
+##
+
+import json
+import threading
+import time
+
+import requests
+from requests.packages.urllib3.exceptions import InsecureRequestWarning
+
+
+## The bridge serves the stream over https with a self-signed certificate, so we can't verify it:
+requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+
+## The bridge sends a keep-alive comment every few seconds.  Hearing nothing for this long means the stream is dead.
+STREAM_CONNECT_TIMEOUT = 5
+STREAM_READ_TIMEOUT = 60
+
+## Seconds between reconnect attempts:
+RECONNECT_MIN = 1
+RECONNECT_MAX = 60
+
+## The v1 endpoints we keep current:
+STREAM_ENDPOINTS = ['lights', 'sensors']
+
+
+## One event stream per bridge and user, for the life of the backend:
+_streams = {}
+
+
+################################################################################
+## Look up (or start) the event stream for a bridge.
+def getEventStream(hueBridge, userName, options):
+
+    key = (hueBridge.bridge, userName)
+
+    if key not in _streams:
+        url = options.get('event_stream_url', 'https://' + hueBridge.bridge + '/eventstream/clip/v2')
+        _streams[key] = EventStream(hueBridge, userName, url)
+        _streams[key].start()
+
+    return _streams[key]
+
+
+################################################################################
+## The v2 event times look like "2022-01-01T12:34:56Z".  v1 leaves off the "Z".
+def v1Time(creationTime):
+
+    if not creationTime:
+        return None
+
+    return creationTime.rstrip('Z').split('.')[0]
+
+
+################################################################################
+## Translate one v2 resource update into the v1 changes it stands for.
+##
+## Returns (endpoint, resource id, changes), where changes looks like {'state': {'on': True}},
+## or None if it isn't a lights or sensors resource.  Changes is None if it is, but we don't know how to translate it.
+def v1Changes(resource, creationTime):
+
+    address = resource.get('id_v1', '').strip('/').split('/')
+
+    if len(address) != 2 or address[0] not in STREAM_ENDPOINTS:
+        return None
+
+    endpoint, resourceID = address
+    resourceType = resource.get('type')
+
+    state = {}
+    config = {}
+
+    if resourceType == 'light':
+
+        if 'on' in resource:
+            state['on'] = resource['on']['on']
+
+        # v2 brightness is a percentage.  v1 is 1 to 254.
+        if 'dimming' in resource:
+            state['bri'] = max(1, min(254, int(round(resource['dimming']['brightness'] * 254 / 100.0))))
+
+        if resource.get('color_temperature', {}).get('mirek_valid', True) and resource.get('color_temperature', {}).get('mirek') is not None:
+            state['ct'] = resource['color_temperature']['mirek']
+            state['colormode'] = 'ct'
+
+        if 'color' in resource:
+            state['xy'] = [resource['color']['xy']['x'], resource['color']['xy']['y']]
+            state['colormode'] = 'xy'
+
+    elif resourceType == 'zigbee_connectivity':
+
+        reachable = resource.get('status') == 'connected'
+        if endpoint == 'lights':
+            state['reachable'] = reachable
+        else:
+            config['reachable'] = reachable
+
+    elif resourceType == 'motion' and 'motion' in resource:
+        state['presence'] = resource['motion']['motion']
+
+    # v2 temperatures are degrees Celsius.  v1 is hundredths of a degree.
+    elif resourceType == 'temperature' and 'temperature' in resource:
+        state['temperature'] = int(round(resource['temperature']['temperature'] * 100))
+
+    elif resourceType == 'light_level' and 'light_level' in resource:
+        state['lightlevel'] = resource['light_level']['light_level']
+
+    elif resourceType == 'device_power' and 'power_state' in resource:
+        config['battery'] = resource['power_state'].get('battery_level')
+
+    if not state and not config:
+        return (endpoint, resourceID, None)
+
+    # A sensor's state changes are stamped with when they happened:
+    if endpoint == 'sensors' and state and v1Time(creationTime):
+        state['lastupdated'] = v1Time(creationTime)
+
+    changes = {}
+    if state:
+        changes['state'] = state
+    if config:
+        changes['config'] = config
+
+    return (endpoint, resourceID, changes)
+
+
+################################################################################
+## A v1 light level sensor also says whether it is dark, and whether it is daylight, by comparing its light level
+## with the tholddark and tholdoffset in its config.  The v2 event only carries the light level, so we work the
+## other two out again.  Returns None if we don't know the sensor's thresholds.
+def lightLevelFlags(lightLevel, config):
+
+    if config is None or config.get('tholddark') is None:
+        return None
+
+    return {'dark'     : lightLevel <= config['tholddark'],
+            'daylight' : lightLevel >= config['tholddark'] + config.get('tholdoffset', 0)}
+
+
+################################################################################
+## Holds one bridge's event stream open on a background thread and applies what it hears to the bridge snapshots.
+class EventStream(threading.Thread):
+
+    def __init__(self, hueBridge, userName, url):
+
+        super(EventStream, self).__init__()
+        self.daemon = True
+
+        self.hueBridge = hueBridge
+        self.userName = userName
+        self.url = url
+
+        # True while the snapshots are being kept current.  The wrappers poll whenever it isn't.
+        self.live = False
+
+        self.lastError = None
+
+
+    def run(self):
+
+        backoff = RECONNECT_MIN
+
+        while True:
+
+            try:
+                self.listen()
+                self.lastError = None
+
+            except Exception, e:
+                self.lastError = e
+
+            # If we had got as far as being live, this is a fresh drop rather than another failed attempt:
+            if self.live:
+                backoff = RECONNECT_MIN
+
+            self.live = False
+
+            time.sleep(backoff)
+            backoff = min(RECONNECT_MAX, backoff * 2)
+
+
+    ############
+    # Connect, catch up, and apply events until the stream ends.
+    def listen(self):
+
+        response = requests.get(self.url,
+                                headers={'hue-application-key': self.userName, 'Accept': 'text/event-stream'},
+                                stream=True,
+                                verify=False,
+                                timeout=(STREAM_CONNECT_TIMEOUT, STREAM_READ_TIMEOUT))
+
+        try:
+
+            response.raise_for_status()
+
+            # We are connected, so anything that changes from here on will reach us.  Catch up on the rest:
+            for endpoint in STREAM_ENDPOINTS:
+                self.refetch(endpoint)
+
+            self.live = True
+
+            for events in self.read(response):
+                self.apply(events)
+
+        finally:
+            response.close()
+
+
+    ############
+    # The decoded "data:" of each event the server sends.  Everything else (ids, keep-alive comments) we ignore.
+    def read(self, response):
+
+        data = []
+
+        # One byte at a time, so we see each event as soon as it arrives instead of when a buffer fills up:
+        for line in response.iter_lines(chunk_size=1):
+
+            if line.startswith('data:'):
+                data.append(line[5:].strip())
+
+            elif not line and data:
+                yield json.loads('\n'.join(data))
+                data = []
+
+
+    ############
+    # Apply one batch of v2 events.
+    def apply(self, events):
+
+        refetch = set()
+
+        for event in events:
+
+            # Lights and sensors that come or go change the whole endpoint:
+            if event.get('type') in ['add', 'delete']:
+                for resource in event.get('data', []):
+                    changes = v1Changes(resource, None)
+                    if changes is not None:
+                        refetch.add((changes[0], None))
+                continue
+
+            if event.get('type') != 'update':
+                continue
+
+            for resource in event.get('data', []):
+
+                changes = v1Changes(resource, event.get('creationtime'))
+                if changes is None:
+                    continue
+
+                endpoint, resourceID, changes = changes
+
+                if changes is None:
+                    refetch.add((endpoint, resourceID))
+                    continue
+
+                # dark and daylight follow from the light level:
+                if 'lightlevel' in changes.get('state', {}):
+                    sensor = (self.hueBridge.lastSnapshot(self.userName, endpoint) or {}).get(resourceID, {})
+                    flags = lightLevelFlags(changes['state']['lightlevel'], sensor.get('config'))
+                    if flags is None:
+                        refetch.add((endpoint, resourceID))
+                        continue
+                    changes['state'].update(flags)
+
+                self.hueBridge.patchResource(self.userName, endpoint, resourceID, changes)
+
+        for endpoint, resourceID in refetch:
+            self.refetch(endpoint, resourceID)
+
+
+    ############
+    # GET an endpoint (or one of its resources) from the v1 API and make it our snapshot.
+    def refetch(self, endpoint, resourceID=None):
+
+        if resourceID is None:
+            self.hueBridge.storeSnapshot(self.userName, endpoint, self.hueBridge.fetch(self.userName, endpoint + '/'))
+            return
+
+        data = self.hueBridge.fetch(self.userName, endpoint + '/' + resourceID)
+
+        # Gone already (or an error we'll find out about on the next full fetch):
+        if isinstance(data, dict):
+            self.hueBridge.patchResource(self.userName, endpoint, resourceID, data)
+
+
+    ############
+    # The current contents of an endpoint (or just one resource from it, shaped like hueBridge.resource()).
+    # Only meaningful while we are live.
+    def current(self, endpoint, resourceID=None):
+
+        data = self.hueBridge.lastSnapshot(self.userName, endpoint)
+
+        if data is None:
+            return {}
+
+        if resourceID is None:
+            return data
+
+        resourceID = str(resourceID)
+        if resourceID in data:
+            return {resourceID: data[resourceID]}
+
+        return {}
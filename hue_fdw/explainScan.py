@@ -0,0 +1,113 @@
+## What EXPLAIN says about a scan of a Hue table.
+##
+## Multicorn asks a wrapper to explain() each foreign scan in a plan.  Each line we hand back shows up under the
+## scan as "Multicorn: ...".  We say:
+##   * the request the scan would send each bridge -- or why it wouldn't need to send one (a fresh snapshot
+##     within cache_ttl_ms, or a live event stream), and whether the bridge's circuit breaker is open,
+##   * the quals that narrow those requests (eg. light_id = 3 -> GET .../lights/3, bridge = ... -> just that bridge),
+##   * the quals we test here, in python, on every row that comes back (all of them -- see operatorFunctions.py),
+##   * the columns the scan builds.
+## It is what a scan would do at the moment EXPLAIN runs.  We don't ask the bridge anything to find out.
+##
+## With EXPLAIN VERBOSE we also say what the table's last scan in this backend cost (see hueStats.ScanCost):  the
+## requests it sent, how long they took, the bytes that came back, and the rows it tested and returned.
+## EXPLAIN (ANALYZE, VERBOSE) explains after running the query, so there the last scan is the query's own.
+##
+## The username is the bridge's only password, so the URLs show <username> instead.
+##
+
+from operatorFunctions import getEqualityValue, getEqualityValues
+
+
+################################################################################
+## A qual the way it would read in SQL, eg. light_id = 3, bridge = ANY('10.0.0.2', '10.0.0.3')
+def describeQual(qual):
+
+    if isinstance(qual.operator, tuple):
+        operator, useOr = qual.operator
+        return '%s %s %s(%s)' % (qual.field_name, operator, 'ANY' if useOr else 'ALL', ', '.join([describeValue(value) for value in qual.value]))
+
+    return '%s %s %s' % (qual.field_name, qual.operator, describeValue(qual.value))
+
+
+def describeValue(value):
+
+    if value is None:
+        return 'NULL'
+
+    if isinstance(value, basestring):
+        return "'%s'" % value
+
+    return '%s' % value
+
+
+################################################################################
+## The quals a scan uses to narrow what it asks the bridges for:  "idColumn = ...", and "bridge = ..." or
+## "bridge in (...)" on tables that have a bridge column.  (The same tests execute() makes.)
+def pushedQuals(quals, idColumn=None):
+
+    pushed = []
+
+    for qual in quals:
+
+        if idColumn is not None and qual.field_name == idColumn and getEqualityValue([qual], idColumn) is not None:
+            pushed.append(qual)
+
+        elif qual.field_name == 'bridge' and getEqualityValues([qual], 'bridge') is not None:
+            pushed.append(qual)
+
+    return pushed
+
+
+################################################################################
+## What a scan of an endpoint would ask one bridge for.  (hueBridge.snapshot() and hueBridge.resource() make
+## the same choices.)
+def plannedRequest(hueBridge, userName, endpoint, resourceID, ttl, fullState, eventStream=None):
+
+    if eventStream is not None and eventStream.live:
+        return 'no request -- answered from the live event stream'
+
+    age = hueBridge.snapshotAge(userName, endpoint)
+    if ttl > 0 and age is not None and age < ttl:
+        return 'no request -- answered from our %.3fs old snapshot (cache_ttl_ms %d)' % (age, ttl * 1000)
+
+    # With a cache, a lookup fetches the whole endpoint (see hueBridge.resource()):
+    if fullState:
+        address = ''
+    elif resourceID is not None and ttl <= 0:
+        address = '%s/%s' % (endpoint, resourceID)
+    else:
+        address = endpoint + '/'
+
+    request = 'GET ' + hueBridge.apiURL('<username>', address)
+
+    if hueBridge.breaker.retryIn() > 0:
+        request += ' -- but the circuit breaker is open for another %.1fs' % hueBridge.breaker.retryIn()
+
+    return request
+
+
+################################################################################
+## The EXPLAIN lines for a scan.
+## requests is a list of (bridge, plannedRequest()) pairs.  lastScan is the table's last ScanCost, or None.
+def explainScan(requests, pushed, quals, columns, lastScan, verbose):
+
+    lines = []
+
+    for bridge, request in requests:
+        lines.append('Hue Bridge %s:  %s' % (bridge, request))
+
+    if not requests:
+        lines.append('Hue Bridge:  none -- the quals rule out every bridge')
+
+    lines.append('Pushed down to the bridge:  %s' % (', '.join([describeQual(qual) for qual in pushed]) or 'none'))
+    lines.append('Filtered in python:  %s' % (', '.join([describeQual(qual) for qual in quals]) or 'none'))
+    lines.append('Columns:  %s' % (', '.join(sorted(columns)) or 'none'))
+
+    if verbose:
+        if lastScan is None:
+            lines.append('Last scan:  none yet in this session')
+        else:
+            lines.append('Last scan:  %s' % lastScan)
+
+    return lines
@@ -0,0 +1,584 @@
+## Per-bridge state shared by the Hue Foreign Data Wrappers.
+##
+## Multicorn keeps one python interpreter alive for the life of a PostgreSQL backend, so anything we
+## keep at module level here is shared by every Hue foreign table that backend touches.
+## We use that to keep one pooled, keep-alive HTTP session per bridge instead of opening a new TCP
+## connection for every GET and PUT.
+##
+## We also keep a short-lived snapshot of each endpoint we GET from the bridge, so repeated scans
+## (nested loop joins, dashboards polling several times a second) don't each cost a round trip.
+## Successful PUTs are written through to the snapshot so we don't serve stale values after an update.
+## In event stream mode (see eventStream.py) the bridge's own change events are written through as well.
+##
+## The bridge will also hand back its whole datastore (lights, sensors, config, groups, ...) from a single
+## GET /api/<username>.  In "fullstate" mode we make that one request and fill the snapshots for every
+## endpoint from it, so a query joining several Hue tables costs one round trip instead of one per table.
+##
+## Every request has connect and read timeouts, so a bridge that has gone away can't hang the backend.
+## Requests that get no answer are retried a few times, after a short random wait (so the retries from several
+## backends don't all land at once), and a bridge that keeps not answering trips its circuit breaker (see
+## circuitBreaker.py) so we stop waiting on it at all for a while.  With serve_stale set, a scan that can't reach
+## the bridge gets the last snapshot we had instead of an error, along with a WARNING saying how old it is.
+##
+## Options (set on "create server", shared by all of the Hue wrappers):
+##  pool_size         -- Optional:  Integer - Number of keep-alive connections we hold open to the bridge. (default: 4)
+##  pool_idle_timeout -- Optional:  Integer - Seconds a pooled connection may sit idle before we drop it
+##                       and reconnect.  The bridge closes idle connections on its own fairly quickly. (default: 10)
+##  max_commands_per_sec       -- Optional:  Number - How many light (and other resource) commands a second we
+##                                send the bridge.  0 for no limit.  (see commandScheduler.py) (default: 10)
+##  max_group_commands_per_sec -- Optional:  Number - The same, for group commands. (default: 1)
+##                                Both limits are per backend:  each session sending commands gets the whole rate,
+##                                so if several will write to the bridge at once, divide the bridge's rate between them.
+##  connect_timeout_ms -- Optional:  Integer - How long we wait to connect to the bridge. (default: 2000)
+##  read_timeout_ms    -- Optional:  Integer - How long we wait for the bridge to answer once connected. (default: 5000)
+##  max_retries        -- Optional:  Integer - How many times a request that got no answer is tried again. (default: 2)
+##  retry_backoff_ms   -- Optional:  Integer - The longest wait before the first retry.  It doubles for each
+##                        retry after that, and the actual wait is a random fraction of it. (default: 100)
+##  breaker_failures   -- Optional:  Integer - How many requests in a row can go unanswered before we stop trying
+##                        the bridge for a while.  0 to keep trying every time. (default: 3)
+##  breaker_reset_ms   -- Optional:  Integer - How long we leave the bridge alone before trying it again. (default: 30000)
+##  serve_stale        -- Optional:  true or false - Whether a scan of a bridge we can't reach gets our last snapshot
+##                        (with a WARNING) instead of an error. (default: false)
+##
+## Options (set per wrapper, on "create server" or "create foreign table"):
+##  cache_ttl_ms      -- Optional:  Integer - How long (in milliseconds) a scan may reuse the last snapshot it
+##                       got from the bridge.  0 means always ask the bridge. (default: 0, or 1000 in fullstate mode)
+##                       With a cache, a join may look rows up by id (eg. light_id) one outer row at a time, since
+##                       they all come out of one snapshot.  Without one the planner only sees a plain scan.
+##  fetch_mode        -- Optional:  endpoint or fullstate - GET only the wrapper's own endpoint, or the whole
+##                       bridge datastore. (default: endpoint)
+##
+
+import json
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from commandScheduler import CommandScheduler, DEFAULT_MAX_COMMANDS_PER_SEC, DEFAULT_MAX_GROUP_COMMANDS_PER_SEC
+from circuitBreaker import CircuitBreaker, retryDelay
+import hueStats
+
+
+## The Hue Bridge is a small embedded device.  Don't hold many sockets open against it.
+DEFAULT_POOL_SIZE = 4
+DEFAULT_POOL_IDLE_TIMEOUT = 10
+
+## A fullstate fetch is only worth making if the other wrappers get to use what it brought back,
+## so in that mode snapshots stay good for a second unless the table says otherwise.
+DEFAULT_FULLSTATE_TTL_MS = 1000
+
+## A bridge on the local network connects in milliseconds and answers in well under a second,
+## even for the whole datastore.  Much longer than this and it isn't going to answer at all.
+DEFAULT_CONNECT_TIMEOUT_MS = 2000
+DEFAULT_READ_TIMEOUT_MS = 5000
+DEFAULT_MAX_RETRIES = 2
+DEFAULT_RETRY_BACKOFF_MS = 100
+DEFAULT_BREAKER_FAILURES = 3
+DEFAULT_BREAKER_RESET_MS = 30000
+
+## We throw this when the bridge doesn't give us something we can use:
+class hueBridgeException(Exception):
+
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return repr(self.msg)
+
+
+## One HueBridge per bridge address, for the life of the backend:
+_bridges = {}
+
+
+################################################################################
+## Look up (or set up) the shared state for the bridge named in a server's options.
+def getBridge(bridge, options):
+
+    poolSize = int(options.get('pool_size', DEFAULT_POOL_SIZE))
+    idleTimeout = float(options.get('pool_idle_timeout', DEFAULT_POOL_IDLE_TIMEOUT))
+    maxCommandsPerSec = float(options.get('max_commands_per_sec', DEFAULT_MAX_COMMANDS_PER_SEC))
+    maxGroupCommandsPerSec = float(options.get('max_group_commands_per_sec', DEFAULT_MAX_GROUP_COMMANDS_PER_SEC))
+    connectTimeout = float(options.get('connect_timeout_ms', DEFAULT_CONNECT_TIMEOUT_MS)) / 1000
+    readTimeout = float(options.get('read_timeout_ms', DEFAULT_READ_TIMEOUT_MS)) / 1000
+    maxRetries = int(options.get('max_retries', DEFAULT_MAX_RETRIES))
+    retryBackoff = float(options.get('retry_backoff_ms', DEFAULT_RETRY_BACKOFF_MS)) / 1000
+    breakerFailures = int(options.get('breaker_failures', DEFAULT_BREAKER_FAILURES))
+    breakerReset = float(options.get('breaker_reset_ms', DEFAULT_BREAKER_RESET_MS)) / 1000
+    serveStale = options.get('serve_stale', 'false').lower() == 'true'
+
+    if bridge not in _bridges:
+        _bridges[bridge] = HueBridge(bridge, poolSize, idleTimeout)
+    else:
+        _bridges[bridge].configure(poolSize, idleTimeout)
+
+    _bridges[bridge].scheduler.configure(maxCommandsPerSec, maxGroupCommandsPerSec)
+    _bridges[bridge].configureRequests(connectTimeout, readTimeout, maxRetries, retryBackoff, serveStale)
+    _bridges[bridge].breaker.configure(breakerFailures, breakerReset)
+
+    return _bridges[bridge]
+
+
+################################################################################
+## A table can span several bridges: its "bridge" option is then a comma separated list of them.
+## The "username" option is either one name for every bridge, or a list in the same order as the bridges.
+##
+## Returns a list of (HueBridge, username) pairs, in the order the bridges were given.
+def getBridges(options, userName):
+
+    bridges = [bridge.strip() for bridge in options['bridge'].split(',') if bridge.strip()]
+    userNames = [name.strip() for name in userName.split(',')]
+
+    if not bridges:
+        raise hueBridgeException('No bridge given: %s' % options['bridge'])
+
+    if len(userNames) == 1:
+        userNames = userNames * len(bridges)
+    elif len(userNames) != len(bridges):
+        raise hueBridgeException('Expected one username, or one for each of the %d bridges: %s' % (len(bridges), userName))
+
+    return [(getBridge(bridge, options), name) for bridge, name in zip(bridges, userNames)]
+
+
+################################################################################
+## Everything we keep about one physical bridge.
+class HueBridge(object):
+
+    def __init__(self, bridge, poolSize, idleTimeout):
+
+        self.bridge = bridge
+        self.poolSize = poolSize
+        self.idleTimeout = idleTimeout
+
+        self._session = None
+        self._lastUsed = 0
+
+        # Commands may be sent from several threads at once (see commandDispatch.py):
+        self._sessionLock = threading.Lock()
+
+        # (username, endpoint) -> (fetch time, decoded JSON)
+        self.snapshots = {}
+
+        # The event stream (see eventStream.py) patches snapshots from its own thread:
+        self._snapshotLock = threading.Lock()
+
+        # (username, endpoint) -> when the event stream or a PUT last changed our snapshot of it (see _storeFetched()):
+        self.changedAt = {}
+
+        # Every command we PUT to this bridge is paced through here:
+        self.scheduler = CommandScheduler(self, DEFAULT_MAX_COMMANDS_PER_SEC, DEFAULT_MAX_GROUP_COMMANDS_PER_SEC)
+
+        # How long we wait on the bridge, and how often we try again (see request()):
+        self.configureRequests(float(DEFAULT_CONNECT_TIMEOUT_MS) / 1000, float(DEFAULT_READ_TIMEOUT_MS) / 1000,
+                               DEFAULT_MAX_RETRIES, float(DEFAULT_RETRY_BACKOFF_MS) / 1000, False)
+
+        self.breaker = CircuitBreaker(DEFAULT_BREAKER_FAILURES, float(DEFAULT_BREAKER_RESET_MS) / 1000)
+
+        # Scans that got an old snapshot because the bridge didn't answer, for the wrapper to warn about (see takeWarnings()):
+        self.warnings = []
+
+
+    ############
+    # Different servers pointing at the same bridge may ask for different pool settings.
+    # The most recent "create server" options win; we rebuild the pool on the next request.
+    def configure(self, poolSize, idleTimeout):
+
+        if (poolSize, idleTimeout) != (self.poolSize, self.idleTimeout):
+            self.poolSize = poolSize
+            self.idleTimeout = idleTimeout
+            self.close()
+
+
+    ############
+    # Timeouts (in seconds), retries, and whether to fall back to an old snapshot.  The most recent "create server" options win.
+    def configureRequests(self, connectTimeout, readTimeout, maxRetries, retryBackoff, serveStale):
+
+        self.timeout = (connectTimeout, readTimeout)
+        self.maxRetries = maxRetries
+        self.retryBackoff = retryBackoff
+        self.serveStale = serveStale
+
+
+    ############
+    # Drop the pooled connections.
+    def close(self):
+
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+
+    ############
+    # Hand back the pooled session, replacing it if its connections have been idle too long
+    # (the bridge will have hung up on us by then and the first request would fail).
+    def session(self):
+
+        with self._sessionLock:
+
+            now = time.time()
+
+            if self._session is not None and now - self._lastUsed > self.idleTimeout:
+                self.close()
+
+            if self._session is None:
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.poolSize)
+                self._session = requests.Session()
+                self._session.mount('http://', adapter)
+                self._session.mount('https://', adapter)
+
+            self._lastUsed = now
+
+            return self._session
+
+
+    ############
+    # The HTTP verbs the wrappers use:
+    def get(self, url):
+        return self.request('GET', url)
+
+    def put(self, url, data):
+        return self.request('PUT', url, data)
+
+    def post(self, url, data):
+        return self.request('POST', url, data)
+
+    def delete(self, url):
+        return self.request('DELETE', url)
+
+
+    ############
+    # Send a request, with our timeouts, trying again if it gets no answer.
+    #
+    # GET, PUT and DELETE mean the same thing however many times the bridge gets them, so they are retried after
+    # a timeout or a dropped connection.  A POST creates something, so it is only retried when we never managed
+    # to connect -- otherwise we could end up making two.
+    # An answer of any kind (even an error from the bridge) goes straight back to the caller.
+    def request(self, method, url, data=None):
+
+        if not self.breaker.allow():
+            raise hueBridgeException('The Hue Bridge %s is not answering (%d requests in a row failed).  Not trying it again for %.0f seconds.'
+                                     % (self.bridge, self.breaker.failures, self.breaker.retryIn()))
+
+        endpoint = hueStats.endpointOf(url)
+        started = time.time()
+        attempt = 0
+
+        while True:
+
+            try:
+
+                response = self.session().request(method, url, data=data, timeout=self.timeout)
+
+            except (requests.ConnectionError, requests.Timeout), e:
+
+                if attempt < self.maxRetries and (method != 'POST' or isinstance(e, requests.ConnectTimeout)):
+                    attempt += 1
+                    time.sleep(retryDelay(attempt, self.retryBackoff))
+                    continue
+
+                self.breaker.failed()
+                hueStats.count(self.bridge, 'request_errors', endpoint, method)
+                raise hueBridgeException('No answer from the Hue Bridge %s to a %s request (attempts: %d): %s' % (self.bridge, method, attempt + 1, e))
+
+            except Exception:
+
+                self.breaker.failed()
+                raise
+
+            self.breaker.succeeded()
+
+            hueStats.timing(self.bridge, 'requests', endpoint, method, time.time() - started)
+            hueStats.count(self.bridge, 'bytes_received', endpoint, method, len(response.content))
+
+            return response
+
+
+    ############
+    # The URL for a resource on the bridge, eg. apiURL('postgreshue', 'lights/3/state') -> http://<bridge>/api/postgreshue/lights/3/state
+    # With no address it is the whole datastore:  http://<bridge>/api/postgreshue
+    def apiURL(self, userName, address=''):
+
+        url = 'http://' + self.bridge + '/api/' + userName
+
+        if address:
+            url += '/' + address
+
+        return url
+
+
+    ############
+    # GET a resource (eg. 'lights/', 'lights/3', or '' for the whole datastore) and decode it.
+    def fetch(self, userName, address):
+
+        return self.decode(self.get(self.apiURL(userName, address)), address)
+
+
+    ############
+    # PUT a command (see commandScheduler.py) and decode the answer.
+    # This is called from dispatch worker threads, so it must not touch our snapshots.
+    def putCommand(self, userName, command):
+
+        return self.decode(self.put(self.apiURL(userName, command.address), json.dumps(command.payload)), command.address)
+
+
+    ############
+    # Decode the bridge's answer to a request for address (keeping track of how long that takes).
+    def decode(self, results, address):
+
+        started = time.time()
+
+        try:
+
+            data = json.loads(results.text)
+
+        except ValueError, e:
+
+            raise hueBridgeException('Unexpected (non-JSON) response from the Hue Bridge %s: %s -- %s' % (self.bridge, e, results))
+
+        hueStats.timing(self.bridge, 'json_decode', address.split('/')[0] or 'datastore', None, time.time() - started)
+
+        return data
+
+
+    ############
+    # The contents of an endpoint, from our snapshot if it is younger than ttl seconds, otherwise from the bridge.
+    # With fullState we refresh every endpoint's snapshot from one GET of the whole datastore.
+    def snapshot(self, userName, endpoint, ttl, fullState=False):
+
+        key = (userName, endpoint)
+
+        data = self._freshSnapshot(key, ttl)
+        if data is not None:
+            return data
+
+        requestTime = time.time()
+
+        if not fullState:
+            try:
+                data = self.fetch(userName, endpoint + '/')
+            except hueBridgeException, e:
+                return self._staleSnapshot(key, e)
+            self._storeFetched(key, data, requestTime)
+            return data
+
+        try:
+            fullStateData = self.fetch(userName, '')
+        except hueBridgeException, e:
+            return self._staleSnapshot(key, e)
+
+        # An unauthorized user gets back a list of errors instead of the datastore:
+        if not isinstance(fullStateData, dict) or endpoint not in fullStateData:
+            raise hueBridgeException('Unexpected full state response from the Hue Bridge %s: %s' % (self.bridge, fullStateData))
+
+        for name in fullStateData.keys():
+            self._storeFetched((userName, name), fullStateData[name], requestTime)
+
+        return fullStateData[endpoint]
+
+
+    ############
+    # Just one resource from an endpoint (eg. light 3), as a one entry dict shaped like the whole endpoint would be:
+    #    {'3': {...light 3...}}
+    # With a cache (ttl > 0) we look it up in the endpoint's snapshot -- fetching the whole endpoint if ours isn't fresh,
+    # so the lookups after it (eg. the inner side of a nested loop join) don't cost a request each.
+    # Without one we ask the bridge for only that resource.
+    # A resource the bridge doesn't have (error type 3) comes back as an empty dict.
+    def resource(self, userName, endpoint, resourceID, ttl):
+
+        resourceID = str(resourceID)
+
+        if ttl > 0:
+
+            data = self.snapshot(userName, endpoint, ttl)
+
+            if not isinstance(data, dict):
+                raise hueBridgeException('Unexpected response from the Hue Bridge %s for %s: %s' % (self.bridge, endpoint, data))
+
+            if resourceID in data:
+                return {resourceID: data[resourceID]}
+            return {}
+
+        try:
+            data = self.fetch(userName, endpoint + '/' + resourceID)
+        except hueBridgeException, e:
+            data = self._staleSnapshot((userName, endpoint), e)
+            if resourceID in data:
+                return {resourceID: data[resourceID]}
+            return {}
+
+        if isinstance(data, list):
+            for status in data:
+                if status.has_key('error') and status['error'].get('type') == 3:
+                    return {}
+            raise hueBridgeException('Unexpected response from the Hue Bridge %s for %s %s: %s' % (self.bridge, endpoint, resourceID, data))
+
+        return {resourceID: data}
+
+
+    ############
+    # Make what we just fetched an endpoint's snapshot.
+    # If the event stream (or a PUT) changed our snapshot after we sent the GET, the snapshot is newer than what came
+    # back, so we keep it.  Without the lock we could also write over a change the stream was applying right then.
+    def _storeFetched(self, key, data, requestTime):
+
+        with self._snapshotLock:
+
+            if key in self.snapshots and self.changedAt.get(key, 0) > requestTime:
+                return
+
+            self.snapshots[key] = (time.time(), data)
+
+
+    ############
+    # Whatever snapshot we have of an endpoint, however old, or None.
+    # Good enough for the planner's row estimates -- the number of lights on a bridge doesn't change much.
+    def lastSnapshot(self, userName, endpoint):
+
+        if (userName, endpoint) in self.snapshots:
+            return self.snapshots[(userName, endpoint)][1]
+
+        return None
+
+
+    ############
+    # How many seconds old our snapshot of an endpoint is, or None if we don't have one.
+    # For EXPLAIN, which wants to know whether a scan would come from the cache without counting a cache hit or miss.
+    def snapshotAge(self, userName, endpoint):
+
+        if (userName, endpoint) in self.snapshots:
+            return time.time() - self.snapshots[(userName, endpoint)][0]
+
+        return None
+
+
+    ############
+    # Our snapshot of an endpoint if it is younger than ttl seconds, otherwise None.
+    def _freshSnapshot(self, key, ttl):
+
+        if ttl > 0 and key in self.snapshots:
+            fetchTime, data = self.snapshots[key]
+            if time.time() - fetchTime < ttl:
+                hueStats.count(self.bridge, 'cache_hits', key[1])
+                return data
+
+        hueStats.count(self.bridge, 'cache_misses', key[1])
+
+        return None
+
+
+    ############
+    # When the bridge didn't answer:  with serve_stale, our last snapshot of the endpoint (however old), otherwise
+    # (or if we don't have one) the error.
+    # We may be on a dispatch worker thread here, so rather than warn about it ourselves we leave the
+    # warning for the wrapper to pick up (see takeWarnings()).
+    def _staleSnapshot(self, key, e):
+
+        if not self.serveStale or key not in self.snapshots:
+            raise e
+
+        fetchTime, data = self.snapshots[key]
+
+        with self._snapshotLock:
+            self.warnings.append('%s -- using our copy of %s from %.0f seconds ago instead.' % (e.msg, key[1], time.time() - fetchTime))
+
+        return data
+
+
+    ############
+    # The stale snapshot warnings we've built up since the last time we were asked.
+    def takeWarnings(self):
+
+        with self._snapshotLock:
+            warnings = self.warnings
+            self.warnings = []
+
+        return warnings
+
+
+    ############
+    # Keep data someone else fetched for us (eg. the sensor history poller) as the endpoint's current snapshot.
+    def storeSnapshot(self, userName, endpoint, data):
+
+        with self._snapshotLock:
+            self.snapshots[(userName, endpoint)] = (time.time(), data)
+
+
+    ############
+    # Merge changes into one resource of an endpoint's snapshot, eg.
+    #    patchResource('postgreshue', 'sensors', '5', {'state': {'presence': True}})
+    # Nested objects (state, config) are merged, anything else is replaced.  Like applySuccess we copy rather than
+    # change anything in place.  If we don't have a snapshot of the endpoint there is nothing to keep current.
+    def patchResource(self, userName, endpoint, resourceID, changes):
+
+        with self._snapshotLock:
+
+            key = (userName, endpoint)
+
+            if key not in self.snapshots:
+                return
+
+            fetchTime, data = self.snapshots[key]
+
+            resource = dict(data.get(resourceID, {}))
+
+            for name, value in changes.items():
+                if isinstance(value, dict) and isinstance(resource.get(name), dict):
+                    merged = dict(resource[name])
+                    merged.update(value)
+                    resource[name] = merged
+                else:
+                    resource[name] = value
+
+            newData = dict(data)
+            newData[resourceID] = resource
+            self.snapshots[key] = (fetchTime, newData)
+            self.changedAt[key] = time.time()
+
+
+    ############
+    # Forget what we know about an endpoint.  The next scan will go back to the bridge.
+    def invalidate(self, userName, endpoint):
+        self.snapshots.pop((userName, endpoint), None)
+
+
+    ############
+    # Write a successful PUT through to our snapshot.
+    #
+    # The bridge answers every attribute it changed with an entry like
+    #    {"success": {"/lights/1/state/bri": 200}}
+    # so we know exactly which value to patch.  We copy each dict along the path instead of changing it in place,
+    # so a scan that is still iterating over the old snapshot sees a consistent picture.
+    def applySuccess(self, userName, success):
+
+        with self._snapshotLock:
+            for address, value in success.items():
+                self._applyValue(userName, address, value)
+
+
+    ## One "success" entry, with the snapshot lock held:
+    def _applyValue(self, userName, address, value):
+
+        path = address.strip('/').split('/')
+        key = (userName, path[0])
+
+        if key not in self.snapshots:
+            return
+
+        fetchTime, data = self.snapshots[key]
+
+        # Walk down to the attribute, copying as we go.  Anything we don't recognize
+        # (like "transitiontime", which isn't part of the state) we leave alone.
+        newData = dict(data)
+        parent = newData
+        for name in path[1:-1]:
+            if not isinstance(parent.get(name), dict):
+                parent = None
+                break
+            parent[name] = dict(parent[name])
+            parent = parent[name]
+
+        if parent is not None and path[-1] in parent:
+            parent[path[-1]] = value
+            self.snapshots[key] = (fetchTime, newData)
+            self.changedAt[key] = time.time()
@@ -0,0 +1,310 @@
+## Counters and timings for what the Hue wrappers cost the bridge, and what they do with what it sends back.
+##
+## Like the bridge sessions and snapshots (see hueBridge.py), these live at module level, so they cover every Hue table
+## this backend has touched, since the backend started.  The HueStatsFDW wrapper hands them back as a table, so you
+## can find the hot tables and tune cache_ttl_ms and the pollers.
+##
+## Each statistic is kept for a (bridge, metric, scope, method):
+##   requests        -- Seconds each HTTP request to the bridge took.  scope is the endpoint, method the HTTP verb.
+##   request_errors  -- Requests that got no answer (after their retries).
+##   bytes_received  -- The size of each response.
+##   json_decode     -- Seconds spent decoding each response.
+##   cache_hits      -- Scans (and planner lookups) answered from a fresh snapshot, by endpoint.
+##   cache_misses    -- ... and the ones that had to ask the bridge.
+##   scans           -- Scans of each kind of table.  scope is the table's wrapper (lights, sensors, ...)
+##   rows_fetched    -- Rows a scan built and tested against its quals (added in when the scan is over) ...
+##   rows_returned   -- ... and the ones that passed.
+##   commands_sent   -- Commands the command scheduler sent, by endpoint.
+##   command_retries -- Commands sent again because the bridge failed some of them with a transient error.
+##
+## Requests are timed from the first try to the answer, so retries show up in the times.
+## Timings are kept as histograms, so you get percentiles as well as the count, total, min, and max.
+## Everything else is a counter:  count is how many times it happened, and total adds up the values (eg. bytes).
+##
+## The dispatch workers and background pollers record here too, so it is locked.
+##
+## Every scan keeps a ScanCost, which counts its rows without going anywhere near the lock, and adds them in here
+## once the scan is done.  The wrappers keep the last one, for EXPLAIN VERBOSE (see explainScan.py).
+##
+
+import threading
+import time
+from collections import OrderedDict
+
+
+## Upper bounds (in seconds) of the timing histogram buckets.  One more bucket catches everything slower.
+TIMING_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+## (bridge, metric, scope, method) -> Counter or Histogram
+_stats = {}
+_lock = threading.Lock()
+
+## When we started counting:
+_since = time.time()
+
+
+################################################################################
+## How many times something happened, and the sum of its values.
+class Counter(object):
+
+    def __init__(self):
+
+        self.count = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = None
+
+
+    def add(self, value, times=1):
+
+        self.count += times
+        self.total += value * times
+
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+
+    ############
+    # Counters don't have percentiles:
+    def percentile(self, fraction):
+        return None
+
+    def buckets(self):
+        return None
+
+
+################################################################################
+## A counter that also remembers how its values (times) are spread out.
+class Histogram(Counter):
+
+    def __init__(self):
+
+        super(Histogram, self).__init__()
+
+        self.bucketCounts = [0] * (len(TIMING_BUCKETS) + 1)
+
+
+    def add(self, value, times=1):
+
+        super(Histogram, self).add(value, times)
+
+        i = 0
+        while i < len(TIMING_BUCKETS) and value > TIMING_BUCKETS[i]:
+            i += 1
+
+        self.bucketCounts[i] += times
+
+
+    ############
+    # Roughly the value fraction of the samples are at or below:  the top of the bucket it falls in
+    # (but never more than the largest value we've actually seen).
+    def percentile(self, fraction):
+
+        if not self.count:
+            return None
+
+        wanted = fraction * self.count
+        seen = 0
+
+        for i, bucketCount in enumerate(self.bucketCounts):
+            seen += bucketCount
+            if seen >= wanted and i < len(TIMING_BUCKETS):
+                return min(TIMING_BUCKETS[i], self.maximum)
+
+        return self.maximum
+
+
+    ############
+    # The bucket counts by their upper bound, in order, eg. {"0.001": 0, ..., "0.01": 3, "0.025": 12, ..., "inf": 0}
+    def buckets(self):
+
+        labels = ['%g' % bound for bound in TIMING_BUCKETS] + ['inf']
+
+        return OrderedDict(zip(labels, self.bucketCounts))
+
+
+################################################################################
+## Add to a counter (times times):
+def count(bridge, metric, scope, method=None, value=1, times=1):
+
+    with _lock:
+        key = (bridge, metric, scope, method)
+        if key not in _stats:
+            _stats[key] = Counter()
+        _stats[key].add(value, times)
+
+
+################################################################################
+## Add a time (in seconds) to a histogram:
+def timing(bridge, metric, scope, method, seconds):
+
+    with _lock:
+        key = (bridge, metric, scope, method)
+        if key not in _stats:
+            _stats[key] = Histogram()
+        _stats[key].add(seconds)
+
+
+################################################################################
+## The requests we've sent to some bridges so far:  how many, the seconds they took, and the bytes that came back.
+def requestTotals(bridges):
+
+    requests = 0
+    seconds = 0
+    bytesReceived = 0
+
+    with _lock:
+
+        for (bridge, metric, scope, method), stat in _stats.items():
+
+            if bridge not in bridges:
+                continue
+
+            if metric == 'requests':
+                requests += stat.count
+                seconds += stat.total
+            elif metric == 'bytes_received':
+                bytesReceived += stat.total
+
+    return requests, seconds, bytesReceived
+
+
+################################################################################
+## What one scan of a table cost:  the requests it sent its bridges, and the rows it tested and returned.
+## We take the difference in the bridges' request totals, so anything else this backend sent them in the meantime
+## (eg. the sensor history poller) is counted in too.
+class ScanCost(object):
+
+    def __init__(self, table, bridges):
+
+        self.table = table
+        self.bridges = bridges
+        self.started = time.time()
+        self.before = requestTotals(bridges)
+
+        self.requests = 0
+        self.requestSeconds = 0
+        self.bytesReceived = 0
+
+        # Seconds from the start of the scan until the last bridge's results were in:
+        self.waited = 0
+
+        # bridge -> [rows tested, rows returned], until finish() adds them to the bridge's stats:
+        self.rowCounts = {}
+        self.finished = False
+
+
+    ############
+    # Count the rows this scan tests (and returns) from a bridge, by wrapping the quals test it runs every row
+    # through (see operatorFunctions.compileQuals()).
+    # This runs for every row, so it only bumps the scan's own counts.
+    def countRows(self, bridge, rowMatches):
+
+        if bridge not in self.rowCounts:
+            self.rowCounts[bridge] = [0, 0]
+            count(bridge, 'scans', self.table)
+
+        counts = self.rowCounts[bridge]
+
+        def countingRowMatches(row):
+
+            counts[0] += 1
+
+            if rowMatches(row):
+                counts[1] += 1
+                return True
+
+            return False
+
+        return countingRowMatches
+
+
+    ############
+    # The scan is over (finished, abandoned, or failed):  add its rows to the stats, once.
+    def finish(self):
+
+        if self.finished:
+            return
+
+        self.finished = True
+
+        for bridge, (rowsFetched, rowsReturned) in self.rowCounts.items():
+            if rowsFetched:
+                count(bridge, 'rows_fetched', self.table, times=rowsFetched)
+            if rowsReturned:
+                count(bridge, 'rows_returned', self.table, times=rowsReturned)
+
+
+    ############
+    @property
+    def rowsFetched(self):
+        return sum([counts[0] for counts in self.rowCounts.values()])
+
+    @property
+    def rowsReturned(self):
+        return sum([counts[1] for counts in self.rowCounts.values()])
+
+
+    ############
+    # Catch up with what the bridges have sent us so far.
+    # The scans call this as each bridge's results arrive.
+    def update(self):
+
+        requests, seconds, bytesReceived = requestTotals(self.bridges)
+
+        self.requests = requests - self.before[0]
+        self.requestSeconds = seconds - self.before[1]
+        self.bytesReceived = bytesReceived - self.before[2]
+        self.waited = time.time() - self.started
+
+
+    ############
+    def __str__(self):
+
+        return 'requests: %d (%.3fs), bytes received: %d, waited: %.3fs, rows tested: %d, rows returned: %d' % \
+               (self.requests, self.requestSeconds, self.bytesReceived, self.waited, self.rowsFetched, self.rowsReturned)
+
+
+################################################################################
+## The endpoint a bridge URL is for:
+##    http://<bridge>/api/<username>/lights/3/state -> lights
+##    http://<bridge>/api/<username>                -> datastore
+def endpointOf(url):
+
+    path = url.split('://', 1)[-1].split('/')[1:]
+
+    if len(path) > 2 and path[0] == 'api' and path[2]:
+        return path[2]
+
+    return 'datastore'
+
+
+################################################################################
+## Everything we've counted, as a list of dicts, and when we started counting.
+def snapshot():
+
+    with _lock:
+
+        rows = []
+
+        for (bridge, metric, scope, method), stat in _stats.items():
+
+            rows.append({'bridge'    : bridge,
+                         'metric'    : metric,
+                         'scope'     : scope,
+                         'method'    : method,
+                         'count'     : stat.count,
+                         'total'     : stat.total,
+                         'minimum'   : stat.minimum,
+                         'maximum'   : stat.maximum,
+                         'mean'      : float(stat.total) / stat.count if stat.count else None,
+                         'p50'       : stat.percentile(0.5),
+                         'p90'       : stat.percentile(0.9),
+                         'p99'       : stat.percentile(0.99),
+                         'histogram' : stat.buckets()})
+
+        return rows, _since
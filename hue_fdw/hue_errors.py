@@ -56,7 +56,7 @@ hue_errors = {
        'usage'       : """The lamp can store a maximum of 16 groups. This error will be returned if the device cannot accept any new groups in its internal table.  Deprecated as of 1.4."""},
 
  304: {'description' : 'device, <id>, could not be added to the scene. Device is unreachable.',
-       'usae'        : """This will be returned if an attempt to update a light list in a group or delete a group of type "Luminaire" or "LightSource". Note: as of 1.4."""},
+       'usage'       : """This will be returned if an attempt to update a light list in a group or delete a group of type "Luminaire" or "LightSource". Note: as of 1.4."""},
 
  305: {'description' : 'It is not allowed to update or delete group of this type.',
        'usage'       : """This will be returned if an attempt to update a light list in a group or delete a group of type "Luminaire" or "LightSource". Note: as of 1.4."""},
@@ -102,3 +102,56 @@ hue_errors = {
 
 }
 
+
+
+## Errors that are the bridge's own trouble rather than anything wrong with what we sent.
+## The same request a moment later will usually go through, so these are worth retrying (see commandScheduler.py).
+## Everything else (eg. 201, the light is off) will fail again however often we send it.
+transientErrors = [901]
+
+
+################################################################################
+## Will sending the same thing again help?
+def isTransient(error):
+    return error.get('type') in transientErrors
+
+
+################################################################################
+## A batch of the bridge's errors as a list of readable messages, one for each kind of error, with every address it happened at.
+## eg. the bridge's
+##    {"error": {"type": 607, "address": "/rules", "description": "invalid value, dx, for parameter, operator"}}
+## becomes
+##    Hue error 607 (Condition error) at /rules: invalid value, dx, for parameter, operator -- Rule conditions contain errors ...
+## and setting the brightness of two lights that are off gives one message:
+##    Hue error 201 (parameter, <parameter>, is not modifiable. Device is set to off.) at /lights/3/state/bri: parameter, bri, ...;
+##    /lights/4/state/bri: parameter, bri, ... -- <usage>
+def describeErrors(errors):
+
+    errorTypes = []
+    places = {}
+
+    for error in errors:
+        errorType = error.get('type')
+        if not places.has_key(errorType):
+            errorTypes.append(errorType)
+            places[errorType] = []
+        places[errorType].append('%s: %s' % (error.get('address'), error.get('description')))
+
+    messages = []
+
+    for errorType in errorTypes:
+
+        known = hue_errors.get(errorType, {})
+
+        message = 'Hue error %s' % errorType
+        if known.has_key('description'):
+            message += ' (%s)' % known['description']
+
+        message += ' at %s' % '; '.join(places[errorType])
+
+        if known.has_key('usage'):
+            message += ' -- %s' % known['usage']
+
+        messages.append(message)
+
+    return messages
@@ -0,0 +1,46 @@
+## A cache for the json text of the nested objects the Hue wrappers return as json columns.
+##
+## pointsymbol, the sensors' config and state, and the config's whitelist/swupdate/portalstate almost never change,
+## but every scan would serialize them all over again.  We remember the text we made for each one and hand it back
+## as long as the object hasn't changed:
+##   * If it is the very same object (our snapshots are never changed in place, see HueBridge.applySuccess),
+##     it can't have changed.
+##   * Otherwise, comparing the new object with the one we serialized last time is still much cheaper than
+##     serializing it again.
+## We don't trust a timestamp inside the object to tell us it changed:  a sensor's state.lastupdated only has
+## one-second resolution, and a button event and a presence change can land in the same second.
+##
+
+import json
+
+
+class SerializationCache(object):
+
+    def __init__(self):
+
+        # key -> (the object we serialized, its json text)
+        self.entries = {}
+
+
+    ############
+    # json.dumps(obj), reusing what we made last time for this key if obj hasn't changed.
+    def dumps(self, key, obj):
+
+        entry = self.entries.get(key)
+
+        if entry is not None:
+
+            lastObj, text = entry
+
+            if lastObj is obj:
+                return text
+
+            if lastObj == obj:
+                # Remember the new object, so next time the identity check is enough:
+                self.entries[key] = (obj, text)
+                return text
+
+        text = json.dumps(obj)
+        self.entries[key] = (obj, text)
+
+        return text
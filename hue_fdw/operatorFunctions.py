@@ -38,43 +38,69 @@ def overlap(a, b):
         return True
     return False
 
+## The regex and LIKE patterns in a qual are the same for every row of a scan, so we only compile each one once:
+_regexCache = {}
+
+def compiledRegex(pattern, flags=0):
+    key = (pattern, flags)
+    if not _regexCache.has_key(key):
+        _regexCache[key] = re.compile(pattern, flags)
+    return _regexCache[key]
+
+## Translate a LIKE pattern into an (anchored) regular expression:
+##   %  -> any run of characters
+##   _  -> any one character
+##   \x -> a literal x
+## and everything else matches itself.
+def likeToRegex(pattern):
+    regex = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex.append(re.escape(pattern[i]))
+        elif c == '%':
+            regex.append('.*')
+        elif c == '_':
+            regex.append('.')
+        else:
+            regex.append(re.escape(c))
+        i += 1
+    return '^' + ''.join(regex) + r'\Z'
+
+_likeCache = {}
+
+def compiledLike(pattern, flags=0):
+    key = (pattern, flags)
+    if not _likeCache.has_key(key):
+        _likeCache[key] = re.compile(likeToRegex(pattern), flags | re.S)
+    return _likeCache[key]
+
+## A NULL never matches a pattern:
 def regexSearch(a, b):
-    if re.search(b, a):
-        return True
-    else:
-        return False
+    return a is not None and compiledRegex(b).search(a) is not None
 
 def regexSearch_i(a, b):
-    if re.search(b, a, re.I):
-        return True
-    else:
-        return False
+    return a is not None and compiledRegex(b, re.I).search(a) is not None
 
 def notRegexSearch(a, b):
-     return not regexSearch(a, b)
+     return a is not None and not regexSearch(a, b)
 
 def notRegexSearch_i(a, b):
-     return not regexSearch_i(a, b)
+     return a is not None and not regexSearch_i(a, b)
 
 def likeSearch(a, b):
-    b.replace('%%', '.*')
-    b.replace('_', '.')
-    return regexSearch(a, b)
+    return a is not None and compiledLike(b).match(a) is not None
 
 def likeSearch_i(a, b):
-    b.replace('%%', '.*')
-    b.replace('_', '.')
-    return regexSearch_i(a, b)
+    return a is not None and compiledLike(b, re.I).match(a) is not None
 
 def notLikeSearch(a, b):
-    b.replace('%%', '.*')
-    b.replace('_', '.')
-    return not regexSearch(a, b)
+    return a is not None and not likeSearch(a, b)
 
 def notLikeSearch_i(a, b):
-    b.replace('%%', '.*')
-    b.replace('_', '.')
-    return not regexSearch_i(a, b)
+    return a is not None and not likeSearch_i(a, b)
 
 
 ################################################################################
@@ -90,39 +116,39 @@ def notLikeSearch_i(a, b):
 ##    JSON Operators
 ##    The Array operators when used on Ranges
 ## 
-def getOperatorFunction(opr):
+operatorFunctionMap = {
+    '<':              operator.lt,
+    '>':              operator.gt,
+    '<=':             operator.le,
+    '>=':             operator.ge,
+    '=':              operator.eq,
+    '<>':             operator.ne,
+    '!=':             operator.ne,
+    '@>':             operator.contains,
+    '<@':             reverseContains,
+    '<<':             strictlyLeft,
+    '>>':             strictlyRight,
+    '&<':             rightBounded,
+    '>&':             leftBounded,
+    '&&':             overlap,
+    'is':             operator.eq, # this one won't work in every sql context, but should for some cases
+    '~':              regexSearch,
+    '~*':             regexSearch_i,
+    '!~':             notRegexSearch,
+    '!~*':            notRegexSearch_i,
+    '~~':             likeSearch,
+    '!~~':            notLikeSearch,
+    'like':           likeSearch,
+    'not like':       notLikeSearch,
+    '~~*':            likeSearch_i,
+    '!~~*':           notLikeSearch_i,
+    'ilike':          likeSearch_i,
+    'not ilike':      notLikeSearch_i,
+    'similar to':     regexSearch,
+    'not similar to': notRegexSearch
+}
 
-  operatorFunctionMap = {
-      '<':              operator.lt,
-      '>':              operator.gt,
-      '<=':             operator.le,
-      '>=':             operator.ge,
-      '=':              operator.eq,
-      '<>':             operator.ne,
-      '!=':             operator.ne,
-      '@>':             operator.contains,
-      '<@':             reverseContains,
-      '<<':             strictlyLeft,
-      '>>':             strictlyRight,
-      '&<':             rightBounded,
-      '>&':             leftBounded,
-      '&&':             overlap,
-      'is':             operator.eq, # this one won't work in every sql context, but should for some cases
-      '~':              regexSearch,
-      '~*':             regexSearch_i,
-      '!~':             notRegexSearch,
-      '!~*':            notRegexSearch_i,
-      '~~':             likeSearch,
-      '!~~':            notLikeSearch,
-      'like':           likeSearch,
-      'not like':       notLikeSearch,
-      '~~*':            likeSearch_i,
-      '!~~*':           notLikeSearch_i,
-      'ilike':          likeSearch_i,
-      'not ilike':      likeSearch_i,
-      'similar to':     regexSearch,
-      'not similar to': notRegexSearch
-  }
+def getOperatorFunction(opr):
 
   if not operatorFunctionMap.has_key(opr):
       raise unknownOperatorException("'%s' is not a supported operator." % opr)
@@ -130,4 +156,78 @@ def getOperatorFunction(opr):
   return operatorFunctionMap[opr]
 
 
+################################################################################
+### Compile the quals for a scan into one function we can call on each row.
+## We look up every operator (and fail on one we don't know) once, before any rows are fetched,
+## rather than once per qual per row.
+##
+## List operators ("light_id = ANY(ARRAY[1,2])", "light_id <> ALL(...)") come to us from Multicorn
+## as an (operator, use_or) tuple with a list value.
+##
+## The returned function takes a row and returns True if every qual matches.
+## Rows are looked up by column name, unless columnIndex (column name -> position) is given,
+## in which case rows are sequences and we look up by position.
+##
+def compileQuals(quals, columnIndex=None):
+
+  tests = []
+
+  for qual in quals:
+
+      if columnIndex is None:
+          key = qual.field_name
+      else:
+          key = columnIndex[qual.field_name]
+
+      if qual.is_list_operator:
+          tests.append((key, listOperatorFunction(getOperatorFunction(qual.operator[0]), qual.operator[1]), qual.value))
+      else:
+          tests.append((key, getOperatorFunction(qual.operator), qual.value))
+
+  def rowMatches(row):
+      for key, operatorFunction, value in tests:
+          if not operatorFunction(row[key], value):
+              return False
+      return True
+
+  return rowMatches
+
+
+## "x op ANY(values)" / "x op ALL(values)":
+def listOperatorFunction(operatorFunction, useOr):
+
+  if useOr:
+      return lambda a, values: any(operatorFunction(a, b) for b in values)
+
+  return lambda a, values: all(operatorFunction(a, b) for b in values)
+
+
+################################################################################
+### Find a simple "column = value" qual.
+## The wrappers use this to push "where light_id = 3" down to a single resource GET (/lights/3)
+## instead of fetching the whole collection and filtering it here.
+## Returns None if there isn't one (or if the value is NULL, which can't match anything we'd fetch).
+##
+def getEqualityValue(quals, fieldName):
+
+  for qual in quals:
+      if qual.field_name == fieldName and qual.operator == '=' and qual.value is not None:
+          return qual.value
+
+  return None
+
+
+################################################################################
+### Find the values a "column = value" or "column in (...)" qual limits a column to.
+## The Lights and Sensors wrappers use this to only ask the bridges a "where bridge = ..." scan needs.
+## Returns None if there isn't one.
+##
+def getEqualityValues(quals, fieldName):
+
+  for qual in quals:
+      if qual.field_name == fieldName and qual.operator == '=' and qual.value is not None:
+          return [qual.value]
+      if qual.field_name == fieldName and qual.operator == ('=', True) and qual.value is not None:
+          return [value for value in qual.value if value is not None]
 
+  return None
@@ -0,0 +1,226 @@
+## Background recording of sensor state changes, for the Hue Sensor History FDW.
+##
+## Polling mysensors from a dashboard every second costs a bridge round trip per poll per client, and anything that
+## happens between polls (a motion sensor that trips and clears) is lost.  Instead, one background thread per bridge
+## polls /sensors, notices which sensors have a new state.lastupdated, and records their state values.
+## History queries are then answered from memory.
+##
+## Each sensor state value (eg. sensor 5's "presence", or sensor 7's "temperature") gets a fixed-size ring buffer,
+## stored as two array columns -- the times and the values -- rather than a list of dicts.  Once a buffer is full
+## the oldest entries are overwritten.
+##
+## The poll interval adapts:  it halves (down to poll_min_ms) when a poll finds changes, and grows by half again
+## (up to poll_max_ms) when it doesn't.
+##
+## The poller runs on its own thread, so it must never call log_to_postgres.  If it runs into trouble it keeps the
+## error in lastError for the next history scan to report.
+##
+
+import calendar
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+DEFAULT_HISTORY_SIZE = 1024
+DEFAULT_POLL_MIN_MS = 250
+DEFAULT_POLL_MAX_MS = 5000
+
+
+## One recorder per bridge and user, for the life of the backend:
+_recorders = {}
+
+
+################################################################################
+## Look up (or start) the recorder for a bridge.
+def getRecorder(hueBridge, userName, options):
+
+    key = (hueBridge.bridge, userName)
+
+    if key not in _recorders:
+        _recorders[key] = SensorHistoryRecorder(hueBridge, userName,
+                                                int(options.get('history_size', DEFAULT_HISTORY_SIZE)),
+                                                float(options.get('poll_min_ms', DEFAULT_POLL_MIN_MS)) / 1000,
+                                                float(options.get('poll_max_ms', DEFAULT_POLL_MAX_MS)) / 1000)
+        _recorders[key].start()
+
+    return _recorders[key]
+
+
+################################################################################
+## The bridge reports times like "2015-06-01T12:34:56" (UTC), or "none" if it doesn't have one.
+def parseLastUpdated(lastUpdated):
+
+    if not lastUpdated or lastUpdated == 'none':
+        return None
+
+    try:
+        return float(calendar.timegm(time.strptime(lastUpdated.split('.')[0], '%Y-%m-%dT%H:%M:%S')))
+
+    except ValueError:
+        return None
+
+
+## We record numbers and booleans.  (Booleans as 1 and 0.)
+def recordable(value):
+    return isinstance(value, (bool, int, long, float))
+
+
+################################################################################
+## A fixed-size ring buffer of (time, value) pairs for one sensor state value.
+## Entries are appended in time order, so the logical order (oldest to newest) is also sorted by time.
+class RingBuffer(object):
+
+    def __init__(self, size):
+
+        self.size = size
+        self.times = array('d', [0.0] * size)
+        self.values = array('d', [0.0] * size)
+
+        # The next slot to write, and how many slots are in use:
+        self.head = 0
+        self.count = 0
+
+
+    def append(self, when, value):
+
+        self.times[self.head] = when
+        self.values[self.head] = float(value)
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+
+    ############
+    # The entries with lower <= time <= upper (either bound may be None), oldest first.
+    def between(self, lower, upper):
+
+        start = (self.head - self.count) % self.size
+
+        # A sorted view of the times, by logical position, for bisect:
+        times = _LogicalView(self.times, start, self.count)
+
+        first = 0 if lower is None else bisect_left(times, lower)
+        last = self.count if upper is None else bisect_right(times, upper)
+
+        for i in xrange(first, last):
+            slot = (start + i) % self.size
+            yield (self.times[slot], self.values[slot])
+
+
+## Index a ring buffer's array in logical (oldest first) order:
+class _LogicalView(object):
+
+    def __init__(self, data, start, count):
+        self.data = data
+        self.start = start
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.data[(self.start + i) % len(self.data)]
+
+
+################################################################################
+## Polls one bridge's sensors on a background thread and records what changes.
+class SensorHistoryRecorder(threading.Thread):
+
+    def __init__(self, hueBridge, userName, historySize, pollMin, pollMax):
+
+        super(SensorHistoryRecorder, self).__init__()
+        self.daemon = True
+
+        self.hueBridge = hueBridge
+        self.userName = userName
+        self.historySize = historySize
+        self.pollMin = pollMin
+        self.pollMax = pollMax
+        self.pollInterval = pollMin
+
+        # (sensor_id, state key) -> RingBuffer
+        self.buffers = {}
+
+        # sensor_id -> the last state.lastupdated we recorded
+        self.lastUpdated = {}
+
+        # The scan side reads self.buffers while we add to it:
+        self.lock = threading.Lock()
+
+        self.lastError = None
+
+
+    def run(self):
+
+        while True:
+
+            try:
+                changed = self.poll()
+                self.lastError = None
+
+            except Exception, e:
+                # Keep going; the bridge may just be busy or rebooting.
+                changed = False
+                self.lastError = e
+
+            if changed:
+                self.pollInterval = max(self.pollMin, self.pollInterval / 2)
+            else:
+                self.pollInterval = min(self.pollMax, self.pollInterval * 1.5)
+
+            time.sleep(self.pollInterval)
+
+
+    ############
+    # One poll of the bridge.  Returns True if any sensor had changed.
+    def poll(self):
+
+        sensors = self.hueBridge.fetch(self.userName, 'sensors/')
+
+        # Our poll is as good as any scan's, so let the sensors tables use it too:
+        self.hueBridge.storeSnapshot(self.userName, 'sensors', sensors)
+
+        changed = False
+
+        for sensorID, sensor in sensors.items():
+
+            state = sensor.get('state', {})
+            lastUpdated = state.get('lastupdated')
+
+            if lastUpdated is None or self.lastUpdated.get(sensorID) == lastUpdated:
+                continue
+
+            self.lastUpdated[sensorID] = lastUpdated
+
+            when = parseLastUpdated(lastUpdated)
+            if when is None:
+                continue
+
+            changed = True
+
+            with self.lock:
+                for key, value in state.items():
+                    if recordable(value):
+                        bufferKey = (int(sensorID), key)
+                        if bufferKey not in self.buffers:
+                            self.buffers[bufferKey] = RingBuffer(self.historySize)
+                        self.buffers[bufferKey].append(when, value)
+
+        return changed
+
+
+    ############
+    # The recorded history as (sensor_id, state key, time, value), oldest first for each sensor value.
+    # sensorIDs limits it to those sensors (None for all of them); lower/upper limit the times (None for no limit).
+    def history(self, sensorIDs, lower, upper):
+
+        with self.lock:
+            keys = sorted(self.buffers.keys())
+            if sensorIDs is not None:
+                keys = [key for key in keys if key[0] in sensorIDs]
+            results = [(key, list(self.buffers[key].between(lower, upper))) for key in keys]
+
+        for (sensorID, stateKey), entries in results:
+            for when, value in entries:
+                yield (sensorID, stateKey, when, value)
@@ -0,0 +1,83 @@
+## The flattened columns for each type of sensor, used by the Hue Sensors FDW when a table has the "sensor_type" option.
+##
+## Each sensor type keeps different things in its "config" and "state" objects:
+##   http://www.developers.meethue.com/documentation/supported-sensors
+## so the plain sensors table leaves them as json.  A table limited to one sensor type can instead have a real,
+## typed column for each of them, pulled straight out of the bridge's response.  That saves serializing them to json
+## only to have a view parse them back out, and lets the values take part in the where clause like any other column.
+##
+## Each entry maps a column name to the ("config" or "state", key) it comes from.
+##
+
+## Most sensors share these:
+_batteryConfig = { 'is_on'          : ('config', 'on'),
+                   'battery'        : ('config', 'battery'),
+                   'reachable'      : ('config', 'reachable'),
+                   'alert'          : ('config', 'alert'),
+                   'led_indication' : ('config', 'ledindication'),
+                   'user_test'      : ('config', 'usertest'),
+                   'last_updated'   : ('state',  'lastupdated') }
+
+def _withBatteryConfig(columns):
+    merged = dict(_batteryConfig)
+    merged.update(columns)
+    return merged
+
+
+sensorTypeColumns = {
+
+    'Daylight'       : { 'is_on'          : ('config', 'on'),
+                         'configured'     : ('config', 'configured'),
+                         'sunrise_offset' : ('config', 'sunriseoffset'),
+                         'sunset_offset'  : ('config', 'sunsetoffset'),
+                         'daylight'       : ('state',  'daylight'),
+                         'last_updated'   : ('state',  'lastupdated') },
+
+    'ZLLPresence'    : _withBatteryConfig({ 'sensitivity'     : ('config', 'sensitivity'),
+                                            'sensitivity_max' : ('config', 'sensitivitymax'),
+                                            'presence'        : ('state',  'presence') }),
+
+    # Hundredths of a degree Celsius:
+    'ZLLTemperature' : _withBatteryConfig({ 'temperature' : ('state', 'temperature') }),
+
+    'ZLLLightLevel'  : _withBatteryConfig({ 'threshold_dark'   : ('config', 'tholddark'),
+                                            'threshold_offset' : ('config', 'tholdoffset'),
+                                            'light_level'      : ('state',  'lightlevel'),
+                                            'dark'             : ('state',  'dark'),
+                                            'daylight'         : ('state',  'daylight') }),
+
+    'ZLLSwitch'      : _withBatteryConfig({ 'button_event' : ('state', 'buttonevent') }),
+
+    'ZGPSwitch'      : { 'is_on'        : ('config', 'on'),
+                         'button_event' : ('state',  'buttonevent'),
+                         'last_updated' : ('state',  'lastupdated') },
+
+    'CLIPGenericFlag'   : { 'is_on'        : ('config', 'on'),
+                            'flag'         : ('state',  'flag'),
+                            'last_updated' : ('state',  'lastupdated') },
+
+    'CLIPGenericStatus' : { 'is_on'        : ('config', 'on'),
+                            'status'       : ('state',  'status'),
+                            'last_updated' : ('state',  'lastupdated') },
+}
+
+
+## The bridge says "none" rather than leaving out a timestamp it doesn't have yet.
+## That would fail to load into a timestamp column, so it becomes a NULL:
+noneStringColumns = ['last_updated']
+
+def noneToNull(value):
+    if value == 'none':
+        return None
+    return value
+
+
+################################################################################
+## Look up a sensor type by name, ignoring case.  Returns the bridge's spelling of it, or None.
+def findSensorType(name):
+
+    for sensorType in sensorTypeColumns.keys():
+        if sensorType.lower() == name.lower():
+            return sensorType
+
+    return None
@@ -0,0 +1,285 @@
+## This is used by the Hue Lights FDW to turn the rows of a multi-row UPDATE into as few bridge commands as it can.
+##
+## Multicorn hands us one update() call per row, and the simple thing to do is PUT /lights/<id>/state for each of them.
+## With 50 lights that is 50 serialized ZigBee unicasts, and you can watch the lights change one after another.
+## Instead we collect the rows of the statement and, when several lights are getting exactly the same state:
+##   * if it is every light on the bridge, send one PUT to /groups/0/action (the built-in "all lights" group),
+##   * if an existing group has exactly those lights, send one PUT to that group's action,
+##   * otherwise create a temporary group for them, PUT its action, and delete it again.
+## Lights whose state isn't shared with enough others still get their own PUT.
+##
+## Whatever commands are left over are sent concurrently (see commandDispatch.py), so a statement that gives
+## every light a different color takes about as long as the slowest light instead of the sum of all of them.
+## Everything goes out through the bridge's command scheduler, so we still stay inside the bridge's rate limits.
+##
+
+import json
+
+from hueBridge import hueBridgeException
+from commandScheduler import Command
+from hue_errors import describeErrors
+
+
+## The bridge only keeps 64 groups, and making one costs us a POST and a DELETE on top of the action PUT.
+## So only build a temporary group when it saves more requests than it costs.
+TEMPORARY_GROUP_OVERHEAD = 3
+TEMPORARY_GROUP_NAME = 'hue_fdw temporary'
+
+## The light list and the group memberships change rarely, so we can lean on an older snapshot for planning:
+TOPOLOGY_TTL = 60
+
+
+################################################################################
+## Collects the light state changes for one statement, then plans and sends them.
+class UpdatePlanner(object):
+
+    def __init__(self, hueBridge, userName, groupUpdates, minGroupSize, maxConcurrentCommands):
+
+        self.hueBridge = hueBridge
+        self.userName = userName
+        self.groupUpdates = groupUpdates
+        self.minGroupSize = minGroupSize
+        self.maxConcurrentCommands = maxConcurrentCommands
+
+        # light_id (as a string, the way the bridge keys them) -> state payload
+        self.pending = {}
+
+        # Copies of pending as it was at each open savepoint (see the Lights FDW's "transactional" option):
+        self.savepoints = []
+
+        # Things the wrapper should tell the user about, but that didn't stop the statement (see takeWarnings()):
+        self.warnings = []
+
+
+    ############
+    # Queue up a state change for one light.
+    # If the same light shows up twice before we flush, the later values win.
+    def add(self, lightID, payload):
+
+        lightID = str(lightID)
+
+        if lightID in self.pending:
+            merged = dict(self.pending[lightID])
+            merged.update(payload)
+            payload = merged
+
+        self.pending[lightID] = payload
+
+
+    ############
+    # Forget everything we've queued (the transaction rolled back), including anything a failed flush() left with the scheduler.
+    def discard(self):
+        self.pending = {}
+        self.savepoints = []
+        self.hueBridge.scheduler.discard(self)
+
+
+    ############
+    # SAVEPOINT, RELEASE SAVEPOINT, and ROLLBACK TO SAVEPOINT.  add() never changes a payload in place,
+    # so a shallow copy of pending is enough to go back to.
+    def savepoint(self):
+        self.savepoints.append(dict(self.pending))
+
+    def release(self):
+        if self.savepoints:
+            self.savepoints.pop()
+
+    def rollbackToSavepoint(self):
+        if self.savepoints:
+            self.pending = self.savepoints.pop()
+
+
+    ############
+    # Turn the queued changes into commands.
+    # We hand back the commands and the ids of any temporary groups we had to create for them.
+    def plan(self):
+
+        # Bucket the lights by identical payload:
+        byPayload = {}
+        for lightID, payload in self.pending.items():
+            key = json.dumps(payload, sort_keys=True)
+            if key not in byPayload:
+                byPayload[key] = (payload, set())
+            byPayload[key][1].add(lightID)
+
+        commands = []
+        temporaryGroups = []
+
+        for payload, lightIDs in byPayload.values():
+
+            if not self.groupUpdates or len(lightIDs) < self.minGroupSize:
+                commands.extend(self._lightCommands(payload, lightIDs))
+                continue
+
+            groupID = self._findGroup(lightIDs)
+
+            if groupID is None and len(lightIDs) > TEMPORARY_GROUP_OVERHEAD:
+                groupID = self._createTemporaryGroup(lightIDs)
+                if groupID is not None:
+                    temporaryGroups.append(groupID)
+
+            if groupID is None:
+                commands.extend(self._lightCommands(payload, lightIDs))
+            else:
+                commands.append(Command('groups/%s/action' % groupID, payload, sorted(lightIDs), isGroup=True))
+
+        return commands, temporaryGroups
+
+
+    ############
+    # Plan and send everything we've collected.
+    # Returns a list of the failures, already formatted for the log.
+    def flush(self):
+
+        if not self.pending:
+            return []
+
+        # Whatever happens from here on, these changes have had their turn.  They mustn't go out again with the next statement.
+        try:
+            commands, temporaryGroups = self.plan()
+        finally:
+            self.pending = {}
+            self.savepoints = []
+
+        failures = []
+        errors = []
+
+        for command in commands:
+            self.hueBridge.scheduler.submit(self.userName, command, self)
+
+        # The PUTs go out concurrently; we look at the answers back here on the backend's thread.
+        # (The scheduler has already sent again whatever failed for the bridge's own reasons.)
+        for command, hueResults, e in self.hueBridge.scheduler.drain(self.maxConcurrentCommands, self):
+
+            if e is not None:
+                self.hueBridge.invalidate(self.userName, 'lights')
+                failures.append('%s:  %s' % (command, e))
+            else:
+                errors.extend(self._checkResults(command, hueResults))
+
+        for groupID in temporaryGroups:
+            self._deleteGroup(groupID)
+
+        # Every light that, say, was switched off gets reported in the one message:
+        return failures + describeErrors(errors)
+
+
+    ############
+    # The warnings flush() ran into, for the wrapper to log.  We hand each one back once.
+    def takeWarnings(self):
+
+        warnings = self.warnings
+        self.warnings = []
+
+        return warnings
+
+
+    ############
+    # Keep the light snapshot in step with whatever the bridge says it changed, and collect the errors for what it didn't.
+    # The bridge answers each attribute separately, so one that failed doesn't stop us keeping the others.
+    def _checkResults(self, command, hueResults):
+
+        errors = []
+
+        if not isinstance(hueResults, list):
+            self.hueBridge.invalidate(self.userName, 'lights')
+            return [{'address': '/' + command.address, 'description': 'unexpected response %s' % hueResults}]
+
+        for status in hueResults:
+
+            if status.has_key('success'):
+
+                if command.isGroup:
+                    # "/groups/0/action/on" tells us "/lights/<id>/state/on" for every light in the group:
+                    for address, value in status['success'].items():
+                        attribute = address.split('/')[-1]
+                        for lightID in command.lightIDs:
+                            self.hueBridge.applySuccess(self.userName, {'/lights/%s/state/%s' % (lightID, attribute): value})
+                else:
+                    self.hueBridge.applySuccess(self.userName, status['success'])
+
+            else:
+
+                # An attribute that failed on one light didn't change, but we can't tell which lights of a group it failed on:
+                if command.isGroup:
+                    self.hueBridge.invalidate(self.userName, 'lights')
+
+                errors.append(status.get('error', {'address': '/' + command.address, 'description': '%s' % status}))
+
+        return errors
+
+
+    ############
+    # One PUT per light:
+    def _lightCommands(self, payload, lightIDs):
+        return [Command('lights/%s/state' % lightID, payload, [lightID]) for lightID in sorted(lightIDs)]
+
+
+    ############
+    # Is there a group on the bridge that covers exactly these lights?
+    def _findGroup(self, lightIDs):
+
+        try:
+
+            allLights = self.hueBridge.snapshot(self.userName, 'lights', TOPOLOGY_TTL)
+
+            # Group 0 is every light the bridge knows about.  It isn't listed under /groups.
+            if lightIDs == set(allLights.keys()):
+                return '0'
+
+            groups = self.hueBridge.snapshot(self.userName, 'groups', TOPOLOGY_TTL)
+
+        except hueBridgeException:
+
+            # We can always fall back to addressing the lights one at a time.
+            return None
+
+        if not isinstance(groups, dict):
+            return None
+
+        for groupID, group in groups.items():
+            if set(group.get('lights', [])) == lightIDs:
+                return groupID
+
+        return None
+
+
+    ############
+    # Make a group just for this statement.
+    def _createTemporaryGroup(self, lightIDs):
+
+        url = self.hueBridge.apiURL(self.userName, 'groups')
+
+        try:
+
+            results = self.hueBridge.post(url, json.dumps({'name': TEMPORARY_GROUP_NAME, 'lights': sorted(lightIDs)}))
+            hueResults = json.loads(results.text)
+
+        except (hueBridgeException, ValueError):
+
+            # We can always fall back to addressing the lights one at a time.
+            return None
+
+        # The bridge answers with [{"success": {"id": "7"}}], or an error if its group table is full (301):
+        if not isinstance(hueResults, list):
+            return None
+
+        for status in hueResults:
+            if status.has_key('success'):
+                return status['success']['id']
+
+        return None
+
+
+    ############
+    # Clean up after ourselves.  If this fails the group is left on the bridge; it is harmless, and
+    # since it has exactly the same lights, the next statement that needs it will find and reuse it.
+    # So the lights we've already changed still count, and we only warn about it.
+    def _deleteGroup(self, groupID):
+
+        try:
+            self.hueBridge.delete(self.hueBridge.apiURL(self.userName, 'groups/%s' % groupID))
+        except hueBridgeException, e:
+            self.warnings.append('Could not delete the temporary group %s from the Hue Bridge %s:  %s' % (groupID, self.hueBridge.bridge, e))
+
+        self.hueBridge.invalidate(self.userName, 'groups')
@@ -0,0 +1,58 @@
+## Unit tests for the pieces of hue_fdw that don't need a bridge or a PostgreSQL backend to run.
+##
+## Run them from the top of the repository with:
+##    python -m unittest discover -s tests -t .
+##
+## The wrapper modules import each other by their bare names (eg. "from hueBridge import ..."), the way Multicorn
+## loads them, so hue_fdw itself goes on the path.
+##
+## Multicorn's log_to_postgres only works inside a PostgreSQL backend, so outside one (where the real module can't be
+## imported) we put in a small stand-in that keeps the messages, and raises PostgresError for an ERROR the way
+## PostgreSQL would abort the statement.
+##
+
+import os
+import sys
+import types
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'hue_fdw'))
+
+
+class PostgresError(Exception):
+    pass
+
+
+## Everything logged, as (level, message):
+logged = []
+
+
+def _installMulticornStandIn():
+
+    DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+
+    def log_to_postgres(message, level=INFO, hint=None, detail=None):
+        logged.append((level, '%s' % message))
+        if level >= ERROR:
+            raise PostgresError('%s' % message)
+
+    class ForeignDataWrapper(object):
+        def __init__(self, options, columns):
+            pass
+
+    multicorn = types.ModuleType('multicorn')
+    multicorn.ForeignDataWrapper = ForeignDataWrapper
+
+    utils = types.ModuleType('multicorn.utils')
+    utils.log_to_postgres = log_to_postgres
+    utils.DEBUG, utils.INFO, utils.WARNING, utils.ERROR = DEBUG, INFO, WARNING, ERROR
+
+    multicorn.utils = utils
+    sys.modules['multicorn'] = multicorn
+    sys.modules['multicorn.utils'] = utils
+
+
+try:
+    import multicorn.utils
+except ImportError:
+    _installMulticornStandIn()
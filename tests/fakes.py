@@ -0,0 +1,90 @@
+## Stand-ins for a bridge and for Multicorn's quals, for the tests.
+
+import json
+
+from hueBridge import HueBridge
+
+
+################################################################################
+## A qual the way Multicorn hands us one:  "field_name operator value".
+## A list operator ("x = ANY(...)") is an (operator, use_or) tuple with a list value.
+class Qual(object):
+
+    def __init__(self, field_name, operator, value):
+        self.field_name = field_name
+        self.operator = operator
+        self.value = value
+
+    @property
+    def is_list_operator(self):
+        return isinstance(self.operator, tuple)
+
+
+################################################################################
+## The bridge's answer to one request.
+class Response(object):
+
+    def __init__(self, data):
+        self.text = json.dumps(data)
+        self.content = self.text
+
+
+################################################################################
+## A HueBridge that never goes near the network.
+##
+## Every request is kept in self.requests as (method, address, decoded body), where address is the part of the URL
+## after /api/<username>/.  What comes back is:
+##   * whatever answer(method, address, body) returns, if the test set one,
+##   * otherwise for GET, that part of self.datastore,
+##   * for PUT, a success for every attribute we sent,
+##   * for POST, a new id,
+##   * for DELETE, a success.
+class FakeBridge(HueBridge):
+
+    def __init__(self, datastore=None, bridge='fake-bridge'):
+
+        super(FakeBridge, self).__init__(bridge, 1, 60)
+
+        # No waiting on the token buckets or between retries:
+        self.scheduler.configure(0, 0)
+        self.configureRequests(1, 1, 0, 0, False)
+
+        self.datastore = datastore or {}
+        self.requests = []
+        self.answer = None
+        self.nextID = 100
+
+
+    def request(self, method, url, data=None):
+
+        path = url.split('/api/', 1)[1].split('/', 1)
+        address = path[1] if len(path) > 1 else ''
+        body = json.loads(data) if data else None
+
+        self.requests.append((method, address, body))
+
+        if self.answer is not None:
+            answer = self.answer(method, address, body)
+            if answer is not None:
+                return Response(answer)
+
+        if method == 'GET':
+            node = self.datastore
+            for name in [name for name in address.split('/') if name]:
+                node = node[name]
+            return Response(node)
+
+        if method == 'PUT':
+            return Response([{'success': {'/%s/%s' % (address, key): value}} for key, value in body.items()])
+
+        if method == 'POST':
+            self.nextID += 1
+            return Response([{'success': {'id': str(self.nextID)}}])
+
+        return Response([{'success': '/%s deleted' % address}])
+
+
+    ############
+    # The PUTs we've sent, as (address, body):
+    def puts(self):
+        return [(address, body) for method, address, body in self.requests if method == 'PUT']
@@ -0,0 +1,113 @@
+import unittest
+from collections import OrderedDict
+
+from tests.fakes import FakeBridge
+
+import HueGroupsFDW
+
+
+COLUMNS = ['group_id', 'group_name', 'light_ids', 'is_on', 'brightness', 'xy', 'alert']
+
+
+def groupsBridge():
+    return FakeBridge({'groups': {'1': {'name': 'Kitchen', 'lights': ['1', '2'], 'type': 'Room',
+                                        'state': {'any_on': True, 'all_on': True},
+                                        'action': {'on': True, 'bri': 100, 'xy': [0.3, 0.3], 'alert': 'select'}}},
+                       'lights': {'1': {'state': {'on': True}}, '2': {'state': {'on': True}}}})
+
+
+class HueGroupsFDWTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.bridge = groupsBridge()
+
+        getBridge = HueGroupsFDW.getBridge
+        HueGroupsFDW.getBridge = lambda bridge, options: self.bridge
+        self.addCleanup(setattr, HueGroupsFDW, 'getBridge', getBridge)
+
+    def wrapper(self, **options):
+
+        options.update({'bridge': 'fake-bridge', 'username': 'u'})
+
+        return HueGroupsFDW.HueGroupsFDW(options, OrderedDict([(column, None) for column in COLUMNS]))
+
+    def scan(self, groups):
+        return [dict(zip(COLUMNS, row)) for row in groups.execute([], set(COLUMNS))]
+
+    ############
+    # One statement:  "update mygroups set ... where group_id = 1"
+    def updateGroup(self, groups, **changes):
+
+        [row] = self.scan(groups)
+        row.update(changes)
+
+        groups.update(1, row)
+        groups.end_modify()
+
+    def test_only_the_changed_columns_are_sent(self):
+
+        groups = self.wrapper()
+        self.updateGroup(groups, brightness=20)
+
+        self.assertEqual(self.bridge.puts(), [('groups/1/action', {'bri': 20, 'alert': 'select', 'transitiontime': 4})])
+
+    def test_nothing_is_sent_when_nothing_changed(self):
+
+        self.bridge.datastore['groups']['1']['action']['alert'] = 'none'
+
+        groups = self.wrapper()
+        self.updateGroup(groups, is_on='t', xy=[0.30001, 0.3])
+
+        self.assertEqual(self.bridge.puts(), [])
+
+    def test_an_alert_is_always_sent(self):
+
+        groups = self.wrapper()
+        self.updateGroup(groups, alert='select')
+
+        self.assertEqual(self.bridge.puts(), [('groups/1/action', {'alert': 'select', 'transitiontime': 4})])
+
+    def test_a_transaction_compares_with_its_own_pending_action(self):
+
+        self.bridge.datastore['groups']['1']['action']['alert'] = 'none'
+
+        groups = self.wrapper(transactional='true')
+        self.updateGroup(groups, is_on=False)
+        self.updateGroup(groups, is_on=True)
+
+        self.assertEqual(self.bridge.puts(), [])
+
+        groups.pre_commit()
+
+        self.assertEqual(self.bridge.puts(), [('groups/1/action', {'on': True, 'transitiontime': 4})])
+
+    def test_a_transaction_reads_its_own_writes(self):
+
+        groups = self.wrapper(transactional='true')
+        self.updateGroup(groups, is_on=False, brightness=5)
+
+        [row] = self.scan(groups)
+
+        self.assertEqual((row['is_on'], row['brightness']), (False, 5))
+
+        groups.rollback()
+
+        [row] = self.scan(groups)
+
+        self.assertEqual((row['is_on'], row['brightness']), (True, 100))
+
+    def test_a_failed_statement_sends_nothing_later(self):
+
+        groups = self.wrapper()
+
+        [row] = self.scan(groups)
+        row['is_on'] = False
+        groups.update(1, row)
+
+        # The statement errors before end_modify(), and the transaction rolls back:
+        groups.rollback()
+
+        self.updateGroup(groups, brightness=20)
+
+        self.assertEqual([body.get('on') for address, body in self.bridge.puts()], [None])
@@ -0,0 +1,70 @@
+import time
+import unittest
+
+from circuitBreaker import CircuitBreaker, retryDelay, MAX_RETRY_DELAY
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_opens_after_enough_failures_in_a_row(self):
+
+        breaker = CircuitBreaker(3, 60)
+
+        breaker.failed()
+        breaker.failed()
+        breaker.succeeded()
+        breaker.failed()
+        breaker.failed()
+
+        self.assertTrue(breaker.allow())
+
+        breaker.failed()
+
+        self.assertFalse(breaker.allow())
+        self.assertTrue(breaker.retryIn() > 59)
+
+    def test_half_open_lets_one_request_through(self):
+
+        breaker = CircuitBreaker(1, 60)
+        breaker.failed()
+
+        # The reset timeout has gone by:
+        breaker.openedAt = time.time() - 61
+
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+        breaker.succeeded()
+
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.retryIn(), 0)
+
+    def test_a_failed_trial_opens_it_again(self):
+
+        breaker = CircuitBreaker(5, 60)
+        breaker.openedAt = time.time() - 61
+
+        self.assertTrue(breaker.allow())
+
+        breaker.failed()
+
+        self.assertFalse(breaker.allow())
+
+    def test_a_threshold_of_0_never_opens(self):
+
+        breaker = CircuitBreaker(0, 60)
+
+        for i in range(20):
+            breaker.failed()
+
+        self.assertTrue(breaker.allow())
+
+
+class RetryDelayTest(unittest.TestCase):
+
+    def test_delays_double_up_to_the_limit(self):
+
+        for i in range(50):
+            self.assertTrue(0 <= retryDelay(1, 0.1) <= 0.1)
+            self.assertTrue(0 <= retryDelay(3, 0.1) <= 0.4)
+            self.assertTrue(0 <= retryDelay(20, 0.1) <= MAX_RETRY_DELAY)
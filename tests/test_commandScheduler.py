@@ -0,0 +1,140 @@
+import unittest
+
+from tests.fakes import FakeBridge
+
+from commandScheduler import Command, CommandBuffer, mergeCommands, retryCommand
+
+
+class CommandBufferTest(unittest.TestCase):
+
+    def test_commands_for_one_resource_merge_newest_wins(self):
+
+        buffer = CommandBuffer()
+        buffer.add(Command('groups/1/action', {'on': False, 'bri': 10}, ['1']))
+        buffer.add(Command('groups/2/action', {'on': True}, ['3']))
+        buffer.add(Command('groups/1/action', {'on': True}, ['2']))
+
+        commands = buffer.take()
+
+        self.assertEqual([command.address for command in commands], ['groups/1/action', 'groups/2/action'])
+        self.assertEqual(commands[0].payload, {'on': True, 'bri': 10})
+        self.assertEqual(commands[0].lightIDs, ['1', '2'])
+        self.assertEqual(buffer.take(), [])
+
+    def test_rollback_to_savepoint_drops_only_what_came_after(self):
+
+        buffer = CommandBuffer()
+        buffer.add(Command('sensors/1', {'status': 1}))
+        buffer.savepoint()
+        buffer.add(Command('sensors/1', {'status': 2}))
+        buffer.add(Command('sensors/2', {'status': 3}))
+        buffer.rollbackToSavepoint()
+
+        commands = buffer.take()
+
+        self.assertEqual(len(commands), 1)
+        self.assertEqual(commands[0].payload, {'status': 1})
+
+    def test_released_savepoint_keeps_its_changes(self):
+
+        buffer = CommandBuffer()
+        buffer.savepoint()
+        buffer.add(Command('config', {'name': 'New'}))
+        buffer.release()
+
+        # Nothing left to roll back to:
+        buffer.rollbackToSavepoint()
+
+        self.assertEqual([command.payload for command in buffer.take()], [{'name': 'New'}])
+
+    def test_discard_forgets_everything(self):
+
+        buffer = CommandBuffer()
+        buffer.add(Command('config', {'name': 'New'}))
+        buffer.savepoint()
+        buffer.discard()
+
+        self.assertEqual(buffer.take(), [])
+        self.assertEqual(buffer.savepoints, [])
+
+    def test_merge_does_not_change_the_waiting_command(self):
+
+        waiting = Command('lights/1/state', {'on': True}, ['1'])
+        merged = mergeCommands(waiting, Command('lights/1/state', {'bri': 5}, ['1']))
+
+        self.assertEqual(waiting.payload, {'on': True})
+        self.assertEqual(merged.payload, {'on': True, 'bri': 5})
+
+
+class CommandSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bridge = FakeBridge()
+        self.scheduler = self.bridge.scheduler
+
+    def test_drain_sends_only_the_owners_commands(self):
+
+        groups, rules = object(), object()
+
+        self.scheduler.submit('u', Command('groups/1/action', {'on': False}, isGroup=True), groups)
+        self.scheduler.submit('u', Command('rules/2', {'name': 'Rule'}), rules)
+
+        results = self.scheduler.drain(1, rules)
+
+        self.assertEqual([command.address for command, hueResults, e in results], ['rules/2'])
+        self.assertEqual(self.bridge.puts(), [('rules/2', {'name': 'Rule'})])
+
+        self.scheduler.drain(1, groups)
+
+        self.assertEqual(self.bridge.puts()[-1], ('groups/1/action', {'on': False}))
+
+    def test_discarded_commands_are_never_sent(self):
+
+        groups, rules = object(), object()
+
+        self.scheduler.submit('u', Command('groups/1/action', {'on': False}, isGroup=True), groups)
+        self.scheduler.submit('u', Command('rules/2', {'name': 'Rule'}), rules)
+        self.scheduler.discard(groups)
+
+        self.assertEqual(self.scheduler.drain(1, groups), [])
+        self.assertEqual(len(self.scheduler.drain(1, rules)), 1)
+        self.assertEqual(self.bridge.puts(), [('rules/2', {'name': 'Rule'})])
+
+    def test_transient_errors_are_sent_again_on_their_own(self):
+
+        tries = []
+
+        def answer(method, address, body):
+            tries.append(body)
+            if len(tries) == 1:
+                return [{'success': {'/lights/1/state/on': True}},
+                        {'error': {'type': 901, 'address': '/lights/1/state/bri', 'description': 'Internal error, 404'}}]
+
+        self.bridge.answer = answer
+        owner = object()
+
+        self.scheduler.submit('u', Command('lights/1/state', {'on': True, 'bri': 5, 'transitiontime': 4}, ['1']), owner)
+        [(command, hueResults, e)] = self.scheduler.drain(1, owner)
+
+        self.assertEqual(tries[1], {'bri': 5, 'transitiontime': 4})
+        self.assertIn({'success': {'/lights/1/state/on': True}}, hueResults)
+        self.assertIn({'success': {'/lights/1/state/bri': 5}}, hueResults)
+        self.assertEqual([status for status in hueResults if 'error' in status], [])
+
+
+class RetryCommandTest(unittest.TestCase):
+
+    def test_nothing_to_retry_without_transient_errors(self):
+
+        command = Command('lights/1/state', {'bri': 5})
+        hueResults = [{'error': {'type': 201, 'address': '/lights/1/state/bri', 'description': 'Device is set to off.'}}]
+
+        self.assertEqual(retryCommand(command, hueResults), None)
+        self.assertEqual(retryCommand(command, {'error': 'not a list'}), None)
+
+    def test_an_error_about_the_whole_resource_retries_all_of_it(self):
+
+        command = Command('lights/1/state', {'on': True, 'bri': 5})
+        hueResults = [{'error': {'type': 901, 'address': '/lights/1/state', 'description': 'Internal error'}}]
+
+        self.assertEqual(retryCommand(command, hueResults).payload, {'on': True, 'bri': 5})
@@ -0,0 +1,71 @@
+import unittest
+
+from eventStream import v1Changes, v1Time, lightLevelFlags
+
+
+class V1ChangesTest(unittest.TestCase):
+
+    def test_light(self):
+
+        resource = {'id_v1': '/lights/3', 'type': 'light', 'on': {'on': True}, 'dimming': {'brightness': 50.0},
+                    'color': {'xy': {'x': 0.4, 'y': 0.5}}}
+
+        self.assertEqual(v1Changes(resource, '2022-01-01T12:34:56Z'),
+                         ('lights', '3', {'state': {'on': True, 'bri': 127, 'xy': [0.4, 0.5], 'colormode': 'xy'}}))
+
+    def test_brightness_stays_within_the_v1_range(self):
+
+        endpoint, resourceID, changes = v1Changes({'id_v1': '/lights/1', 'type': 'light', 'dimming': {'brightness': 0.0}}, None)
+
+        self.assertEqual(changes['state']['bri'], 1)
+
+    def test_sensor_changes_are_stamped_with_when_they_happened(self):
+
+        resource = {'id_v1': '/sensors/5', 'type': 'motion', 'motion': {'motion': True}}
+
+        self.assertEqual(v1Changes(resource, '2022-01-01T12:34:56.789Z'),
+                         ('sensors', '5', {'state': {'presence': True, 'lastupdated': '2022-01-01T12:34:56'}}))
+
+    def test_temperature_and_battery(self):
+
+        self.assertEqual(v1Changes({'id_v1': '/sensors/6', 'type': 'temperature', 'temperature': {'temperature': 21.5}}, None),
+                         ('sensors', '6', {'state': {'temperature': 2150}}))
+        self.assertEqual(v1Changes({'id_v1': '/sensors/6', 'type': 'device_power', 'power_state': {'battery_level': 80}}, None),
+                         ('sensors', '6', {'config': {'battery': 80}}))
+
+    def test_reachability(self):
+
+        self.assertEqual(v1Changes({'id_v1': '/lights/2', 'type': 'zigbee_connectivity', 'status': 'connectivity_issue'}, None),
+                         ('lights', '2', {'state': {'reachable': False}}))
+        self.assertEqual(v1Changes({'id_v1': '/sensors/2', 'type': 'zigbee_connectivity', 'status': 'connected'}, None),
+                         ('sensors', '2', {'config': {'reachable': True}}))
+
+    def test_other_resources(self):
+
+        # Not a lights or sensors resource:
+        self.assertEqual(v1Changes({'id_v1': '/groups/1', 'type': 'grouped_light', 'on': {'on': True}}, None), None)
+        self.assertEqual(v1Changes({'type': 'light'}, None), None)
+
+        # One of ours, but nothing we know how to translate:
+        self.assertEqual(v1Changes({'id_v1': '/lights/1', 'type': 'light', 'effects': {}}, None), ('lights', '1', None))
+
+    def test_v1_time(self):
+
+        self.assertEqual(v1Time('2022-01-01T12:34:56Z'), '2022-01-01T12:34:56')
+        self.assertEqual(v1Time(None), None)
+
+
+class LightLevelFlagsTest(unittest.TestCase):
+
+    def test_dark_and_daylight(self):
+
+        config = {'tholddark': 16000, 'tholdoffset': 7000}
+
+        self.assertEqual(lightLevelFlags(12000, config), {'dark': True, 'daylight': False})
+        self.assertEqual(lightLevelFlags(20000, config), {'dark': False, 'daylight': False})
+        self.assertEqual(lightLevelFlags(23000, config), {'dark': False, 'daylight': True})
+
+    def test_unknown_thresholds(self):
+
+        self.assertEqual(lightLevelFlags(12000, None), None)
+        self.assertEqual(lightLevelFlags(12000, {'on': True}), None)
@@ -0,0 +1,85 @@
+import re
+import unittest
+
+from tests.fakes import Qual
+
+from operatorFunctions import likeToRegex, compileQuals, getEqualityValue, getEqualityValues, unknownOperatorException
+
+
+class LikeToRegexTest(unittest.TestCase):
+
+    def like(self, value, pattern):
+        return re.match(likeToRegex(pattern), value, re.S) is not None
+
+    def test_wildcards(self):
+
+        self.assertTrue(self.like('Kitchen 1', 'Kit%'))
+        self.assertTrue(self.like('Kitchen 1', '%chen _'))
+        self.assertFalse(self.like('Kitchen 12', '%chen _'))
+        self.assertTrue(self.like('line\nbreak', 'line%'))
+
+    def test_the_pattern_is_anchored_at_both_ends(self):
+
+        self.assertFalse(self.like('The Kitchen', 'Kitchen'))
+        self.assertFalse(self.like('Kitchen\n', 'Kitchen'))
+
+    def test_escapes_and_regex_characters_are_literal(self):
+
+        self.assertTrue(self.like('100%', '100\\%'))
+        self.assertFalse(self.like('1000', '100\\%'))
+        self.assertTrue(self.like('a.b', 'a.b'))
+        self.assertFalse(self.like('axb', 'a.b'))
+        self.assertTrue(self.like('(1)', '(_)'))
+
+
+class CompileQualsTest(unittest.TestCase):
+
+    def test_rows_by_name(self):
+
+        rowMatches = compileQuals([Qual('brightness', '>=', 100), Qual('name', '~~', 'Hall%')])
+
+        self.assertTrue(rowMatches({'brightness': 200, 'name': 'Hallway'}))
+        self.assertFalse(rowMatches({'brightness': 50, 'name': 'Hallway'}))
+        self.assertFalse(rowMatches({'brightness': 200, 'name': 'Kitchen'}))
+
+    def test_rows_by_position(self):
+
+        rowMatches = compileQuals([Qual('light_id', ('=', True), [1, 3])], {'light_id': 0, 'name': 1})
+
+        self.assertTrue(rowMatches([3, 'Hall']))
+        self.assertFalse(rowMatches([2, 'Hall']))
+
+    def test_all_list_operator(self):
+
+        rowMatches = compileQuals([Qual('light_id', ('<>', False), [1, 3])])
+
+        self.assertTrue(rowMatches({'light_id': 2}))
+        self.assertFalse(rowMatches({'light_id': 3}))
+
+    def test_null_never_matches_a_pattern(self):
+
+        rowMatches = compileQuals([Qual('name', '!~~', 'Hall%')])
+
+        self.assertFalse(rowMatches({'name': None}))
+        self.assertTrue(rowMatches({'name': 'Kitchen'}))
+
+    def test_an_unknown_operator_fails_before_any_rows(self):
+
+        self.assertRaises(unknownOperatorException, compileQuals, [Qual('name', '@@', 'x')])
+
+
+class EqualityValueTest(unittest.TestCase):
+
+    def test_equality_value(self):
+
+        quals = [Qual('brightness', '>', 1), Qual('light_id', '=', 3)]
+
+        self.assertEqual(getEqualityValue(quals, 'light_id'), 3)
+        self.assertEqual(getEqualityValue(quals, 'brightness'), None)
+        self.assertEqual(getEqualityValue([Qual('light_id', '=', None)], 'light_id'), None)
+
+    def test_equality_values(self):
+
+        self.assertEqual(getEqualityValues([Qual('bridge', '=', '10.0.0.2')], 'bridge'), ['10.0.0.2'])
+        self.assertEqual(getEqualityValues([Qual('bridge', ('=', True), ['10.0.0.2', None])], 'bridge'), ['10.0.0.2'])
+        self.assertEqual(getEqualityValues([Qual('bridge', ('<>', False), ['10.0.0.2'])], 'bridge'), None)
@@ -0,0 +1,50 @@
+import unittest
+
+from sensorHistory import RingBuffer, parseLastUpdated, recordable
+
+
+class RingBufferTest(unittest.TestCase):
+
+    def test_between(self):
+
+        ring = RingBuffer(8)
+        for when in [10, 20, 30, 40]:
+            ring.append(when, when / 10)
+
+        self.assertEqual(list(ring.between(None, None)), [(10, 1), (20, 2), (30, 3), (40, 4)])
+        self.assertEqual(list(ring.between(20, 30)), [(20, 2), (30, 3)])
+        self.assertEqual(list(ring.between(25, None)), [(30, 3), (40, 4)])
+        self.assertEqual(list(ring.between(None, 5)), [])
+
+    def test_the_oldest_entries_are_overwritten(self):
+
+        ring = RingBuffer(3)
+        for when in range(1, 8):
+            ring.append(when, when)
+
+        self.assertEqual(list(ring.between(None, None)), [(5, 5), (6, 6), (7, 7)])
+        self.assertEqual(list(ring.between(6, 100)), [(6, 6), (7, 7)])
+
+    def test_booleans_are_recorded_as_numbers(self):
+
+        ring = RingBuffer(2)
+        ring.append(1, True)
+
+        self.assertEqual(list(ring.between(None, None)), [(1, 1.0)])
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_last_updated(self):
+
+        self.assertEqual(parseLastUpdated('1970-01-01T00:01:00'), 60.0)
+        self.assertEqual(parseLastUpdated('1970-01-01T00:01:00.500'), 60.0)
+        self.assertEqual(parseLastUpdated('none'), None)
+        self.assertEqual(parseLastUpdated('yesterday'), None)
+
+    def test_recordable(self):
+
+        self.assertTrue(recordable(True))
+        self.assertTrue(recordable(2150))
+        self.assertFalse(recordable('none'))
+        self.assertFalse(recordable(None))
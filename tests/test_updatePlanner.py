@@ -0,0 +1,159 @@
+import unittest
+
+from tests.fakes import FakeBridge
+
+from hueBridge import hueBridgeException
+from updatePlanner import UpdatePlanner, TEMPORARY_GROUP_NAME
+
+
+def light(on=True):
+    return {'state': {'on': on, 'bri': 100}}
+
+
+def bridgeWith(lightIDs, groups=None):
+    return FakeBridge({'lights': dict([(lightID, light()) for lightID in lightIDs]), 'groups': groups or {}})
+
+
+class UpdatePlannerTest(unittest.TestCase):
+
+    def planner(self, bridge, groupUpdates=True, minGroupSize=3):
+        return UpdatePlanner(bridge, 'u', groupUpdates, minGroupSize, 4)
+
+    def test_later_changes_to_a_light_win(self):
+
+        planner = self.planner(bridgeWith(['1']))
+        planner.add(1, {'on': True, 'bri': 10})
+        planner.add('1', {'bri': 20})
+
+        self.assertEqual(planner.pending, {'1': {'on': True, 'bri': 20}})
+
+    def test_every_light_the_same_goes_to_group_0(self):
+
+        bridge = bridgeWith(['1', '2', '3', '4'])
+        planner = self.planner(bridge)
+
+        for lightID in ['1', '2', '3', '4']:
+            planner.add(lightID, {'on': False})
+
+        self.assertEqual(planner.flush(), [])
+        self.assertEqual(bridge.puts(), [('groups/0/action', {'on': False})])
+
+    def test_an_existing_group_with_exactly_those_lights_is_used(self):
+
+        bridge = bridgeWith(['1', '2', '3', '4', '5'], {'7': {'name': 'Kitchen', 'lights': ['1', '2', '3']}})
+        planner = self.planner(bridge)
+
+        for lightID in ['1', '2', '3']:
+            planner.add(lightID, {'bri': 50})
+        planner.add('4', {'bri': 60})
+
+        self.assertEqual(planner.flush(), [])
+        self.assertEqual(sorted(bridge.puts()), [('groups/7/action', {'bri': 50}), ('lights/4/state', {'bri': 60})])
+
+    def test_small_sets_get_a_command_per_light(self):
+
+        bridge = bridgeWith(['1', '2', '3', '4', '5'])
+        planner = self.planner(bridge)
+
+        planner.add('1', {'bri': 50})
+        planner.add('2', {'bri': 50})
+
+        planner.flush()
+
+        self.assertEqual(sorted(bridge.puts()), [('lights/1/state', {'bri': 50}), ('lights/2/state', {'bri': 50})])
+
+    def test_a_temporary_group_is_made_and_removed(self):
+
+        lightIDs = [str(i) for i in range(1, 11)]
+        bridge = bridgeWith(lightIDs)
+        planner = self.planner(bridge)
+
+        for lightID in lightIDs[:6]:
+            planner.add(lightID, {'on': True})
+
+        self.assertEqual(planner.flush(), [])
+
+        methods = [(method, address) for method, address, body in bridge.requests if method != 'GET']
+        self.assertEqual(methods, [('POST', 'groups'), ('PUT', 'groups/101/action'), ('DELETE', 'groups/101')])
+        self.assertEqual(bridge.requests[-3][2], {'name': TEMPORARY_GROUP_NAME, 'lights': lightIDs[:6]})
+
+    def test_a_failed_temporary_group_falls_back_to_each_light(self):
+
+        lightIDs = [str(i) for i in range(1, 11)]
+        bridge = bridgeWith(lightIDs)
+        planner = self.planner(bridge)
+
+        # The bridge's group table is full:
+        bridge.answer = lambda method, address, body: {'error': 'full'} if method == 'POST' else None
+
+        for lightID in lightIDs[:6]:
+            planner.add(lightID, {'on': True})
+
+        self.assertEqual(planner.flush(), [])
+        self.assertEqual(sorted(address for address, body in bridge.puts()), sorted('lights/%s/state' % lightID for lightID in lightIDs[:6]))
+
+    def test_a_failed_temporary_group_delete_is_only_a_warning(self):
+
+        lightIDs = [str(i) for i in range(1, 11)]
+        bridge = bridgeWith(lightIDs)
+        planner = self.planner(bridge)
+
+        def answer(method, address, body):
+            if method == 'DELETE':
+                raise hueBridgeException('DELETE timed out')
+
+        bridge.answer = answer
+
+        for lightID in lightIDs[:6]:
+            planner.add(lightID, {'on': True})
+
+        self.assertEqual(planner.flush(), [])
+        self.assertEqual(len(planner.takeWarnings()), 1)
+        self.assertEqual(planner.takeWarnings(), [])
+
+    def test_the_bridges_errors_are_reported_together(self):
+
+        bridge = bridgeWith(['1', '2', '3', '4', '5'])
+        planner = self.planner(bridge, groupUpdates=False)
+
+        bridge.answer = lambda method, address, body: ([{'error': {'type': 201, 'address': '/%s/bri' % address, 'description': 'Device is set to off.'}}]
+                                                       if method == 'PUT' else None)
+
+        planner.add('1', {'bri': 50})
+        planner.add('2', {'bri': 50})
+
+        failures = planner.flush()
+
+        self.assertEqual(len(failures), 1)
+        self.assertIn('/lights/1/state/bri', failures[0])
+        self.assertIn('/lights/2/state/bri', failures[0])
+
+    def test_flush_forgets_its_changes_even_when_planning_fails(self):
+
+        bridge = bridgeWith(['1', '2', '3', '4'])
+        planner = self.planner(bridge)
+        planner.add('1', {'on': False})
+
+        def plan():
+            raise hueBridgeException('no answer')
+
+        planner.plan = plan
+
+        self.assertRaises(hueBridgeException, planner.flush)
+        self.assertEqual(planner.pending, {})
+        self.assertEqual(planner.flush(), [])
+
+    def test_savepoints(self):
+
+        planner = self.planner(bridgeWith(['1', '2']))
+        planner.add('1', {'on': True})
+        planner.savepoint()
+        planner.add('1', {'bri': 1})
+        planner.add('2', {'on': False})
+        planner.rollbackToSavepoint()
+
+        self.assertEqual(planner.pending, {'1': {'on': True}})
+
+        planner.discard()
+
+        self.assertEqual(planner.pending, {})